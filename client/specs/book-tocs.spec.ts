@@ -4,6 +4,7 @@ import { expect } from '@jest/globals'
 
 import { BookRootNode, type BookToc, type ClientTocNode, TocNodeKind } from '../../common/src/toc'
 import { type BookOrTocNode, type OrphanCollection, OrphanCollectionKind, TocsTreeProvider, toggleTocTreesFilteringHandler } from '../src/book-tocs'
+import { BookTocsPatchKind } from '../../common/src/requests'
 
 const testTocPage: ClientTocNode = {
   type: TocNodeKind.Page,
@@ -75,6 +76,48 @@ describe('Toc Provider', () => {
     expect(p.getParent(testToc.tocTree[0])).toBe(testToc)
     expect(p.getParentBook(testToc)).toBe(undefined)
   })
+  it('remembers parents as the tree is expanded', () => {
+    const p = new TocsTreeProvider()
+    p.update([testToc], [])
+    const getChildren = SinonRoot.spy(p, 'getChildren')
+    expect(p.getChildren(testToc)).toEqual([testTocSubbook])
+    expect(p.getParent(testTocSubbook)).toBe(testToc)
+    expect(getChildren.callCount).toBe(1)
+    // Revealing a node that was never expanded finds its parents
+    expect(p.getParent(testTocPage)).toBe(testTocSubbook)
+    expect(p.getParent(testToc)).toBe(undefined)
+    getChildren.restore()
+  })
+  it('applies patches in place and only refreshes what changed', () => {
+    const page = (token: string): ClientTocNode => ({ type: TocNodeKind.Page, value: { absPath: `/${token}`, token, title: token, fileId: token } })
+    const subbook: ClientTocNode = { type: TocNodeKind.Subbook, value: { token: 'sub', title: 'Unit' }, children: [page('p1'), page('p2')] }
+    const book: BookToc = { ...testToc, tocTree: [subbook, page('p1')] }
+    const orphans = [page('p3').value]
+    const p = new TocsTreeProvider()
+    p.update([book], orphans)
+    const fired: Array<BookOrTocNode[] | undefined> = []
+    p.onDidChangeTreeData(e => { fired.push(e as BookOrTocNode[] | undefined) })
+    const [p1InSubbook, p2] = subbook.children
+    const p4 = page('p4')
+    const parent = { bookIndex: 0, parentToken: 'sub' }
+    p.applyPatch([
+      { kind: BookTocsPatchKind.Remove, parent: { bookIndex: 0, parentToken: undefined }, index: 1 },
+      { kind: BookTocsPatchKind.Move, parent, fromIndex: 1, toIndex: 0 },
+      { kind: BookTocsPatchKind.Insert, parent, index: 2, node: p4 },
+      { kind: BookTocsPatchKind.Retitle, token: 'p1', title: 'Renamed' }
+    ])
+    expect(book.tocTree).toEqual([subbook])
+    expect(subbook.children).toEqual([p2, p1InSubbook, p4])
+    expect(p1InSubbook.value.title).toBe('Renamed')
+    expect(p.getParent(p4)).toBe(subbook)
+    expect(fired).toEqual([[book, subbook, p1InSubbook]])
+
+    p.applyPatch([{ kind: BookTocsPatchKind.Retitle, token: 'p3', title: 'Orphan' }])
+    expect(orphans[0].title).toBe('Orphan')
+    const orphanCollection = p.getChildren()[1]
+    expect(fired[1]).toEqual([orphanCollection])
+    expect(p.getChildren(orphanCollection)).toEqual([{ type: TocNodeKind.Page, value: orphans[0] }])
+  })
 })
 
 describe('filtering', () => {
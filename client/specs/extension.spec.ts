@@ -9,7 +9,7 @@ import * as utils from '../src/utils' // Used for dependency mocking in tests
 import Sinon from 'sinon'
 import { type LanguageClient } from 'vscode-languageclient/node'
 import { OpenstaxCommand } from '../src/extension-types'
-import { type BooksAndOrphans, ExtensionServerNotification } from '../../common/src/requests'
+import { type BooksAndOrphans, type BookTocsPatch, ExtensionServerNotification, ExtensionServerRequest, type VersionedBooksAndOrphans } from '../../common/src/requests'
 import { type PanelManager } from '../src/panel'
 import { type CnxmlPreviewPanel } from '../src/panel-cnxml-preview'
 import * as pushContent from '../src/push-content'
@@ -31,8 +31,9 @@ describe('Extension', () => {
 
   describe('with mocked languageserver client', () => {
     let onNotificationStub = sinon.stub()
+    let sendRequestStub = sinon.stub()
     beforeEach(() => {
-      const sendRequestStub = sinon.stub()
+      sendRequestStub = sinon.stub()
       onNotificationStub = sinon.stub()
       const mockClient = {
         stop: sinon.stub(),
@@ -69,6 +70,36 @@ describe('Extension', () => {
 
         expect(updateStub.callCount).toBe(1)
       })
+      it('applies BookTocs patches and asks for everything again when it missed one', async () => {
+        setResourceRootDir(join(__dirname, '..', 'static'))
+        await activate(extensionContext)
+
+        expect(onNotificationStub.secondCall.args[0]).toBe(ExtensionServerNotification.BookTocsPatch)
+        const onBookTocs = onNotificationStub.firstCall.args[1]
+        const onPatch = onNotificationStub.secondCall.args[1]
+        const { tocTreesProvider } = getTocTree()
+        if (tocTreesProvider == null) throw new Error('tocTreesProvider was not set yet')
+        const applyPatchStub = sinon.stub(tocTreesProvider, 'applyPatch')
+        const updateStub = sinon.stub(tocTreesProvider, 'update')
+        sinon.stub(utils, 'getRootPathUri').returns(vscode.Uri.file('/workspace'))
+        const snapshot: VersionedBooksAndOrphans = { version: 7, books: [], orphans: [] }
+        sendRequestStub.resolves(snapshot)
+
+        onBookTocs({ version: 1, books: [], orphans: [] })
+        const patch: BookTocsPatch = { baseVersion: 1, version: 2, ops: [] }
+        onPatch(patch)
+        expect(applyPatchStub.callCount).toBe(1)
+
+        onPatch({ ...patch, baseVersion: 5, version: 6 })
+        expect(applyPatchStub.callCount).toBe(1)
+        expect(sendRequestStub.lastCall.args[0]).toBe(ExtensionServerRequest.BookTocs)
+        await sendRequestStub.lastCall.returnValue
+        await new Promise(resolve => setImmediate(resolve))
+        expect(updateStub.lastCall.args).toEqual([snapshot.books, snapshot.orphans])
+
+        onPatch({ ...patch, baseVersion: 7, version: 8 })
+        expect(applyPatchStub.callCount).toBe(2)
+      })
     })
     describe('panels', () => {
       const fakeResourceRootDir = '/fake-resource-root-dir'
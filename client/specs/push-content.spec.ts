@@ -28,9 +28,11 @@ describe('Push Button Test Suite', () => {
   afterEach(() => { sinon.restore() })
   const commitOptions: CommitOptions = { all: true }
   const sendRequestMock = sinon.stub()
+  const onProgressMock = sinon.stub().returns({ dispose: () => {} })
   const mockHostContext: ExtensionHostContext = {
     client: {
-      sendRequest: sendRequestMock
+      sendRequest: sendRequestMock,
+      onProgress: onProgressMock
     }
   } as any as ExtensionHostContext
   const withProgressNoCancel = (
@@ -449,6 +451,37 @@ describe('Push Button Test Suite', () => {
       ExtensionServerRequest.BundleEnsureIds
     )).toBe(true)
   })
+  test('pushContent shows how far along fixing ids is and stops when cancelled', async () => {
+    sinon.stub(utils, 'getErrorDiagnosticsBySource').resolves(new Map<string, Array<[vscode.Uri, vscode.Diagnostic]>>())
+    sinon.stub(pushContent, 'canPush').returns(true)
+    sinon.stub(pushContent, 'getBookRepo').returns(Substitute.for<Repository>())
+    const stubPushContentHelperInner = sinon.stub()
+    sinon.stub(pushContent, '_pushContent').returns(stubPushContentHelperInner)
+    const messages: string[] = []
+    let cancelled = false
+    const withProgressCancelLater = async (
+      options: vscode.ProgressOptions,
+      task: (
+        progress: vscode.Progress<{ message?: string, increment?: number }>,
+        token: vscode.CancellationToken
+      ) => Thenable<unknown>
+    ): Promise<unknown> => await task(
+      { report: ({ message }) => { if (message !== undefined) messages.push(message) } },
+      { get isCancellationRequested() { return cancelled }, onCancellationRequested: sinon.stub() }
+    )
+    sinon.stub(vscode.window, 'withProgress').callsFake(withProgressCancelLater)
+    sendRequestMock.callsFake(async () => {
+      const [, , onProgress] = onProgressMock.lastCall.args
+      onProgress({ kind: 'report', percentage: 50, message: '1 of 2 pages' })
+      cancelled = true
+      return { pages: 1, ids: 3, cancelled: true }
+    })
+    await pushContent.pushContent(mockHostContext)()
+    expect(messages).toContain('Creating Auto Element IDs (1 of 2 pages)...')
+    expect(sendRequestMock.firstCall.args[1].workDoneToken).toBe(onProgressMock.lastCall.args[1])
+    expect(stubPushContentHelperInner.callCount).toBe(0)
+    sendRequestMock.reset()
+  })
   test('pushContent invokes _pushContent with private submodule and book repository', async () => {
     const getExtensionStub = Substitute.for<vscode.Extension<GitExtension>>()
     const stubPrivateSubmodule = Substitute.for<Repository>()
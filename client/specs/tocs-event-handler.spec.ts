@@ -120,6 +120,14 @@ describe('TocsEventHandler', () => {
       await expect(tocsEventHandler.removeNode({} as unknown as BookOrTocNode)).rejects.toThrow(/token/)
       expect(sendRequestMock).not.toHaveBeenCalled()
     })
+    it('sends the version of the ToC it was made against', async () => {
+      tocsTreeProvider.version = 7
+      await tocsEventHandler.removeNode(testTocPage)
+      expect(sendRequestMock).toBeCalledWith(
+        ExtensionServerRequest.TocModification,
+        expect.objectContaining({ version: 7 })
+      )
+    })
   })
   describe('move node', () => {
     const testCases: Array<{
@@ -1,6 +1,7 @@
 import { EventEmitter, type TreeItem, TreeItemCollapsibleState, Uri, type TreeDataProvider, ThemeIcon } from 'vscode'
 
 import { type BookToc, type ClientTocNode, BookRootNode, TocNodeKind, type ClientPageish } from '../../common/src/toc'
+import { applyBookTocsPatch, type BookTocsPatchOp } from '../../common/src/requests'
 import type vscode from 'vscode'
 
 export const OrphanCollectionKind = 'OrphanCollection'
@@ -20,13 +21,19 @@ export const TocItemIcon = {
 }
 
 export class TocsTreeProvider implements TreeDataProvider<BookOrTocNode> {
-  private readonly _onDidChangeTreeData = new EventEmitter<void>()
+  private readonly _onDidChangeTreeData = new EventEmitter<BookOrTocNode[] | undefined>()
   readonly onDidChangeTreeData = this._onDidChangeTreeData.event
 
   public includeFileIdsForFilter = false
+  // Of the BookTocs that are shown. Sent with ToC edits so the server can
+  // reject the ones made against an older ToC
+  public version: number | undefined
   private bookTocs: BookToc[]
+  private orphans: ClientPageish[] = []
   private readonly orphanCollection: OrphanCollection
   private readonly parentsMap = new Map<BookOrTocNode, BookOrTocNode>()
+  private allParentsKnown = false
+  private orphanNodes = new Set<BookOrTocNode>()
 
   constructor() {
     this.bookTocs = []
@@ -35,23 +42,51 @@ export class TocsTreeProvider implements TreeDataProvider<BookOrTocNode> {
 
   public toggleFilterMode() {
     this.includeFileIdsForFilter = !this.includeFileIdsForFilter
-    this._onDidChangeTreeData.fire()
+    this._onDidChangeTreeData.fire(undefined)
   }
 
   public update(n: BookToc[], o: ClientPageish[]) {
     this.bookTocs = n
+    this.orphans = o
+    // Parents are remembered as the tree is expanded (see getChildren and getParent)
     this.parentsMap.clear()
-    this.bookTocs.forEach(n => { this.recAddParent(n) })
-    this.orphanCollection.children = o.map(toClientTocNode)
-    this._onDidChangeTreeData.fire()
+    this.allParentsKnown = false
+    this.setOrphanNodes()
+    this._onDidChangeTreeData.fire(undefined)
   }
 
-  private recAddParent(node: BookOrTocNode) {
-    const kids = this.getChildren(node)
-    kids.forEach(k => {
-      this.parentsMap.set(k, node)
-      this.recAddParent(k)
+  // Edits the books and orphans from the last update in place and only
+  // refreshes the items that changed
+  public applyPatch(ops: BookTocsPatchOp[]) {
+    const applied = applyBookTocsPatch({ books: this.bookTocs, orphans: this.orphans }, ops)
+    applied.removed.forEach(n => { this.recRemoveParent(n) })
+    applied.inserted.forEach(({ node, parent }) => {
+      this.parentsMap.set(node, parent)
+      if (this.allParentsKnown) this.recAddParent(node)
     })
+    const changed: BookOrTocNode[] = [...applied.changed]
+    if (applied.orphansChanged) {
+      this.setOrphanNodes()
+      changed.push(this.orphanCollection)
+    }
+    if (changed.length > 0) {
+      this._onDidChangeTreeData.fire(changed)
+    }
+  }
+
+  private setOrphanNodes() {
+    this.orphanCollection.children = this.orphans.map(toClientTocNode)
+    this.orphanNodes = new Set(this.orphanCollection.children)
+  }
+
+  private recRemoveParent(node: BookOrTocNode) {
+    this.getChildren(node).forEach(k => { this.recRemoveParent(k) })
+    this.parentsMap.delete(node)
+  }
+
+  private recAddParent(node: BookOrTocNode) {
+    // getChildren remembers the parent of each kid
+    this.getChildren(node).forEach(k => { this.recAddParent(k) })
   }
 
   public getTreeItem(node: BookOrTocNode): TreeItem {
@@ -114,10 +149,21 @@ export class TocsTreeProvider implements TreeDataProvider<BookOrTocNode> {
     } else {
       kids = node.children
     }
+    if (node !== undefined && node.type !== OrphanCollectionKind) {
+      kids.forEach(k => { this.parentsMap.set(k, node) })
+    }
     return kids
   }
 
   public getParent(node: BookOrTocNode) {
+    if (node.type === BookRootNode.Singleton || node.type === OrphanCollectionKind || this.orphanNodes.has(node)) {
+      return undefined
+    }
+    if (!this.parentsMap.has(node) && !this.allParentsKnown) {
+      // Something asked about a node that was never expanded (like reveal)
+      this.bookTocs.forEach(b => { this.recAddParent(b) })
+      this.allParentsKnown = true
+    }
     return this.parentsMap.get(node)
   }
 
@@ -10,7 +10,7 @@ import { type ExtensionHostContext, type Panel, PanelManager } from './panel'
 import { ImageManagerPanel } from './panel-image-manager'
 import { toggleTocTreesFilteringHandler } from './book-tocs'
 import { type BookOrTocNode, TocsTreeProvider } from './book-tocs'
-import { type BooksAndOrphans, EMPTY_BOOKS_AND_ORPHANS, ExtensionServerNotification } from '../../common/src/requests'
+import { type BookTocsPatch, EMPTY_BOOKS_AND_ORPHANS, ExtensionServerNotification, requestBookTocs, type VersionedBooksAndOrphans } from '../../common/src/requests'
 import { readmeGenerator } from './generate-readme'
 import { TocsEventHandler } from './tocs-event-handler'
 import { TocNodeKind } from '../../common/src/toc'
@@ -97,9 +97,29 @@ function doRest(client: LanguageClient): ExtensionExports {
 
   tocTreesProvider = new TocsTreeProvider()
   tocEventHandler = new TocsEventHandler(tocTreesProvider, hostContext)
-  client.onNotification(ExtensionServerNotification.BookTocs, (params: BooksAndOrphans) => {
+  let resyncing = false
+  const replaceBookTocs = (params: VersionedBooksAndOrphans) => {
+    tocTreesProvider.version = params.version
     hostContext.bookTocs = params // When a panel opens, make sure it has the latest bookTocs
     tocTreesProvider.update(params.books, params.orphans)
+  }
+  client.onNotification(ExtensionServerNotification.BookTocs, replaceBookTocs)
+  client.onNotification(ExtensionServerNotification.BookTocsPatch, (patch: BookTocsPatch) => {
+    if (resyncing) return // The snapshot on its way has these changes
+    if (patch.baseVersion === tocTreesProvider.version) {
+      tocTreesProvider.version = patch.version
+      // Edits hostContext.bookTocs too since the tree provider shares its books and orphans
+      tocTreesProvider.applyPatch(patch.ops)
+      return
+    }
+    // We missed a patch so ask for everything
+    const workspaceUri = getRootPathUri()
+    /* istanbul ignore if */
+    if (workspaceUri === null) return
+    resyncing = true
+    void ensureCatchPromise(requestBookTocs(client, { workspaceUri: workspaceUri.toString() })
+      .then(replaceBookTocs)
+      .finally(() => { resyncing = false }))
   })
 
   vscode.workspace.onDidChangeWorkspaceFolders(ensureCatch(forwardOnDidChangeWorkspaceFolders(client)))
@@ -2,8 +2,8 @@ import vscode from 'vscode'
 import { expect, getErrorDiagnosticsBySource, getRootPathUri } from './utils'
 import { type GitExtension, GitErrorCodes, type CommitOptions, type Repository, Status } from './git-api/git'
 import { type ExtensionHostContext } from './panel'
-import { DiagnosticSource, requestEnsureIds, requestGetSubmoduleConfig } from '../../common/src/requests'
-import { type LanguageClient } from 'vscode-languageclient/node'
+import { DiagnosticSource, type EnsureIdsSummary, requestEnsureIds, requestGetSubmoduleConfig } from '../../common/src/requests'
+import { type LanguageClient, WorkDoneProgress } from 'vscode-languageclient/node'
 
 const PRIVATE_SUBMODULE_NAME = 'private'
 
@@ -285,6 +285,29 @@ export const preparePrivateSubmodule = async (
   }
 }
 
+// Fixes the ids of every page and shows how far along the server is
+export const ensureIds = async (
+  client: LanguageClient,
+  workspaceUri: string,
+  progress: vscode.Progress<{ message?: string }>,
+  token: vscode.CancellationToken
+): Promise<EnsureIdsSummary | undefined> => {
+  const workDoneToken = `ensure-ids-${Date.now()}`
+  const listener = client.onProgress(WorkDoneProgress.type, workDoneToken, value => {
+    if (value.kind !== 'end' && value.message !== undefined) {
+      progress.report({ message: `Creating Auto Element IDs (${value.message})...` })
+    }
+  })
+  try {
+    return await requestEnsureIds(client, { workspaceUri, workDoneToken }, token)
+  } catch (e) {
+    if (token.isCancellationRequested) return undefined
+    throw e
+  } finally {
+    listener.dispose()
+  }
+}
+
 export const pushContent = (hostContext: ExtensionHostContext) => async () => {
   // Do a precursory check for known errors (fast!)
   if (canPush(getErrorDiagnosticsBySource())) {
@@ -303,8 +326,11 @@ export const pushContent = (hostContext: ExtensionHostContext) => async () => {
       const uri = expect(getRootPathUri(), 'No root path in which to generate a module')
       const pushTargets = [getBookRepo()]
       // fix ids
-      // TODO: better ui in future. Add `increment` value in `progress.report` and use a callback to update real progress
-      await requestEnsureIds(hostContext.client, { workspaceUri: uri.toString() })
+      await ensureIds(hostContext.client, uri.toString(), progress, token)
+      if (token.isCancellationRequested) {
+        // The pages that were already fixed stay fixed
+        return
+      }
       try {
         const privateSubmodule = _getPrivateSubmodule()
         if (privateSubmodule !== undefined) {
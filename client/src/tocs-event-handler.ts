@@ -1,6 +1,6 @@
 import vscode from 'vscode'
 import { type TocsTreeProvider, type BookOrTocNode, OrphanCollectionKind } from './book-tocs'
-import { type TocModification, TocModificationKind, type TocModificationParams, TocNodeKind, BookRootNode, type CreatePageEvent, type CreateSubbookEvent, type CreateAncillaryEvent, isClientTocNode } from '../../common/src/toc'
+import { type TocModification, TocModificationKind, type TocModificationParams, TocNodeKind, BookRootNode, type CreatePageEvent, type CreateSubbookEvent, type CreateAncillaryEvent, isClientTocNode, type TocEvent } from '../../common/src/toc'
 import { ExtensionServerRequest } from '../../common/src/requests'
 import { expect, getRootPathUri } from './utils'
 import { type ExtensionHostContext } from './panel'
@@ -17,8 +17,6 @@ export const validateTitle = (title: string) => {
 
 export const XFER_ITEM_ID = 'application/vnd.code.tree.tocTrees'
 
-type TocEvent = TocModification | CreateSubbookEvent | CreatePageEvent | CreateAncillaryEvent
-
 export class TocsEventHandler implements vscode.TreeDragAndDropController<BookOrTocNode> {
   constructor(
     private readonly tocTreesProvider: TocsTreeProvider,
@@ -34,7 +32,7 @@ export class TocsEventHandler implements vscode.TreeDragAndDropController<BookOr
 
   private async fireEvent(event: TocEvent) {
     const workspaceUri = this.workspaceUri
-    const params: TocModificationParams = { workspaceUri, event }
+    const params: TocModificationParams = { workspaceUri, event, version: this.tocTreesProvider.version }
     await this.context.client.sendRequest(
       ExtensionServerRequest.TocModification,
       params
@@ -163,6 +163,11 @@ export function launchLanguageServer(context: vscode.ExtensionContext): Language
   const clientOptions: LanguageClientOptions = {
     // Register the server for XML documents
     documentSelector: [{ scheme: 'file', language: 'xml' }],
+    initializationOptions: {
+      parserThreads: vscode.workspace.getConfiguration('languageServerCnxml').get('parserThreads', 0),
+      // Parsed files are cached here between sessions
+      cacheDir: context.storageUri?.fsPath
+    },
     synchronize: {
       fileEvents: [
         // NOTE: these patterns do not support matching directories without matching files
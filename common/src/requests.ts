@@ -1,4 +1,4 @@
-import { type BookToc, type ClientPageish } from './toc'
+import { BookRootNode, type BookToc, type ClientPageish, type ClientTocNode, type Token, TocNodeKind } from './toc'
 
 export enum DiagnosticSource {
   xml = 'xml',
@@ -16,12 +16,15 @@ export type Opt<T> = T | undefined
 export enum ExtensionServerRequest {
   BundleEnsureIds = 'BUNDLE_ENSURE_IDS',
   TocModification = 'TOC_MODIFICATION',
+  TocModificationBatch = 'TOC_MODIFICATION_BATCH',
   GenerateReadme = 'GENREATE_README',
-  GetSubmoduleConfig = 'GET_SUBMODULE_CONFIG'
+  GetSubmoduleConfig = 'GET_SUBMODULE_CONFIG',
+  BookTocs = 'BOOK_TOCS'
 }
 
 export enum ExtensionServerNotification {
   BookTocs = 'BOOK_TOCS',
+  BookTocsPatch = 'BOOK_TOCS_PATCH'
 }
 
 export interface NewPageParams {
@@ -44,17 +47,158 @@ export interface BooksAndOrphans {
 
 export const EMPTY_BOOKS_AND_ORPHANS: BooksAndOrphans = { books: [], orphans: [] }
 
+// The server sends the whole BooksAndOrphans once and then only patches.
+// Every send bumps the version. A client whose version is not the baseVersion
+// of a patch has missed something and asks for the whole thing again
+// (see requestBookTocs).
+export interface VersionedBooksAndOrphans extends BooksAndOrphans {
+  version: number
+}
+
+export interface BookTocsPatch {
+  baseVersion: number
+  version: number
+  ops: BookTocsPatchOp[]
+}
+
+export enum BookTocsPatchKind {
+  Insert = 'BookTocsPatchKind.Insert',
+  Remove = 'BookTocsPatchKind.Remove',
+  Move = 'BookTocsPatchKind.Move',
+  Retitle = 'BookTocsPatchKind.Retitle',
+  Orphans = 'BookTocsPatchKind.Orphans'
+}
+
+// The children of a book (parentToken is undefined) or of a subbook
+export interface TocParent {
+  bookIndex: number
+  parentToken: Token | undefined
+}
+
+export type BookTocsPatchOp = TocInsertOp | TocRemoveOp | TocMoveOp | TocRetitleOp | TocOrphansOp
+export interface TocInsertOp { readonly kind: BookTocsPatchKind.Insert, parent: TocParent, index: number, node: ClientTocNode }
+export interface TocRemoveOp { readonly kind: BookTocsPatchKind.Remove, parent: TocParent, index: number }
+// `toIndex` is the index after the node was taken out
+export interface TocMoveOp { readonly kind: BookTocsPatchKind.Move, parent: TocParent, fromIndex: number, toIndex: number }
+// Applies to every node with the token (a page can be in more than one place)
+export interface TocRetitleOp { readonly kind: BookTocsPatchKind.Retitle, token: Token, title: string | undefined }
+export interface TocOrphansOp { readonly kind: BookTocsPatchKind.Orphans, orphans: ClientPageish[] }
+
+type TocParentNode = BookToc | ClientTocNode
+export interface AppliedBookTocsPatch {
+  // Books and subbooks whose children changed and nodes that were retitled
+  changed: Set<TocParentNode>
+  inserted: Array<{ node: ClientTocNode, parent: TocParentNode }>
+  removed: ClientTocNode[]
+  orphansChanged: boolean
+}
+
+const childrenOfParent = (n: TocParentNode) => {
+  if (n.type === BookRootNode.Singleton) return n.tocTree
+  if (n.type === TocNodeKind.Subbook) return n.children
+  throw new Error('BUG: Pages do not have children')
+}
+
+function indexTokens(state: BooksAndOrphans) {
+  const byToken = new Map<Token, ClientTocNode[]>()
+  const add = (n: ClientTocNode) => {
+    const list = byToken.get(n.value.token)
+    if (list === undefined) {
+      byToken.set(n.value.token, [n])
+    } else {
+      list.push(n)
+    }
+    if (n.type === TocNodeKind.Subbook) n.children.forEach(add)
+  }
+  state.books.forEach(b => { b.tocTree.forEach(add) })
+  return byToken
+}
+
+// Changes `state` in place so the tree items that did not change keep their
+// identity. Returns what changed so only those items need to be redrawn.
+export function applyBookTocsPatch(state: BooksAndOrphans, ops: BookTocsPatchOp[]): AppliedBookTocsPatch {
+  const applied: AppliedBookTocsPatch = { changed: new Set(), inserted: [], removed: [], orphansChanged: false }
+  let byToken: Map<Token, ClientTocNode[]> | undefined
+  const parentOf = ({ bookIndex, parentToken }: TocParent) => {
+    const book = state.books[bookIndex]
+    if (book === undefined) throw new Error(`BUG: There is no book at index ${bookIndex}`)
+    if (parentToken === undefined) return book
+    byToken = byToken ?? indexTokens(state)
+    const parent = byToken.get(parentToken)?.[0]
+    if (parent === undefined) throw new Error(`BUG: There is no subbook with token '${parentToken}'`)
+    return parent
+  }
+  for (const op of ops) {
+    switch (op.kind) {
+      case BookTocsPatchKind.Insert: {
+        const parent = parentOf(op.parent)
+        childrenOfParent(parent).splice(op.index, 0, op.node)
+        applied.inserted.push({ node: op.node, parent })
+        applied.changed.add(parent)
+        byToken = undefined
+        break
+      }
+      case BookTocsPatchKind.Remove: {
+        const parent = parentOf(op.parent)
+        applied.removed.push(...childrenOfParent(parent).splice(op.index, 1))
+        applied.changed.add(parent)
+        byToken = undefined
+        break
+      }
+      case BookTocsPatchKind.Move: {
+        const parent = parentOf(op.parent)
+        const children = childrenOfParent(parent)
+        children.splice(op.toIndex, 0, ...children.splice(op.fromIndex, 1))
+        applied.changed.add(parent)
+        break
+      }
+      case BookTocsPatchKind.Retitle: {
+        byToken = byToken ?? indexTokens(state)
+        for (const n of byToken.get(op.token) ?? []) {
+          if (n.type === TocNodeKind.Subbook) {
+            n.value.title = op.title ?? n.value.title
+          } else {
+            n.value.title = op.title
+          }
+          applied.changed.add(n)
+        }
+        state.orphans.forEach(o => {
+          if (o.token === op.token) {
+            o.title = op.title
+            applied.orphansChanged = true
+          }
+        })
+        break
+      }
+      case BookTocsPatchKind.Orphans:
+        state.orphans.splice(0, state.orphans.length, ...op.orphans)
+        applied.orphansChanged = true
+        break
+    }
+  }
+  return applied
+}
+
 // Mock out the basic need of the LanguageClient for common,
 // since we can't import the client lib.
 interface LanguageClient {
-  sendRequest: <R>(method: string, param: any) => Promise<R>
+  sendRequest: <R>(method: string, param: any, token?: any) => Promise<R>
 }
 
 export interface BundleRequestParams {
   workspaceUri: string
 }
 
-export interface BundleEnsureIdsParams extends BundleRequestParams { }
+export interface BundleEnsureIdsParams extends BundleRequestParams {
+  workDoneToken?: string // The server reports its progress with this token
+}
+// What BUNDLE_ENSURE_IDS did. When it was cancelled the pages that were
+// already written keep their new ids.
+export interface EnsureIdsSummary {
+  pages: number // pages that were changed
+  ids: number // ids that were added
+  cancelled: boolean
+}
 export interface BundleGenerateReadmeParams extends BundleRequestParams {
   repo: {
     owner: string
@@ -62,9 +206,10 @@ export interface BundleGenerateReadmeParams extends BundleRequestParams {
   }
 }
 export interface BundleGetSubmoduleConfigParams extends BundleRequestParams { }
+export interface BundleBookTocsParams extends BundleRequestParams { }
 
-export const requestEnsureIds = async (client: LanguageClient, args: BundleEnsureIdsParams): Promise<void> => {
-  await client.sendRequest(ExtensionServerRequest.BundleEnsureIds, args)
+export const requestEnsureIds = async (client: LanguageClient, args: BundleEnsureIdsParams, token?: unknown): Promise<EnsureIdsSummary> => {
+  return await client.sendRequest(ExtensionServerRequest.BundleEnsureIds, args, token)
 }
 
 export const requestGenerateReadme = async (client: LanguageClient, args: BundleGenerateReadmeParams): Promise<void> => {
@@ -74,3 +219,7 @@ export const requestGenerateReadme = async (client: LanguageClient, args: Bundle
 export const requestGetSubmoduleConfig = async (client: LanguageClient, args: BundleGetSubmoduleConfigParams): Promise<Record<string, string> | null> => {
   return await client.sendRequest(ExtensionServerRequest.GetSubmoduleConfig, args)
 }
+
+export const requestBookTocs = async (client: LanguageClient, args: BundleBookTocsParams): Promise<VersionedBooksAndOrphans> => {
+  return await client.sendRequest(ExtensionServerRequest.BookTocs, args)
+}
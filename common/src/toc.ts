@@ -46,9 +46,17 @@ export interface BookToc {
   tocTree: ClientTocNode[]
 }
 
+export type TocEvent = TocModification | CreateSubbookEvent | CreatePageEvent | CreateAncillaryEvent
 export interface TocModificationParams {
   workspaceUri: string
-  event: TocModification | CreateSubbookEvent | CreatePageEvent | CreateAncillaryEvent
+  event: TocEvent
+  version?: number // of the BookTocs the event was made against. Rejected when the ToC changed since
+}
+// Applied in order. Each collection is written once and a single ToC update is sent
+export interface TocModificationBatchParams {
+  workspaceUri: string
+  events: TocEvent[]
+  version?: number // Same as TocModificationParams
 }
 export type TocModification = (TocMoveEvent | TocRemoveEvent | PageRenameEvent | SubbookRenameEvent | AncillaryRenameEvent)
 export interface TocMoveEvent {
@@ -0,0 +1,7 @@
+// Benchmarks are not run with the unit tests. Run them with `npm run bench`
+/** @type {import('@ts-jest/dist/types').InitialOptionsTsJest} */
+module.exports = {
+  ...require('./jest.config.js'),
+  testRegex: '\\.bench\\.ts$',
+  testTimeout: 5 * 60 * 1000
+}
@@ -0,0 +1,45 @@
+import { expect } from '@jest/globals'
+
+describe('bench-helpers Dummy', () => {
+  it('trivially passes because Jest requires every bench file to have at least one test', () => {
+    expect(true).toBe(true)
+  })
+})
+
+export interface BenchResult {
+  name: string
+  iterations: number
+  msPerOp: number
+  peakHeapMb: number // Highest heap growth seen while running, compared to before
+}
+
+const gc = (): void => { (global as any).gc?.() } // Needs `node --expose-gc` (see `npm run bench`)
+
+export function bench(name: string, iterations: number, fn: () => unknown): BenchResult {
+  fn() // warm up
+  gc()
+  const baseline = process.memoryUsage().heapUsed
+  let peak = baseline
+  const start = process.hrtime.bigint()
+  for (let i = 0; i < iterations; i++) {
+    fn()
+    peak = Math.max(peak, process.memoryUsage().heapUsed)
+  }
+  const ns = Number(process.hrtime.bigint() - start)
+  return { name, iterations, msPerOp: ns / 1e6 / iterations, peakHeapMb: (peak - baseline) / 1024 / 1024 }
+}
+
+// How much the heap grows to keep what `build` returns alive. The result is
+// returned so it stays reachable until the heap was measured
+export function retainedHeapMb<T>(build: () => T): { kept: T, mb: number } {
+  gc()
+  const baseline = process.memoryUsage().heapUsed
+  const kept = build()
+  gc()
+  return { kept, mb: (process.memoryUsage().heapUsed - baseline) / 1024 / 1024 }
+}
+
+export function report(title: string, results: BenchResult[]) {
+  const lines = results.map(r => `  ${r.name.padEnd(40)} ${r.msPerOp.toFixed(3).padStart(10)} ms/op ${r.peakHeapMb.toFixed(1).padStart(8)} MB peak heap (${r.iterations} runs)`)
+  console.log([title, ...lines].join('\n'))
+}
@@ -0,0 +1,49 @@
+import { expect } from '@jest/globals'
+import { BookRootNode, type BookToc, type ClientTocNode, type Token, TocNodeKind } from '../../common/src/toc'
+import { TocIdMap } from './book-toc-utils'
+import { bench, report } from './bench-helpers.bench'
+
+// What ModelManager.lookupToken used to do
+function recFind(token: Token, parent: ClientTocNode | BookToc, nodes: ClientTocNode[]): { node: ClientTocNode, parent: ClientTocNode | BookToc } | undefined {
+  for (const node of nodes) {
+    if (node.value.token === token) return { node, parent }
+    if (node.type === TocNodeKind.Subbook) {
+      const ret = recFind(token, node, node.children)
+      if (ret !== undefined) return ret
+    }
+  }
+}
+const lookupToken = (books: BookToc[], token: Token) => {
+  for (const b of books) {
+    const ret = recFind(token, b, b.tocTree)
+    if (ret !== undefined) return ret
+  }
+}
+
+// Units of chapters of sections of pages
+function makeBook(slug: string, units: number): BookToc {
+  const page = (token: string): ClientTocNode => ({ type: TocNodeKind.Page, value: { token, title: token, fileId: token, absPath: `/modules/${token}/index.cnxml` } })
+  const subbook = (token: string, children: ClientTocNode[]): ClientTocNode => ({ type: TocNodeKind.Subbook, value: { token, title: token }, children })
+  const range = (n: number) => Array.from({ length: n }, (_, i) => i)
+  const tocTree = range(units).map(u => subbook(`${slug}-u${u}`, range(10).map(c => subbook(`${slug}-u${u}-c${c}`, range(10).map(s => subbook(`${slug}-u${u}-c${c}-s${s}`, range(10).map(p => page(`${slug}-u${u}-c${c}-s${s}-p${p}`))))))))
+  return { type: BookRootNode.Singleton, absPath: `/collections/${slug}.collection.xml`, uuid: slug, title: slug, slug, language: 'en', licenseUrl: '', tocTree }
+}
+
+describe('ToC token lookup', () => {
+  it('finds the nodes of a move without searching every book', () => {
+    const books = [makeBook('a', 5), makeBook('b', 5)]
+    const m = new TocIdMap(() => { throw new Error('BUG: Not used by this bench') })
+    m.placeBooks(books)
+    // The node, its new parent and the ancestors that were visited to find its book
+    const tokens = ['b-u4-c9-s9-p9', 'b-u4-c9-s9', 'b-u4-c9', 'b-u4', 'a-u0-c0-s0']
+    tokens.forEach(t => { expect(m.placeOf(t)?.node).toBe(lookupToken(books, t)?.node) })
+    const results = [
+      bench('recursive search (lookupToken)', 20, () => tokens.map(t => lookupToken(books, t))),
+      bench('remembered places (placeOf)', 20, () => tokens.map(t => m.placeOf(t)))
+    ]
+    const nodes = books.length * 5 * (1 + 10 * (1 + 10 * (1 + 10)))
+    report(`Resolving the tokens of a move in ${books.length} books with ${nodes} nodes`, results)
+    expect(results[1].msPerOp).toBeLessThan(results[0].msPerOp)
+    expect(results[1].msPerOp).toBeLessThan(1)
+  })
+})
@@ -1,10 +1,11 @@
 import xmlFormat from 'xml-formatter'
 import { DOMParser, XMLSerializer } from 'xmldom'
-import { BookRootNode, type BookToc, type ClientPageish, type ClientTocNode, type TocPage } from '../../common/src/toc'
+import { BookRootNode, type BookToc, type ClientPageish, type ClientTocNode, type Token, type TocPage } from '../../common/src/toc'
+import { type BookTocsPatchOp, BookTocsPatchKind, type BooksAndOrphans, type TocParent } from '../../common/src/requests'
 import { pageToModuleId } from './model-manager'
-import { type BookNode, type TocSubbookWithRange, type TocNodeWithRange } from './model/book'
+import { type BookFacts, type BookNode, type TocNodeFact, type TocSubbookWithRange, type TocNodeWithRange } from './model/book'
 import { type PageNode } from './model/page'
-import { selectOne, NS_COLLECTION, NS_METADATA, TocNodeKind, equalsArray } from './model/utils'
+import { selectOne, NS_COLLECTION, NS_METADATA, TocNodeKind, equalsArray, expectValue, type Opt, type Range, type WithRange } from './model/utils'
 
 export const equalsTocNode = (n1: ClientTocNode, n2: ClientTocNode): boolean => {
   /* istanbul ignore next */
@@ -87,6 +88,79 @@ export function toString(t: BookToc) {
   return serailizedXml
 }
 
+const COLLECTION_START_TAG = '<col:collection xmlns:col="http://cnx.rice.edu/collxml" xmlns:md="http://cnx.rice.edu/mdml" xmlns="http://cnx.rice.edu/collxml">'
+const INDENTATION = '  '
+// Text that xmldom and xml-formatter write back as it is (other than &).
+// Anything else goes through toString.
+const PLAIN_TEXT_RE = /^[^\x00-\x1f<>\u2028\u2029]*\S[^\x00-\x1f<>\u2028\u2029]*$/
+const PLAIN_ATTRIBUTE_RE = /^[^\x00-\x1f<>&"'\u2028\u2029]*$/
+
+// Writes the same bytes as toString without a DOM or a second pass through
+// xml-formatter. It also returns the facts (with the ranges xmldom would
+// report) so the BookNode can be updated without parsing what was written.
+// Undefined when a title or attribute has characters that this does not
+// know how to escape exactly like toString.
+export function writeCollection(t: BookToc): Opt<{ xml: string, facts: BookFacts }> {
+  const lines: string[] = []
+  // Every element but the root is followed by a line break so, like in
+  // calculateElementPositions, it ends where its line ends
+  const line = (depth: number, xml: string): Range => {
+    const character = depth * INDENTATION.length
+    const start = { line: lines.length, character }
+    lines.push(`${INDENTATION.repeat(depth)}${xml}`)
+    return { start, end: { line: start.line, character: character + xml.length } }
+  }
+  const text = (depth: number, tag: string, v: string): Opt<WithRange<string>> => {
+    if (!PLAIN_TEXT_RE.test(v)) return undefined
+    return { v, range: line(depth, `<${tag}>${v.replace(/&/g, '&amp;')}</${tag}>`) }
+  }
+  const children = (depth: number, nodes: ClientTocNode[]): Opt<TocNodeFact[]> => {
+    const facts: TocNodeFact[] = []
+    for (const n of nodes) {
+      if (n.type === TocNodeKind.Page || n.type === TocNodeKind.Ancillary) {
+        const pageId = n.value.fileId
+        if (!PLAIN_ATTRIBUTE_RE.test(pageId)) return undefined
+        facts.push({ type: TocNodeKind.Page, pageId, range: line(depth, `<col:module document="${pageId}"/>`) })
+      } else {
+        line(depth, '<col:subcollection>')
+        const title = text(depth + 1, 'md:title', n.value.title)
+        const content = title === undefined ? undefined : contentOf(depth + 1, n.children)
+        if (title === undefined || content === undefined) return undefined
+        line(depth, '</col:subcollection>')
+        facts.push({ type: TocNodeKind.Subbook, title: title.v, children: content, range: title.range })
+      }
+    }
+    return facts
+  }
+  const contentOf = (depth: number, nodes: ClientTocNode[]): Opt<TocNodeFact[]> => {
+    if (nodes.length === 0) {
+      line(depth, '<col:content/>')
+      return []
+    }
+    line(depth, '<col:content>')
+    const facts = children(depth + 1, nodes)
+    line(depth, '</col:content>')
+    return facts
+  }
+
+  line(0, COLLECTION_START_TAG)
+  line(1, '<col:metadata>')
+  const title = text(2, 'md:title', t.title)
+  const slug = text(2, 'md:slug', t.slug)
+  const language = text(2, 'md:language', t.language)
+  const uuid = text(2, 'md:uuid', t.uuid)
+  if (title === undefined || slug === undefined || language === undefined || uuid === undefined || !PLAIN_ATTRIBUTE_RE.test(t.licenseUrl)) return undefined
+  const license = line(2, `<md:license url="${t.licenseUrl}"/>`)
+  line(1, '</col:metadata>')
+  const toc = contentOf(1, t.tocTree)
+  if (toc === undefined) return undefined
+  line(0, '</col:collection>')
+  return {
+    xml: lines.join('\n'),
+    facts: { uuid, title, slug, language, licenseUrl: { v: t.licenseUrl, range: license }, licenseText: { v: '', range: license }, toc }
+  }
+}
+
 export function fromPage(tocIdMap: IdMap<string, TocSubbookWithRange | PageNode>, n: PageNode): TocPage<ClientPageish> {
   return { type: TocNodeKind.Page, value: { token: tocIdMap.add(n), title: n.title, absPath: n.absPath, fileId: pageToModuleId(n) } }
 }
@@ -94,10 +168,152 @@ function recTree(tocIdMap: IdMap<string, TocSubbookWithRange | PageNode>, parent
   if (n.type === TocNodeKind.Page) {
     return fromPage(tocIdMap, n.page)
   } else {
-    return { ...n, value: { token: tocIdMap.add(n), title: n.title }, children: n.children.map(c => recTree(tocIdMap, n, c)) }
+    return { type: TocNodeKind.Subbook, value: { token: tocIdMap.add(n), title: n.title }, children: n.children.map(c => recTree(tocIdMap, n, c)) }
   }
 }
 
+// Gives each subbook a token that stays the same while the subbook stays in
+// its book, even though the book is loaded again (with new
+// TocSubbookWithRange objects) after every edit. Tokens are never reused, so a
+// token from a client that has not seen the latest ToC does not resolve to
+// some other subbook.
+export class SubbookTokens {
+  private next = 0
+  // What each book looked like in the last build
+  private previous = new Map<string, BuiltSubbooks>()
+  // The tokens of the subbooks of the books that were just written, in document order
+  private readonly written = new Map<string, Token[]>()
+
+  public fresh(): Token { return `servertoken:inner:${this.next++}` }
+
+  // Call when `book` is written so its subbooks keep their tokens once it is loaded again
+  public wrote(book: BookToc) {
+    const tokens: Token[] = []
+    const rec = (nodes: ClientTocNode[]) => {
+      nodes.forEach(n => {
+        if (n.type !== TocNodeKind.Subbook) return
+        tokens.push(n.value.token)
+        rec(n.children)
+      })
+    }
+    rec(book.tocTree)
+    this.written.set(book.absPath, tokens)
+  }
+
+  public assign(books: BookNode[]) {
+    const tokens = new Map<TocSubbookWithRange, Token>()
+    const built = new Map<string, BuiltSubbooks>()
+    for (const book of books) {
+      const prev = this.previous.get(book.absPath)
+      const written = this.written.get(book.absPath)
+      this.written.delete(book.absPath)
+      const subbooks: Array<{ subbook: TocSubbookWithRange, parent: Opt<TocSubbookWithRange> }> = []
+      const rec = (parent: Opt<TocSubbookWithRange>, nodes: TocNodeWithRange[]) => {
+        nodes.forEach(n => {
+          if (n.type !== TocNodeKind.Subbook) return
+          subbooks.push({ subbook: n, parent })
+          rec(n, n.children)
+        })
+      }
+      rec(undefined, book.toc)
+      const byTitle = new Map<string, Token[]>()
+      const keyOf = (parentToken: Token, title: string) => `${parentToken}\n${title}`
+      if (prev !== undefined && prev.toc === book.toc) {
+        subbooks.forEach(({ subbook }) => { tokens.set(subbook, expectValue(prev.tokens.get(subbook), 'BUG: the book did not change')) })
+      } else {
+        // Loaded again. When this is what was written the subbooks are in the
+        // same order. Otherwise (edited some other way) a subbook keeps the
+        // token of the one with the same title in the same parent
+        const inOrder = written?.length === subbooks.length ? written : undefined
+        subbooks.forEach(({ subbook, parent }, i) => {
+          const parentToken = parent === undefined ? '' : expectValue(tokens.get(parent), 'BUG: parents come first')
+          tokens.set(subbook, inOrder?.[i] ?? prev?.byTitle.get(keyOf(parentToken, subbook.title))?.shift() ?? this.fresh())
+        })
+      }
+      subbooks.forEach(({ subbook, parent }) => {
+        const key = keyOf(parent === undefined ? '' : expectValue(tokens.get(parent), 'BUG: parents come first'), subbook.title)
+        byTitle.set(key, [...(byTitle.get(key) ?? []), expectValue(tokens.get(subbook), 'BUG: every subbook has a token')])
+      })
+      built.set(book.absPath, { toc: book.toc, tokens: new Map(subbooks.map(({ subbook }) => [subbook, expectValue(tokens.get(subbook), 'BUG: every subbook has a token')])), byTitle })
+    }
+    this.previous = built
+    return tokens
+  }
+}
+
+interface BuiltSubbooks {
+  toc: TocNodeWithRange[]
+  tokens: Map<TocSubbookWithRange, Token>
+  byTitle: Map<string, Token[]> // by parent token and title, for matching after the file was edited
+}
+
+const sameBookMetadata = (b1: BookToc, b2: BookToc) => (
+  b1.absPath === b2.absPath &&
+  b1.uuid === b2.uuid &&
+  b1.title === b2.title &&
+  b1.slug === b2.slug &&
+  b1.language === b2.language &&
+  b1.licenseUrl === b2.licenseUrl
+)
+const tokenOf = (n: ClientTocNode) => n.value.token
+
+// The ops that turn `prev` into `next`, or undefined when the books themselves
+// changed (added, removed, reordered or their metadata edited) and the client
+// should be sent everything again.
+export function diffBooksAndOrphans(prev: BooksAndOrphans, next: BooksAndOrphans): Opt<BookTocsPatchOp[]> {
+  if (!equalsArray(sameBookMetadata)(prev.books, next.books)) return undefined
+  const ops: BookTocsPatchOp[] = []
+  // Retitles go last and once per token because a page can be in more than one place
+  const titles = new Map<Token, string | undefined>()
+  prev.books.forEach((b, bookIndex) => {
+    diffChildren(ops, titles, { bookIndex, parentToken: undefined }, b.tocTree, next.books[bookIndex].tocTree)
+  })
+  if (!equalsArray<string>((t1, t2) => t1 === t2)(prev.orphans.map(o => o.token), next.orphans.map(o => o.token))) {
+    ops.push({ kind: BookTocsPatchKind.Orphans, orphans: next.orphans })
+  } else {
+    next.orphans.forEach((o, i) => {
+      if (o.title !== prev.orphans[i].title) titles.set(o.token, o.title)
+    })
+  }
+  titles.forEach((title, token) => { ops.push({ kind: BookTocsPatchKind.Retitle, token, title }) })
+  return ops
+}
+
+function diffChildren(ops: BookTocsPatchOp[], titles: Map<Token, string | undefined>, parent: TocParent, prev: ClientTocNode[], next: ClientTocNode[]) {
+  const nextTokens = new Set(next.map(tokenOf))
+  if (nextTokens.size !== next.length || new Set(prev.map(tokenOf)).size !== prev.length) {
+    // A page is in here more than once so tokens do not say which one moved. Start this level over
+    prev.forEach(() => { ops.push({ kind: BookTocsPatchKind.Remove, parent, index: 0 }) })
+    next.forEach((node, index) => { ops.push({ kind: BookTocsPatchKind.Insert, parent, index, node }) })
+    return
+  }
+  const current = prev.slice()
+  for (let i = current.length - 1; i >= 0; i--) {
+    if (!nextTokens.has(tokenOf(current[i]))) {
+      ops.push({ kind: BookTocsPatchKind.Remove, parent, index: i })
+      current.splice(i, 1)
+    }
+  }
+  next.forEach((node, i) => {
+    const token = tokenOf(node)
+    if (current[i] === undefined || tokenOf(current[i]) !== token) {
+      const fromIndex = current.findIndex((n, j) => j > i && tokenOf(n) === token)
+      if (fromIndex < 0) {
+        ops.push({ kind: BookTocsPatchKind.Insert, parent, index: i, node })
+        current.splice(i, 0, node)
+        return
+      }
+      ops.push({ kind: BookTocsPatchKind.Move, parent, fromIndex, toIndex: i })
+      current.splice(i, 0, ...current.splice(fromIndex, 1))
+    }
+    const old = current[i]
+    if (old.value.title !== node.value.title) titles.set(token, node.value.title)
+    if (old.type === TocNodeKind.Subbook && node.type === TocNodeKind.Subbook) {
+      diffChildren(ops, titles, { bookIndex: parent.bookIndex, parentToken: token }, old.children, node.children)
+    }
+  })
+}
+
 function recBuild(doc: Document, node: ClientTocNode): Element {
   if (node.type === TocNodeKind.Page || node.type === TocNodeKind.Ancillary) {
     const ret = doc.createElementNS(NS_COLLECTION, 'col:module')
@@ -144,6 +360,44 @@ export class IdMap<K, V> {
   // getKey(v: V) { return this.map2.get(v) }
 }
 
+// Where a node is in the BookTocs
+export interface TocPlace { node: ClientTocNode, parent: BookToc | ClientTocNode, bookIndex: number, childIndex: number }
+
+// Also remembers where each token is in the BookTocs so ToC edits find a node,
+// its parent and its book without searching every tree. The BookTocs are
+// edited in place so `place` has to be called again on every parent whose
+// children change.
+export class TocIdMap extends IdMap<Token, TocSubbookWithRange | PageNode> {
+  private readonly places = new Map<Token, TocPlace>()
+
+  placeOf(token: Token) { return this.places.get(token) }
+
+  placeBooks(books: BookToc[]) {
+    this.places.clear()
+    // Backwards (like `place`) so a page that is in more than one book is found in the first one
+    for (let bookIndex = books.length - 1; bookIndex >= 0; bookIndex--) {
+      this.place(books[bookIndex], bookIndex, true)
+    }
+  }
+
+  // Records where the children of `parent` are and, when `deep`, where all of their descendants are
+  place(parent: BookToc | ClientTocNode, bookIndex: number, deep = false) {
+    const children = parent.type === BookRootNode.Singleton ? parent.tocTree : parent.type === TocNodeKind.Subbook ? parent.children : []
+    // Backwards so a page that is in the ToC twice is found where it first appears
+    for (let childIndex = children.length - 1; childIndex >= 0; childIndex--) {
+      const node = children[childIndex]
+      if (deep) this.place(node, bookIndex, true)
+      this.places.set(node.value.token, { node, parent, bookIndex, childIndex })
+    }
+  }
+
+  // Forgets a node that was removed from the BookTocs along with its descendants
+  unplace(node: ClientTocNode) {
+    if (this.places.get(node.value.token)?.node === node) this.places.delete(node.value.token)
+    if (node.type === TocNodeKind.Subbook) node.children.forEach(c => { this.unplace(c) })
+  }
+}
+
 export function renameTitle(newTitle: string, cnxmlStr: string) {
   const doc = new DOMParser().parseFromString(cnxmlStr)
   selectOne('/cnxml:document/cnxml:title', doc).textContent = newTitle
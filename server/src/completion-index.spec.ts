@@ -0,0 +1,33 @@
+import { expect } from '@jest/globals'
+import { CompletionIndex } from './completion-index'
+
+describe('CompletionIndex', () => {
+  const paths = ['media/cat.png', 'media/catalog.svg', 'media/dog.png', 'media/Concat.jpg', 'other/cat-2.png', 'media/c-a-t.gif']
+  const makeIndex = () => {
+    const index = new CompletionIndex<string>(p => p)
+    paths.forEach(p => { index.add(p) })
+    return index
+  }
+  it('ranks prefix, name, substring and then fuzzy matches', () => {
+    const index = makeIndex()
+    expect(index.search('media/cat', 10)).toEqual(['media/cat.png', 'media/catalog.svg'])
+    expect(index.search('CAT', 10)).toEqual(['media/cat.png', 'media/catalog.svg', 'other/cat-2.png', 'media/Concat.jpg', 'media/c-a-t.gif'])
+    expect(index.search('', 10)).toEqual([...paths].sort((a, b) => a.toLowerCase() < b.toLowerCase() ? -1 : 1))
+    expect(index.search('zzz', 10)).toEqual([])
+  })
+  it('returns at most limit items that are accepted', () => {
+    const index = makeIndex()
+    expect(index.search('cat', 2)).toEqual(['media/cat.png', 'media/catalog.svg'])
+    expect(index.search('cat', 2, p => !p.endsWith('.svg'))).toEqual(['media/cat.png', 'other/cat-2.png'])
+    expect(index.search('', 1)).toEqual(['media/c-a-t.gif'])
+  })
+  it('keeps up with items being added and removed', () => {
+    const index = makeIndex()
+    index.delete('media/cat.png')
+    index.add('media/cat.png') // Added twice
+    index.add('media/cat.png')
+    index.delete('media/catalog.svg')
+    expect(index.size).toBe(paths.length - 1)
+    expect(index.search('media/cat', 10)).toEqual(['media/cat.png'])
+  })
+})
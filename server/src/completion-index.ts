@@ -0,0 +1,89 @@
+import { type Opt } from './model/utils'
+
+interface Entry<T> {
+  item: T
+  key: string // lowercased
+  name: string // the last path segment of the key
+}
+
+// Finds completion candidates by what was typed. Keys stay sorted so the ones
+// that start with the typed text are found with a binary search. After those
+// come the ones whose name starts with it, then the ones that contain it and
+// then the ones that have its characters in order (fuzzy).
+export class CompletionIndex<T> {
+  private readonly entries = new Map<T, Entry<T>>()
+  private sorted: Opt<Array<Entry<T>>> // Sorted again on the first search after a change
+
+  constructor(private readonly keyOf: (item: T) => string) { }
+
+  public get size() { return this.entries.size }
+
+  public add(item: T) {
+    if (this.entries.has(item)) return
+    const key = this.keyOf(item).toLowerCase()
+    this.entries.set(item, { item, key, name: key.slice(key.lastIndexOf('/') + 1) })
+    this.sorted = undefined
+  }
+
+  public delete(item: T) {
+    if (this.entries.delete(item)) this.sorted = undefined
+  }
+
+  // At most `limit` items, best matches first. `accept` is only called on
+  // items that match.
+  public search(typed: string, limit: number, accept: (item: T) => boolean = () => true): T[] {
+    const query = typed.toLowerCase()
+    const sorted = this.getSorted()
+    const found: T[] = []
+    for (let i = lowerBound(sorted, query); i < sorted.length && found.length < limit && sorted[i].key.startsWith(query); i++) {
+      if (accept(sorted[i].item)) found.push(sorted[i].item)
+    }
+    // Everything starts with ''
+    if (found.length >= limit || query === '') return found
+    const remaining = limit - found.length
+    const byName: T[] = []
+    const containing: T[] = []
+    const fuzzy: T[] = []
+    for (const e of sorted) {
+      if (byName.length >= remaining) break
+      if (e.key.startsWith(query)) continue // Already looked at
+      const tier = e.name.startsWith(query)
+        ? byName
+        : e.key.includes(query)
+          ? containing
+          : isSubsequence(query, e.key) ? fuzzy : undefined
+      if (tier !== undefined && tier.length < remaining && accept(e.item)) tier.push(e.item)
+    }
+    return [...found, ...byName, ...containing, ...fuzzy].slice(0, limit)
+  }
+
+  private getSorted() {
+    if (this.sorted === undefined) {
+      this.sorted = [...this.entries.values()].sort((a, b) => a.key < b.key ? -1 : a.key > b.key ? 1 : 0)
+    }
+    return this.sorted
+  }
+}
+
+// The first index whose key is not less than `query`
+function lowerBound<T>(sorted: Array<Entry<T>>, query: string) {
+  let lo = 0
+  let hi = sorted.length
+  while (lo < hi) {
+    const mid = (lo + hi) >>> 1
+    if (sorted[mid].key < query) {
+      lo = mid + 1
+    } else {
+      hi = mid
+    }
+  }
+  return lo
+}
+
+function isSubsequence(query: string, key: string) {
+  let i = 0
+  for (let j = 0; i < query.length && j < key.length; j++) {
+    if (query[i] === key[j]) i++
+  }
+  return i === query.length
+}
@@ -0,0 +1,60 @@
+import { expect } from '@jest/globals'
+import { readFileSync } from 'fs'
+import I from 'immutable'
+import { loadDependencies, loadDependenciesByRescan } from './dependency-loader'
+import { type Fileish } from './model/fileish'
+import { makeBundle } from './model/spec-helpers.spec'
+import { NOWHERE } from './model/utils'
+
+const readOrUndefined = (absPath: string) => {
+  try {
+    return readFileSync(absPath, 'utf-8')
+  } catch {
+    return undefined
+  }
+}
+const loadFromDisk = async (nodes: Fileish[]) => {
+  nodes.forEach(n => { n.load(readOrUndefined(n.absPath)) })
+}
+
+const stateOf = (nodes: I.Set<Fileish>) => nodes.toArray()
+  .map(n => ({ path: n.absPath, isLoaded: n.isLoaded, exists: n.exists, errors: n.validationErrors.errors.map(e => e.title).sort().toArray() }))
+  .sort((a, b) => a.path.localeCompare(b.path))
+
+describe('loadDependencies', () => {
+  it('ends in the same state as rescanning the whole bundle', async () => {
+    const expected = makeBundle()
+    const rescanWaves = await loadDependenciesByRescan(expected, loadFromDisk)
+
+    const actual = makeBundle()
+    const seen: number[] = []
+    const waves = await loadDependencies(I.Set([actual]), loadFromDisk, w => { seen.push(w.files) })
+
+    expect(stateOf(actual.allNodes)).toEqual(stateOf(expected.allNodes))
+    expect(actual.allNodes.every(n => n.isLoaded)).toBe(true)
+    expect(waves).toEqual(rescanWaves)
+    expect(seen).toEqual(waves.map(w => w.files))
+  })
+  it('does nothing when the roots are loaded', async () => {
+    const bundle = makeBundle()
+    bundle.load(undefined)
+    expect(await loadDependencies(I.Set([bundle]), loadFromDisk)).toEqual([])
+  })
+  it('does not retry files that did not parse', async () => {
+    const bundle = makeBundle()
+    const loaded: Fileish[] = []
+    const waves = await loadDependencies(I.Set([bundle]), async nodes => {
+      loaded.push(...nodes)
+      nodes.forEach(n => {
+        if (n === bundle) {
+          n.load(readFileSync(n.absPath, 'utf-8'))
+        } else {
+          n.loadFacts({ error: { message: 'Broken', range: NOWHERE } })
+        }
+      })
+    })
+    expect(waves.map(w => w.round)).toEqual([1, 2])
+    expect(loaded.length).toBe(1 + bundle.allBooks.size)
+    expect(bundle.allBooks.all.every(b => !b.isValidXML)).toBe(true)
+  })
+})
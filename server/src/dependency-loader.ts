@@ -0,0 +1,42 @@
+import I from 'immutable'
+import { type Fileish } from './model/fileish'
+import { type Bundle } from './model/bundle'
+
+export interface LoadWave { round: number, files: number }
+
+const needsLoading = (n: Fileish) => !n.isLoaded && n.isValidXML
+
+// Loads the roots and then, one wave at a time, everything they depend on
+// until nothing is left to load. Each wave only looks at the dependencies of
+// the nodes loaded in the previous wave (instead of validating the whole
+// Bundle again) and is handed to loadWave in one batch.
+//
+// Ends in the same state as repeatedly loading every unloaded node in
+// bundle.allNodes.flatMap(n => n.validationErrors.nodesToLoad).
+export async function loadDependencies(roots: I.Set<Fileish>, loadWave: (nodes: Fileish[]) => Promise<void>, onWave?: (wave: LoadWave) => void) {
+  const waves: LoadWave[] = []
+  let wave = roots.filter(needsLoading)
+  while (wave.size > 0) {
+    const current = { round: waves.length + 1, files: wave.size }
+    onWave?.(current)
+    await loadWave(wave.toArray())
+    waves.push(current)
+    wave = wave.flatMap(n => n.dependencies).filter(needsLoading)
+  }
+  return waves
+}
+
+// Same result as loadDependencies, by rescanning the whole Bundle every round.
+// Kept to check the worklist version against.
+export async function loadDependenciesByRescan(bundle: Bundle, loadWave: (nodes: Fileish[]) => Promise<void>) {
+  const waves: LoadWave[] = []
+  let wave = I.Set<Fileish>()
+  do {
+    wave = bundle.allNodes.flatMap(n => n.validationErrors.nodesToLoad).filter(n => !n.isLoaded && n.validationErrors.errors.size === 0)
+    if (wave.size > 0) {
+      waves.push({ round: waves.length + 1, files: wave.size })
+      await loadWave(wave.toArray())
+    }
+  } while (wave.size > 0)
+  return waves
+}
@@ -0,0 +1,55 @@
+import { expect } from '@jest/globals'
+import fs from 'fs'
+import path from 'path'
+import mockfs from 'mock-fs'
+import SinonRoot from 'sinon'
+import { DirectoryListings } from './directory-listings'
+
+describe('DirectoryListings', () => {
+  const sinon = SinonRoot.createSandbox()
+  const media = path.resolve('media')
+  beforeEach(() => {
+    mockfs({
+      'media/a.png': '',
+      'media/b.svg': '<svg/>',
+      'media/sub/c.gif': ''
+    })
+  })
+  afterEach(() => {
+    mockfs.restore()
+    sinon.restore()
+  })
+
+  it('lists each directory once', async () => {
+    const opendir = sinon.spy(fs.promises, 'opendir')
+    const listings = new DirectoryListings()
+    const found = await Promise.all(['a.png', 'b.svg', 'sub', 'missing.png'].map(async n => await listings.isFile(path.join(media, n))))
+    expect(found).toEqual([true, true, false, false])
+    expect(await listings.isFile(path.join(media, 'sub', 'c.gif'))).toBe(true)
+    expect(opendir.callCount).toBe(2)
+  })
+  it('looks up names that are not in the listing with a stat', async () => {
+    const listings = new DirectoryListings()
+    expect(await listings.isFile(path.join(media, 'new.png'))).toBe(false)
+    fs.writeFileSync(path.join(media, 'new.png'), '')
+    expect(await listings.isFile(path.join(media, 'new.png'))).toBe(true)
+  })
+  it('lists a directory again once something in it changed', async () => {
+    const listings = new DirectoryListings()
+    expect(await listings.isFile(path.join(media, 'a.png'))).toBe(true)
+    expect(await listings.isFile(path.join(media, 'sub', 'c.gif'))).toBe(true)
+    fs.rmSync(path.join(media, 'a.png'))
+    fs.rmSync(path.join(media, 'sub'), { recursive: true })
+    // Still listed
+    expect(await listings.isFile(path.join(media, 'a.png'))).toBe(true)
+    listings.forget(path.join(media, 'a.png'))
+    listings.forget(path.join(media, 'sub'))
+    expect(await listings.isFile(path.join(media, 'a.png'))).toBe(false)
+    expect(await listings.isFile(path.join(media, 'sub', 'c.gif'))).toBe(false)
+  })
+  it('stats each name in a directory that cannot be listed', async () => {
+    const listings = new DirectoryListings()
+    expect(await listings.isFile(path.join(media, 'a.png', 'x'))).toBe(false)
+    expect(await listings.isFile(path.resolve('nowhere', 'x'))).toBe(false)
+  })
+})
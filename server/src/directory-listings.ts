@@ -0,0 +1,55 @@
+import fs from 'fs'
+import path from 'path'
+import { readdirAsync } from './fs-utils'
+import { type Opt } from './model/utils'
+
+// Which files exist, from one listing per directory instead of an access +
+// stat (+ read) per file. The media folder of an image-heavy book has
+// thousands of files and all of them are looked up while the bundle loads.
+//
+// A listing is kept until `forget` is called for something in its directory
+// (a file or directory was created or removed there). A name that is not in
+// the listing is looked up with a stat, so case-insensitive filesystems still
+// find it like before.
+export class DirectoryListings {
+  // The names of the files in each directory. Undefined when it could not be listed
+  private readonly listings = new Map<string, Promise<Opt<Set<string>>>>()
+
+  public async isFile(fsPath: string) {
+    const files = await this.listing(path.dirname(fsPath))
+    if (files?.has(path.basename(fsPath)) === true) return true
+    const stat = await fs.promises.stat(fsPath).catch(() => undefined)
+    return stat?.isFile() === true
+  }
+
+  // Call this when `fsPath` was created or removed
+  public forget(fsPath: string) {
+    this.listings.delete(path.dirname(fsPath))
+    const prefix = `${fsPath}${path.sep}`
+    for (const dir of this.listings.keys()) {
+      if (dir === fsPath || dir.startsWith(prefix)) this.listings.delete(dir)
+    }
+  }
+
+  private async listing(dir: string) {
+    let listing = this.listings.get(dir)
+    if (listing === undefined) {
+      // Lookups that come in while it is being read wait for the same listing
+      listing = this.read(dir)
+      this.listings.set(dir, listing)
+    }
+    return await listing
+  }
+
+  private async read(dir: string): Promise<Opt<Set<string>>> {
+    const files = new Set<string>()
+    try {
+      for await (const entries of readdirAsync({ path: dir, realpath: dir })) {
+        entries.forEach(e => { if (e.isFile()) files.add(e.name) })
+      }
+      return files
+    } catch {
+      return undefined
+    }
+  }
+}
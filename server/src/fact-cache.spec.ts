@@ -0,0 +1,100 @@
+import { expect } from '@jest/globals'
+import fs from 'fs'
+import mockfs from 'mock-fs'
+import { FactCache, FACT_CACHE_SCHEMA } from './fact-cache'
+import { FactsKind } from './model/fileish'
+import { extractFacts } from './parse-worker'
+import { pageMaker } from './model/spec-helpers.spec'
+
+describe('FactCache', () => {
+  const cacheFile = '/cache/facts.json'
+  const pagePath = '/repo/modules/m1/index.cnxml'
+  const content = pageMaker({ elementIds: ['p1'] })
+  const result = extractFacts(FactsKind.PAGE, content)
+  const stat = { mtimeMs: 1000, size: content.length }
+  let caches: FactCache[] = []
+  const open = async () => {
+    const cache = new FactCache(cacheFile)
+    await cache.open()
+    caches.push(cache)
+    return cache
+  }
+  beforeEach(() => {
+    caches = []
+    mockfs({})
+  })
+  afterEach(async () => {
+    // Flush the pending saves while the filesystem is still mocked
+    await Promise.all(caches.map(async c => { await c.save() }))
+    mockfs.restore()
+  })
+
+  it('misses, then hits by mtime and size without reading the file', async () => {
+    const cache = await open()
+    expect(cache.get(pagePath, FactsKind.PAGE, stat, content)).toBeUndefined()
+    cache.set(pagePath, FactsKind.PAGE, stat, content, result)
+    expect(cache.get(pagePath, FactsKind.PAGE, stat)).toEqual(result)
+    expect(cache.get(pagePath, FactsKind.BOOK, stat)).toBeUndefined()
+    expect(cache.counters).toEqual({ hits: 1, misses: 1 })
+  })
+  it('survives a restart', async () => {
+    const cache = await open()
+    cache.set(pagePath, FactsKind.PAGE, stat, content, result)
+    await cache.save()
+
+    const reopened = await open()
+    expect(reopened.size).toBe(1)
+    expect(reopened.get(pagePath, FactsKind.PAGE, stat)).toEqual(result)
+  })
+  it('falls back to the content hash when the mtime changed', async () => {
+    const cache = await open()
+    cache.set(pagePath, FactsKind.PAGE, stat, content, result)
+    const touched = { mtimeMs: 2000, size: content.length }
+    expect(cache.get(pagePath, FactsKind.PAGE, touched)).toBeUndefined()
+    expect(cache.get(pagePath, FactsKind.PAGE, touched, content)).toEqual(result)
+    // The entry now has the new mtime
+    expect(cache.get(pagePath, FactsKind.PAGE, touched)).toEqual(result)
+    const edited = pageMaker({ elementIds: ['p2'] })
+    expect(cache.get(pagePath, FactsKind.PAGE, { mtimeMs: 3000, size: edited.length }, edited)).toBeUndefined()
+  })
+  it('lets go of the facts once a node was loaded from them and keeps them in the file', async () => {
+    const cache = await open()
+    cache.set(pagePath, FactsKind.PAGE, stat, content, result)
+    await cache.save()
+    // Only the file has them now
+    expect(cache.get(pagePath, FactsKind.PAGE, stat)).toBeUndefined()
+
+    const reopened = await open()
+    expect(reopened.get(pagePath, FactsKind.PAGE, stat)).toEqual(result)
+    expect(reopened.get(pagePath, FactsKind.PAGE, stat)).toBeUndefined()
+    const otherPath = '/repo/modules/m2/index.cnxml'
+    reopened.set(otherPath, FactsKind.PAGE, stat, content, result)
+    await reopened.save()
+
+    const again = await open()
+    expect(again.get(pagePath, FactsKind.PAGE, stat)).toEqual(result)
+    expect(again.get(otherPath, FactsKind.PAGE, stat)).toEqual(result)
+  })
+  it('forgets deleted files and directories', async () => {
+    const cache = await open()
+    const otherPath = '/repo/media/m2.cnxml'
+    cache.set(pagePath, FactsKind.PAGE, stat, content, result)
+    cache.set(otherPath, FactsKind.PAGE, stat, content, result)
+    cache.delete('/repo/modules')
+    expect(cache.size).toBe(1)
+    await cache.save()
+    const reopened = await open()
+    expect(reopened.get(pagePath, FactsKind.PAGE, stat)).toBeUndefined()
+    expect(reopened.get(otherPath, FactsKind.PAGE, stat)).toEqual(result)
+  })
+  it('ignores a cache written with another schema or a corrupt one', async () => {
+    fs.mkdirSync('/cache')
+    fs.writeFileSync(cacheFile, JSON.stringify({ schema: `${FACT_CACHE_SCHEMA}-old`, entries: { [pagePath]: {} } }))
+    const old = await open()
+    expect(old.size).toBe(0)
+
+    fs.writeFileSync(cacheFile, '{"schema":')
+    const corrupt = await open()
+    expect(corrupt.size).toBe(0)
+  })
+})
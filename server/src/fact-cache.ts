@@ -0,0 +1,153 @@
+import crypto from 'crypto'
+import fs from 'fs'
+import path from 'path'
+import { type FactsKind, type FactsResult } from './model/fileish'
+import { expectValue, type Opt } from './model/utils'
+import { type Facts } from './parse-worker'
+
+// Bump this whenever PageFacts/BookFacts (or how they are extracted) change
+export const FACT_CACHE_SCHEMA = 'poet-facts-1'
+
+export interface FileStat { mtimeMs: number, size: number }
+interface Entry extends FileStat { hash: string, kind: FactsKind, result: FactsResult<Facts> }
+interface CacheFile { schema: string, entries: Record<string, Entry> }
+// The facts are only kept until they are in the cache file and a node was
+// loaded from them. After that the node has them and `save` copies them from
+// the file it wrote last time.
+type Remembered = Omit<Entry, 'result'> & { result: Opt<FactsResult<Facts>>, inFile: boolean }
+
+export const hashContent = (content: string) => crypto.createHash('sha1').update(content).digest('hex')
+
+// Remembers the facts extracted from each page and book between runs so that
+// files which did not change do not need to be parsed again. Entries are keyed
+// by path and are only used when the mtime and size still match or, when the
+// contents have already been read, when the contents hash to the same value.
+// Each entry is meant to load one node: a second `get` for a path that was
+// loaded from the cache is a miss.
+export class FactCache {
+  public static SAVE_DELAY_MS = 2000
+  public readonly counters = { hits: 0, misses: 0 }
+  private entries = new Map<string, Remembered>()
+  private opening: Opt<Promise<void>>
+  private saveTimer: Opt<NodeJS.Timeout>
+  private dirty = false
+
+  constructor(public readonly file: string) {}
+
+  // Reads the cache file. Safe to call more than once
+  public async open() {
+    if (this.opening === undefined) {
+      this.opening = (async () => {
+        const entries = await this.readEntries()
+        this.entries = new Map([...entries].map(([fsPath, e]) => [fsPath, { ...e, inFile: true }]))
+      })()
+    }
+    await this.opening
+  }
+
+  public get size() { return this.entries.size }
+
+  // Returns undefined on a miss. Without `content` only the mtime and size are
+  // compared so the file does not even need to be read.
+  public get(fsPath: string, kind: FactsKind, stat: FileStat, content?: string): Opt<FactsResult<Facts>> {
+    const e = this.entries.get(fsPath)
+    const { result } = e ?? {}
+    if (e !== undefined && result !== undefined && e.kind === kind) {
+      if (content === undefined) {
+        if (e.mtimeMs === stat.mtimeMs && e.size === stat.size) {
+          this.counters.hits++
+          this.release(fsPath, e)
+          return result
+        }
+      } else if (e.hash === hashContent(content)) {
+        // e.g. a `git checkout` touched the file without changing it
+        if (e.mtimeMs !== stat.mtimeMs || e.size !== stat.size) {
+          this.entries.set(fsPath, { ...e, mtimeMs: stat.mtimeMs, size: stat.size })
+          this.scheduleSave()
+        }
+        this.counters.hits++
+        this.release(fsPath, expectValue(this.entries.get(fsPath), 'BUG: was just set'))
+        return result
+      }
+    }
+    // Only count the misses that lead to parsing the file
+    if (content !== undefined) this.counters.misses++
+    return undefined
+  }
+
+  public set(fsPath: string, kind: FactsKind, stat: FileStat, content: string, result: FactsResult<Facts>) {
+    this.entries.set(fsPath, { mtimeMs: stat.mtimeMs, size: stat.size, hash: hashContent(content), kind, result, inFile: false })
+    this.scheduleSave()
+  }
+
+  // Forgets the file or, for a directory, everything in it
+  public delete(fsPath: string) {
+    const prefix = `${fsPath}${path.sep}`
+    let deleted = this.entries.delete(fsPath)
+    for (const p of this.entries.keys()) {
+      if (p.startsWith(prefix)) {
+        this.entries.delete(p)
+        deleted = true
+      }
+    }
+    if (deleted) this.scheduleSave()
+  }
+
+  public async save() {
+    if (this.saveTimer !== undefined) clearTimeout(this.saveTimer)
+    this.saveTimer = undefined
+    if (!this.dirty) return
+    this.dirty = false
+    const saving = [...this.entries]
+    // The facts that were let go are still in the file that was written last time
+    const released = saving.some(([, e]) => e.result === undefined) ? await this.readEntries() : new Map<string, Entry>()
+    const entries: Record<string, Entry> = {}
+    for (const [fsPath, { inFile, ...e }] of saving) {
+      const old = released.get(fsPath)
+      const result = e.result ?? (old?.hash === e.hash && old.kind === e.kind ? old.result : undefined)
+      // Otherwise it is just a miss next time
+      if (result !== undefined) entries[fsPath] = { ...e, result }
+    }
+    const json: CacheFile = { schema: FACT_CACHE_SCHEMA, entries }
+    // Write to a temporary file first so a crash never leaves a truncated cache behind
+    const tmp = `${this.file}.${process.pid}.tmp`
+    await fs.promises.mkdir(path.dirname(this.file), { recursive: true })
+    await fs.promises.writeFile(tmp, JSON.stringify(json), 'utf-8')
+    await fs.promises.rename(tmp, this.file)
+    // Unless they changed while saving, the entries are in the file now. The
+    // ones that were set were loaded into a node right away
+    for (const [fsPath, e] of saving) {
+      if (this.entries.get(fsPath) !== e || e.inFile) continue
+      if (fsPath in entries) {
+        this.entries.set(fsPath, { ...e, result: undefined, inFile: true })
+      } else {
+        this.entries.delete(fsPath)
+      }
+    }
+  }
+
+  // Once a node was loaded from an entry that is in the file, the facts are not needed here
+  private release(fsPath: string, e: Remembered) {
+    if (e.inFile) this.entries.set(fsPath, { ...e, result: undefined })
+  }
+
+  private async readEntries() {
+    try {
+      const json: CacheFile = JSON.parse(await fs.promises.readFile(this.file, 'utf-8'))
+      return new Map(json.schema === FACT_CACHE_SCHEMA ? Object.entries(json.entries) : [])
+    } catch {
+      // Missing or corrupt. Start over
+      return new Map<string, Entry>()
+    }
+  }
+
+  private scheduleSave() {
+    this.dirty = true
+    if (this.saveTimer !== undefined) return
+    this.saveTimer = setTimeout(() => {
+      this.saveTimer = undefined
+      this.save().catch(err => { console.warn('Could not save the cache', this.file, err) })
+    }, FactCache.SAVE_DELAY_MS)
+    this.saveTimer.unref()
+  }
+}
@@ -0,0 +1,39 @@
+import { expect } from '@jest/globals'
+import { idFixer, spliceIds } from './fix-document-ids'
+import { scanPageFacts } from './model/page-scanner'
+import { pageMaker } from './model/spec-helpers.spec'
+import { expectValue } from './model/utils'
+import { bench, report } from './bench-helpers.bench'
+
+// A page where some of the elements already have ids and the rest do not
+function page(n: number, sections: number) {
+  const extraCnxml = Array.from({ length: sections }, (_, i) => `<section${i % 2 === 0 ? ` id="sect-${n}-${i}"` : ''}><title>Section ${i}</title>
+  <para id="para-${n}-${i}">Some <emphasis>text</emphasis> with a <term>term</term>.</para>
+  <para>A paragraph without an id.</para>
+  <figure><media alt="x"><image src="../../media/img${i}.png" mime-type="image/png"/></media></figure>
+  <note class="x"><para>A note</para></note>
+</section>`).join('\n')
+  return pageMaker({ title: `Page ${n}`, extraCnxml })
+}
+
+describe('Element ID creation', () => {
+  it('splices the ids into a whole book faster than fixing a DOM for every page', () => {
+    const pages = Array.from({ length: 100 }, (_, n) => page(n, 50))
+    // What was found when the pages were parsed
+    const facts = pages.map(p => expectValue(scanPageFacts(p), 'The scanner should handle the bench pages'))
+    const splice = () => pages.map((p, i) => spliceIds(p, facts[i].elementIds.map(e => e.v), facts[i].elementsMissingIds))
+    const spliced = splice()
+    // Same ids as the DOM fixer once they are parsed again
+    const idsOf = (content: string) => expectValue(scanPageFacts(content), 'The scanner should handle the bench pages').elementIds.map(e => e.v)
+    spliced.forEach((s, i) => {
+      expect(idsOf(expectValue(s, 'The facts match the page'))).toEqual(idsOf(idFixer(pages[i], '')))
+    })
+    const results = [
+      bench('xmldom parse + serialize (idFixer)', 3, () => pages.map(p => idFixer(p, ''))),
+      bench('splice into the text (spliceIds)', 3, splice)
+    ]
+    const mb = pages.reduce((sum, p) => sum + p.length, 0) / 1024 / 1024
+    report(`Adding ids to a book of ${pages.length} pages (${mb.toFixed(1)} MB, ${facts.reduce((sum, f) => sum + f.elementsMissingIds.length, 0)} ids)`, results)
+    expect(results[1].msPerOp).toBeLessThan(results[0].msPerOp)
+  })
+})
@@ -2,9 +2,24 @@ import { expect } from '@jest/globals'
 import assert from 'assert'
 import * as xpath from 'xpath-ts'
 import { DOMParser, XMLSerializer } from 'xmldom'
-import { fixDocument, idFixer, padLeft } from './fix-document-ids'
+import { fixDocument, idFixer, padLeft, spliceIds } from './fix-document-ids'
 import mockfs from 'mock-fs'
 import { bundleMaker, pageMaker } from './model/spec-helpers.spec'
+import { scanPageFacts } from './model/page-scanner'
+import { expectValue } from './model/utils'
+
+const serialize = (doc: Document) => new XMLSerializer().serializeToString(doc)
+
+// spliceIds leaves everything but the start tags as it was so compare the
+// documents after a round trip through xmldom
+function expectSpliceToMatch(input: string) {
+  const facts = expectValue(scanPageFacts(input), 'The scanner should handle the test documents')
+  const spliced = expectValue(spliceIds(input, facts.elementIds.map(i => i.v), facts.elementsMissingIds), 'The facts match the input')
+  const doc = new DOMParser().parseFromString(input)
+  fixDocument(doc)
+  expect(serialize(new DOMParser().parseFromString(spliced))).toEqual(serialize(doc))
+  return spliced
+}
 
 describe('Element ID creation', () => {
   describe('fixDocument', () => {
@@ -19,6 +34,7 @@ describe('Element ID creation', () => {
               <para>no id here</para>
             </content>
           </document>`
+      expectSpliceToMatch(simple)
       const doc = new DOMParser().parseFromString(simple)
       fixDocument(doc)
       const out = new XMLSerializer().serializeToString(doc)
@@ -43,6 +59,7 @@ describe('Element ID creation', () => {
               </section>
             </content>
           </document>`
+      expectSpliceToMatch(paraPartialId)
       const doc = new DOMParser().parseFromString(paraPartialId)
       fixDocument(doc)
       const NS_CNXML = 'http://cnx.rice.edu/cnxml'
@@ -85,6 +102,7 @@ describe('Element ID creation', () => {
               <cite/>
             </content>
           </document>`
+      expectSpliceToMatch(xml)
       const doc = new DOMParser().parseFromString(xml)
       fixDocument(doc)
       const out = new XMLSerializer().serializeToString(doc)
@@ -108,6 +126,7 @@ describe('Element ID creation', () => {
               </para>
             </content>
           </document>`
+      expectSpliceToMatch(xml)
       const doc = new DOMParser().parseFromString(xml)
       fixDocument(doc)
       const out = new XMLSerializer().serializeToString(doc)
@@ -123,6 +142,29 @@ describe('Element ID creation', () => {
       assert.strictEqual(padLeft('9999', '0', 5), '09999')
     })
   })
+  describe('spliceIds', () => {
+    const page = (content: string) => `<document xmlns="http://cnx.rice.edu/cnxml">
+  <metadata xmlns:md="http://cnx.rice.edu/mdml"><md:uuid>00000000-0000-4000-0000-000000000000</md:uuid></metadata>
+  <content>${content}</content>
+</document>`
+    it('only changes the start tags that need an id', () => {
+      const input = page(`<!-- <para> in a comment -->
+    <para class='x'   >a &amp; b</para><para
+      class="y"/><note id="note-00001"/>\r\n<note /><para id="para-00001"/>`)
+      const spliced = expectSpliceToMatch(input)
+      expect(spliced).toBe(input
+        .replace("<para class='x'   >", "<para class='x' id=\"para-00002\"   >")
+        .replace('class="y"/>', 'class="y" id="para-00003"/>')
+        .replace('<note />', '<note id="note-00002" />'))
+    })
+    it('gives up when the facts are not for this content', () => {
+      const before = page('<para>one</para>')
+      const facts = expectValue(scanPageFacts(before), 'The scanner should handle the test documents')
+      expect(spliceIds(before.replace('<para>', '<para id="p1">'), [], facts.elementsMissingIds)).toBeUndefined()
+      expect(spliceIds(before.replace('<content>', '<content>\n'), [], facts.elementsMissingIds)).toBeUndefined()
+      expect(spliceIds(before, [], [{ start: { line: 99, character: 0 }, end: { line: 99, character: 1 } }])).toBeUndefined()
+    })
+  })
   describe('fixModule', () => {
     beforeEach(() => {
       mockfs({
@@ -1,6 +1,6 @@
 import { DOMParser, XMLSerializer } from 'xmldom'
 import { ELEMENTS_MISSING_IDS_SEL, ELEMENT_TO_PREFIX } from './model/page'
-import { expectValue, select } from './model/utils'
+import { expectValue, type Opt, type Range, select } from './model/utils'
 
 const ID_PADDING_CHARS = 5
 
@@ -17,21 +17,89 @@ function buildId(tag: string, counter: number): string {
   return `${prefix}-${padLeft(String(counter), '0', ID_PADDING_CHARS)}`
 }
 
-export function fixDocument(doc: Document): void {
-  const elsWithIds = select('//cnxml:*[@id]', doc) as Element[]
-  const ids = new Set(elsWithIds.map(el => el.getAttribute('id')))
-  const els = select(ELEMENTS_MISSING_IDS_SEL, doc) as Element[]
+// Hands out new ids in the order fixDocument always has: for each tag, the
+// first free counter after the last one it handed out
+function idAllocator(taken: Iterable<string>) {
+  const ids = new Set(taken)
   const cacheHighId: Record<string, number> = {}
-  for (const el of els) {
-    const tag = el.tagName.toLowerCase()
+  return (tag: string) => {
     let counter = cacheHighId[tag] > 0 ? cacheHighId[tag] + 1 : 1
     while (ids.has(buildId(tag, counter))) {
       counter++
     }
-    ids.add(buildId(tag, counter)) // avoid reusage of new generated id
+    const id = buildId(tag, counter)
+    ids.add(id) // avoid reusage of new generated id
     cacheHighId[tag] = counter // cache new highest counter
-    el.setAttribute('id', buildId(tag, counter))
+    return id
+  }
+}
+
+export function fixDocument(doc: Document): void {
+  const elsWithIds = select('//cnxml:*[@id]', doc) as Element[]
+  const nextId = idAllocator(elsWithIds.map(el => el.getAttribute('id') as string))
+  const els = select(ELEMENTS_MISSING_IDS_SEL, doc) as Element[]
+  for (const el of els) {
+    el.setAttribute('id', nextId(el.tagName.toLowerCase()))
+  }
+}
+
+const NAME_RE = /[A-Za-z_][\w.:-]*/y
+// An attribute, or the end of the start tag (with the whitespace before it)
+const ATTR_OR_END_RE = /\s*(?:([A-Za-z_][\w.:-]*)\s*=\s*(?:"[^"]*"|'[^']*')|(\/?>))/y
+const NEWLINE_RE = /\r\n?|\n/g
+// xmldom starts a new line on these too (see model/page-scanner.ts)
+const ODD_LINE_BREAKS_RE = /[\u2028\u2029]/
+
+function compareRanges(a: Range, b: Range) {
+  return a.start.line !== b.start.line ? a.start.line - b.start.line : a.start.character - b.start.character
+}
+
+// Where the id attribute goes in the start tag at `offset`: after its last
+// attribute, which is where setAttribute puts it. Undefined when there is no
+// start tag of an element that needs an id there.
+function insertionPoint(input: string, offset: number): Opt<{ tag: string, at: number }> {
+  if (input[offset] !== '<') return undefined
+  NAME_RE.lastIndex = offset + 1
+  const name = NAME_RE.exec(input)
+  if (name === null) return undefined
+  const tag = name[0].toLowerCase()
+  if (!ELEMENT_TO_PREFIX.has(tag)) return undefined
+  let at = NAME_RE.lastIndex
+  for (;;) {
+    ATTR_OR_END_RE.lastIndex = at
+    const m = ATTR_OR_END_RE.exec(input)
+    if (m === null || m[1] === 'id') return undefined
+    if (m[2] !== undefined) return { tag, at }
+    at = ATTR_OR_END_RE.lastIndex
+  }
+}
+
+// Adds the same ids as fixDocument but without a DOM: `ids` and `missing` are
+// the PageFacts of `input` (elementIds and elementsMissingIds) and each new id
+// is spliced into the text of its start tag. The rest of the file is left
+// exactly as it was. Undefined when the facts do not match `input`.
+export function spliceIds(input: string, ids: Iterable<string>, missing: Range[]): Opt<string> {
+  if (ODD_LINE_BREAKS_RE.test(input)) return undefined
+  const nextId = idAllocator(ids)
+  const newline = new RegExp(NEWLINE_RE)
+  let line = 0
+  let lineStart = 0
+  const parts: string[] = []
+  let copied = 0
+  for (const { start } of [...missing].sort(compareRanges)) {
+    while (line < start.line) {
+      const m = newline.exec(input)
+      if (m === null) return undefined
+      lineStart = m.index + m[0].length
+      line++
+    }
+    const point = insertionPoint(input, lineStart + start.character)
+    if (point === undefined) return undefined
+    parts.push(input.slice(copied, point.at), ` id="${nextId(point.tag)}"`)
+    copied = point.at
   }
+  parts.push(input.slice(copied))
+  return parts.join('')
 }
 
 export function idFixer(input: string, absPath: string) {
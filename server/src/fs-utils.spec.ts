@@ -1,7 +1,7 @@
 import { expect, beforeEach, jest } from '@jest/globals'
-import { type Dirent, type Walker, followSymbolicLinks, walkDir, adaptFSDirent, isDirectorySync, isFileSync } from './fs-utils'
+import { type Dirent, type Walker, followSymbolicLinks, walkDir, adaptFSDirent, isDirectorySync, isFileSync, findFiles, readdirAsync, readdirSync, walkDirAsync } from './fs-utils'
 import { expectValue } from './model/utils'
-import { type Dirent as FSDirent } from 'fs'
+import fs, { type Dirent as FSDirent } from 'fs'
 import SinonRoot from 'sinon'
 import { Substitute } from '@fluffy-spoon/substitute'
 import path from 'path'
@@ -189,4 +189,73 @@ describe('FS Utils', () => {
       expect(isDirectorySync('not-existing-dir')).toBe(false)
     })
   })
+  describe('async directory reads', () => {
+    beforeEach(() => {
+      mockfs({
+        root: {
+          'a.txt': '',
+          '.hidden.txt': '',
+          dir1: {
+            'b.txt': '',
+            'c.cnxml': '',
+            // Points back at root
+            up: mockfs.symlink({ path: '..' }),
+            'broken.txt': mockfs.symlink({ path: 'nowhere' })
+          },
+          dir2: Object.fromEntries(Array.from({ length: 10 }, (_, i) => [`${i}.txt`, '']))
+        }
+      })
+    })
+    afterEach(() => {
+      mockfs.restore()
+    })
+    const collect = async <T>(batches: AsyncIterable<T[]>) => {
+      const all: T[][] = []
+      for await (const batch of batches) all.push(batch)
+      return all
+    }
+    const start = () => ({ path: 'root', realpath: fs.realpathSync('root') })
+    const onError = (err: Error) => { throw err }
+
+    it('readdirAsync reads a directory in batches', async () => {
+      const batches = await collect(readdirAsync({ path: 'root/dir2', realpath: fs.realpathSync('root/dir2') }, 4))
+      expect(batches.map(b => b.length)).toEqual([4, 4, 2])
+      const [first] = batches[0]
+      expect(first.isFile()).toBe(true)
+      expect(first.realpath).toBe(path.join(fs.realpathSync('root/dir2'), first.name))
+    })
+    it('walkDirAsync finds the same entries as walkDir and does not loop on symbolic links', async () => {
+      const walker = { readdir: async function * (dir: Pick<Dirent, 'path' | 'realpath'>) { yield * readdirAsync(dir, 2) }, shouldWalk: followSymbolicLinks(), onError }
+      const asyncEntries = (await collect(walkDirAsync(walker, start()))).flat()
+      const syncEntries = Array.from(walkDir({ readdir: readdirSync, shouldWalk: followSymbolicLinks(), onError }, 'root'))
+      // realpath throws on broken links in walkDir, only directories need it
+      const summary = (d: Dirent) => ({ path: d.path, realpath: d.isDirectory() ? d.realpath : undefined, isDirectory: d.isDirectory(), isFile: d.isFile(), isSymbolicLink: d.isSymbolicLink() })
+      const byPath = (a: { path: string }, b: { path: string }) => a.path < b.path ? -1 : 1
+      expect(asyncEntries.map(summary).sort(byPath)).toEqual(syncEntries.map(summary).sort(byPath))
+      expect(asyncEntries.find(d => d.name === 'up')?.isDirectory()).toBe(true)
+      expect(asyncEntries.find(d => d.name === 'broken.txt')?.isFile()).toBe(false)
+    })
+    it('walkDirAsync stops once it is cancelled', async () => {
+      const token = { isCancellationRequested: false }
+      const walker = { readdir: async function * (dir: Pick<Dirent, 'path' | 'realpath'>) { yield * readdirAsync(dir, 1) }, shouldWalk: followSymbolicLinks(), onError }
+      let seen = 0
+      for await (const batch of walkDirAsync(walker, start(), token)) {
+        seen += batch.length
+        token.isCancellationRequested = true
+      }
+      expect(seen).toBe(1)
+    })
+    it('walkDirAsync reports directories it cannot read', async () => {
+      const errors: Error[] = []
+      const walker = { readdir: readdirAsync, shouldWalk: followSymbolicLinks(), onError: (err: Error) => { errors.push(err) } }
+      expect(await collect(walkDirAsync(walker, { path: 'does-not-exist', realpath: 'does-not-exist' }))).toEqual([])
+      expect(errors.length).toBe(1)
+    })
+    it('findFiles matches one predicate per level like a glob', async () => {
+      const visible = (name: string) => !name.startsWith('.')
+      expect((await collect(findFiles('root', [visible, n => n.endsWith('.cnxml')]))).flat()).toEqual([path.join('root', 'dir1', 'c.cnxml')])
+      expect((await collect(findFiles('root', [n => visible(n) && n.endsWith('.txt')]))).flat()).toEqual([path.join('root', 'a.txt')])
+      expect(await collect(findFiles('does-not-exist', [visible]))).toEqual([])
+    })
+  })
 })
@@ -20,6 +20,17 @@ export interface Walker {
   readonly onError: (err: Error) => void
 }
 
+export interface AsyncWalker {
+  readonly readdir: (dir: Pick<Dirent, 'path' | 'realpath'>) => AsyncIterable<Dirent[]>
+  readonly shouldWalk: (dirent: Dirent) => boolean
+  readonly onError: (err: Error) => void
+}
+
+// A vscode CancellationToken fits here
+export interface Cancellable {
+  readonly isCancellationRequested: boolean
+}
+
 export const followSymbolicLinks = () => {
   let visited = I.Set()
   return (dirent: Dirent) => {
@@ -55,6 +66,72 @@ export function * walkDir(
   }
 }
 
+// Like walkDir but yields the entries of each directory in batches, as they
+// are read. Stops before the next batch once `token` is cancelled.
+export async function * walkDirAsync(
+  walker: AsyncWalker,
+  start: Pick<Dirent, 'path' | 'realpath'>,
+  token?: Cancellable
+): AsyncGenerator<Dirent[], void, unknown> {
+  const toVisit = [start]
+  let next: Pick<Dirent, 'path' | 'realpath'> | undefined
+  while ((next = toVisit.shift()) !== undefined) {
+    try {
+      for await (const entries of walker.readdir(next)) {
+        if (token?.isCancellationRequested === true) return
+        for (const entry of entries) {
+          if (walker.shouldWalk(entry)) {
+            toVisit.push(entry)
+          }
+        }
+        yield entries
+      }
+    } catch (e) {
+      walker.onError(e as Error)
+    }
+  }
+}
+
+// The files below `start` whose path matches `levels`, one predicate per
+// directory level and the last one for the file names (like the glob
+// `start/*/*.cnxml`). A directory that cannot be read has no files.
+export async function * findFiles(
+  start: string,
+  levels: Array<(name: string) => boolean>,
+  token?: Cancellable
+): AsyncGenerator<string[], void, unknown> {
+  let realpath: string
+  try {
+    realpath = await fs.promises.realpath(start)
+  } catch {
+    return
+  }
+  yield * findIn({ path: start, realpath }, levels, token)
+}
+
+async function * findIn(
+  dir: Pick<Dirent, 'path' | 'realpath'>,
+  levels: Array<(name: string) => boolean>,
+  token?: Cancellable
+): AsyncGenerator<string[], void, unknown> {
+  const [matches, ...rest] = levels
+  try {
+    for await (const entries of readdirAsync(dir)) {
+      if (token?.isCancellationRequested === true) return
+      if (rest.length === 0) {
+        const files = entries.filter(e => matches(e.name) && e.isFile()).map(e => e.path)
+        if (files.length > 0) yield files
+      } else {
+        for (const e of entries) {
+          if (matches(e.name) && e.isDirectory()) yield * findIn(e, rest, token)
+        }
+      }
+    }
+  } catch {
+    // Skipped, like a glob does
+  }
+}
+
 // Most implementations of dirent use d_type which ORs together types like
 // dt_type = DT_DIR | DT_LNK and then isDirectory() would return
 // (dt_type & DT_DIR) == DT_DIR
@@ -85,6 +162,57 @@ export const readdirSync = (wd: string) => {
     .map((dirent) => adaptFSDirent(wd, fs.realpathSync, dirent))
 }
 
+// Like readdirSync but reads `batchSize` entries at a time and never blocks
+// the event loop. Only symbolic links need to be looked at again (to know
+// what they point to), the real path of the rest is `dir.realpath` + name.
+export async function * readdirAsync(dir: Pick<Dirent, 'path' | 'realpath'>, batchSize = 256): AsyncGenerator<Dirent[], void, unknown> {
+  const handle = await fs.promises.opendir(dir.path, { bufferSize: batchSize })
+  let entries: Dirent[] = []
+  // Closes the directory when this finishes, throws or is returned from
+  for await (const dirent of handle) {
+    entries.push(dirent.isSymbolicLink()
+      ? await adaptSymbolicLink(dir.path, dirent)
+      : adaptPlainDirent(dir, dirent))
+    if (entries.length >= batchSize) {
+      yield entries
+      entries = []
+    }
+  }
+  if (entries.length > 0) yield entries
+}
+
+const adaptPlainDirent = (dir: Pick<Dirent, 'path' | 'realpath'>, dirent: fs.Dirent): Dirent => {
+  const isDirectory = dirent.isDirectory()
+  const isFile = dirent.isFile()
+  return {
+    name: dirent.name,
+    path: path.join(dir.path, dirent.name),
+    realpath: path.join(dir.realpath, dirent.name),
+    isDirectory: () => isDirectory,
+    isFile: () => isFile,
+    isSymbolicLink: () => false
+  }
+}
+
+const adaptSymbolicLink = async (wd: string, dirent: fs.Dirent): Promise<Dirent> => {
+  const p = path.join(wd, dirent.name)
+  // A link that points nowhere is neither a file nor a directory
+  const [realpath, stat] = await Promise.all([
+    fs.promises.realpath(p).catch(() => p),
+    fs.promises.stat(p).catch(() => undefined)
+  ])
+  const isDirectory = stat?.isDirectory() ?? false
+  const isFile = stat?.isFile() ?? false
+  return {
+    name: dirent.name,
+    path: p,
+    realpath,
+    isDirectory: () => isDirectory,
+    isFile: () => isFile,
+    isSymbolicLink: () => true
+  }
+}
+
 export const isDirectorySync = (p: string) => {
   try {
     const stat = fs.statSync(p)
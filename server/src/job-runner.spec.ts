@@ -1,45 +1,133 @@
 import { expect } from '@jest/globals'
-import { JobRunner, type URIPair } from './job-runner'
+import { JobPriority, JobRunner, type URIPair } from './job-runner'
 
 JobRunner.debug = () => {} // Turn off logging
 
 describe('Job Runner', () => {
   const context: URIPair = { workspace: 'aaa', doc: 'bbb' }
+  // Jobs with the same type and context get coalesced so give each one its own context
+  const ctx = (doc: string): URIPair => ({ workspace: 'aaa', doc })
   let jobRunner = new JobRunner()
   beforeEach(() => {
     jobRunner = new JobRunner()
   })
   it('runs newly added jobs first (stack)', async () => {
     const appendLog: string[] = []
-    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Job1') })
-    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Job2') })
-    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Job3') })
-    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Job4') })
-    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Job5') })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Job1'), fn: () => appendLog.push('Job1') })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Job2'), fn: () => appendLog.push('Job2') })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Job3'), fn: () => appendLog.push('Job3') })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Job4'), fn: () => appendLog.push('Job4') })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Job5'), fn: () => appendLog.push('Job5') })
     expect(appendLog).toEqual([]) // Nothing immediately executes (otherwise jobs would keep restacking themselves)
     await jobRunner.done()
     expect(appendLog).toEqual(['Job5', 'Job4', 'Job3', 'Job2', 'Job1'])
   })
   it('prioritizes fast jobs', async () => {
     const appendLog: string[] = []
-    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Initial') })
-    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Fast1') })
-    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Slow1'), slow: true })
-    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Fast2') })
-    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Slow2'), slow: true })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Initial'), fn: () => appendLog.push('Initial') })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Fast1'), fn: () => appendLog.push('Fast1') })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Slow1'), fn: () => appendLog.push('Slow1'), slow: true })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Fast2'), fn: () => appendLog.push('Fast2') })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Slow2'), fn: () => appendLog.push('Slow2'), slow: true })
     expect(appendLog).toEqual([])
     await jobRunner.done()
     expect(appendLog).toEqual(['Fast2', 'Fast1', 'Initial', 'Slow2', 'Slow1'])
   })
+  it('runs jobs in priority order', async () => {
+    const appendLog: string[] = []
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Background'), fn: () => appendLog.push('Background'), priority: JobPriority.BACKGROUND })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Dependency'), fn: () => appendLog.push('Dependency'), priority: JobPriority.DEPENDENCY })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Interactive'), fn: () => appendLog.push('Interactive'), priority: JobPriority.INTERACTIVE })
+    await jobRunner.done()
+    expect(appendLog).toEqual(['Interactive', 'Dependency', 'Background'])
+  })
+  it('lets interactive jobs preempt a batch of background jobs', async () => {
+    const appendLog: string[] = []
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Slow1'), fn: () => appendLog.push('Slow1'), slow: true })
+    jobRunner.enqueue({
+      type: 'testcheck',
+      context: ctx('Slow2'),
+      slow: true,
+      fn: () => {
+        appendLog.push('Slow2')
+        jobRunner.enqueue({ type: 'testcheck', context: ctx('Fast1'), fn: () => appendLog.push('Fast1'), priority: JobPriority.INTERACTIVE })
+      }
+    })
+    await jobRunner.done()
+    expect(appendLog).toEqual(['Slow2', 'Fast1', 'Slow1'])
+  })
+  it('runs parallel jobs concurrently but never more than the limit', async () => {
+    jobRunner = new JobRunner(3)
+    let inFlight = 0
+    let maxInFlight = 0
+    const fn = async () => {
+      inFlight++
+      maxInFlight = Math.max(maxInFlight, inFlight)
+      await new Promise(resolve => setTimeout(resolve, 5))
+      inFlight--
+    }
+    for (let i = 0; i < 10; i++) {
+      jobRunner.enqueue({ type: 'testcheck', context: ctx(`Job${i}`), fn, parallel: true })
+    }
+    await jobRunner.done()
+    expect(inFlight).toBe(0)
+    expect(maxInFlight).toBe(3)
+  })
+  it('waits for parallel jobs to finish before running a non-parallel job', async () => {
+    const appendLog: string[] = []
+    const delayed = (msg: string, ms: number) => async () => {
+      await new Promise(resolve => setTimeout(resolve, ms))
+      appendLog.push(msg)
+    }
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Barrier'), fn: () => appendLog.push('Barrier') })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Load1'), fn: delayed('Load1', 10), parallel: true })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Load2'), fn: delayed('Load2', 1), parallel: true })
+    await jobRunner.done()
+    expect(appendLog).toEqual(['Load2', 'Load1', 'Barrier'])
+  })
+  it('coalesces pending jobs with the same type and context', async () => {
+    const appendLog: string[] = []
+    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Old') })
+    jobRunner.enqueue({ type: 'othercheck', context, fn: () => appendLog.push('Other') })
+    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('New') })
+    await jobRunner.done()
+    // The newest duplicate replaces the pending one and moves to the top of the stack
+    expect(appendLog).toEqual(['New', 'Other'])
+    expect(jobRunner.counters).toEqual({ enqueued: 3, coalesced: 1, executed: 2 })
+  })
+  it('keeps the more urgent priority when coalescing', async () => {
+    const appendLog: string[] = []
+    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Dup'), priority: JobPriority.INTERACTIVE })
+    jobRunner.enqueue({ type: 'testcheck', context: ctx('Dependency'), fn: () => appendLog.push('Dependency'), priority: JobPriority.DEPENDENCY })
+    jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Dup'), slow: true })
+    await jobRunner.done()
+    expect(appendLog).toEqual(['Dup', 'Dependency'])
+  })
+  it('does not coalesce with a job that is already running', async () => {
+    const appendLog: string[] = []
+    jobRunner.enqueue({
+      type: 'testcheck',
+      context,
+      fn: () => {
+        appendLog.push('First')
+        if (appendLog.length === 1) {
+          jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Again') })
+        }
+      }
+    })
+    await jobRunner.done()
+    expect(appendLog).toEqual(['First', 'Again'])
+    expect(jobRunner.counters.coalesced).toBe(0)
+  })
   it('done() waits even when there are no jobs running', async () => {
     await jobRunner.done()
   })
   it('continues jobs when one throws an error', async () => {
     const appendLog: string[] = []
     await expect(async () => {
-      jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Initial') })
-      jobRunner.enqueue({ type: 'testcheck', context, fn: () => { throw new Error('intentional_error') } })
-      jobRunner.enqueue({ type: 'testcheck', context, fn: () => appendLog.push('Fast1') })
+      jobRunner.enqueue({ type: 'testcheck', context: ctx('Initial'), fn: () => appendLog.push('Initial') })
+      jobRunner.enqueue({ type: 'testcheck', context: ctx('Error'), fn: () => { throw new Error('intentional_error') } })
+      jobRunner.enqueue({ type: 'testcheck', context: ctx('Fast1'), fn: () => appendLog.push('Fast1') })
       expect(appendLog).toEqual([])
       await jobRunner.done()
     }).rejects.toThrow('intentional_error')
@@ -3,68 +3,156 @@ import { Fileish } from './model/fileish'
 import { expectValue, type Opt, profileAsync } from './model/utils'
 
 export interface URIPair { workspace: string, doc: string }
+
+// Lower numbers run first. Within a priority level jobs run as a stack (newest first)
+export enum JobPriority {
+  INTERACTIVE = 0, // The user is waiting on these (opening a file, editing the ToC)
+  DEPENDENCY = 1, // Loading files that some other job needs before it can finish
+  BACKGROUND = 2 // Initial load and validation of the whole bundle
+}
+
 export interface Job {
   type: string
   context: Fileish | URIPair
   fn: () => Promise<any> | any
-  slow?: boolean
+  slow?: boolean // Shorthand for `priority: JobPriority.BACKGROUND`
+  priority?: JobPriority
+  // Parallel jobs only do I/O (e.g. read a file and load it) so several of them
+  // may run at the same time. Every other job waits for the running jobs to
+  // finish and runs by itself.
+  parallel?: boolean
+}
+
+const PRIORITIES = [JobPriority.INTERACTIVE, JobPriority.DEPENDENCY, JobPriority.BACKGROUND]
+
+// Jobs with the same key are duplicates of each other. Only the newest one is kept
+interface PendingJob { key: string, job: Job, priority: JobPriority }
+
+export interface JobCounters {
+  enqueued: number // Every call to enqueue()
+  coalesced: number // Calls to enqueue() that replaced a job which was still pending
+  executed: number // Jobs that actually ran
 }
 
 export class JobRunner {
+  public static DEFAULT_CONCURRENCY = 8
+
   private _currentPromise: Opt<Promise<void>>
-  private readonly fastStack: Job[] = []
-  private readonly slowStack: Job[] = []
+  private _resolve: () => void = () => {}
+  private _reject: (err: any) => void = () => {}
+  private readonly stacks: PendingJob[][] = PRIORITIES.map(() => [])
+  private readonly pending = new Map<string, PendingJob>()
+  private readonly running = new Set<Job>()
+  private readonly _counters: JobCounters = { enqueued: 0, coalesced: 0, executed: 0 }
+
+  constructor(private readonly concurrency = JobRunner.DEFAULT_CONCURRENCY) {
+    /* istanbul ignore if */
+    if (concurrency < 1) {
+      throw new Error(`BUG: JobRunner needs at least one worker but was given ${concurrency}`)
+    }
+  }
 
   public static debug = console.debug
   public enqueue(job: Job) {
-    job.slow === true ? this.slowStack.push(job) : this.fastStack.push(job)
+    const key = `${job.type}\0${contextKey(job.context)}`
+    const existing = this.pending.get(key)
+    // Coalesce with the pending duplicate: the newer job replaces it and moves
+    // to the top of the stack (so anything it depends on still runs after it is
+    // re-enqueued) while keeping the more urgent of the two priorities.
+    const priority = existing === undefined ? priorityOf(job) : Math.min(existing.priority, priorityOf(job))
+    const p: PendingJob = { key, job, priority }
+    this._counters.enqueued++
+    if (existing !== undefined) this._counters.coalesced++
+    this.pending.set(key, p)
+    this.stacks[priority].push(p)
     this.process()
   }
 
+  public get counters(): JobCounters { return { ...this._counters } }
+
   public async done(): Promise<any> { this._currentPromise === undefined ? await Promise.resolve() : await this._currentPromise }
 
   private length() {
-    return this.fastStack.length + this.slowStack.length
+    return this.pending.size
+  }
+
+  private isStale(p: PendingJob) {
+    return this.pending.get(p.key) !== p
   }
 
-  private pop(): Opt<Job> {
-    return this.fastStack.pop() ?? this.slowStack.pop()
+  private peek(): Opt<PendingJob> {
+    for (const stack of this.stacks) {
+      // Drop the entries that were replaced by a newer duplicate
+      while (stack.length > 0 && this.isStale(stack[stack.length - 1])) {
+        stack.pop()
+      }
+      if (stack.length > 0) return stack[stack.length - 1]
+    }
+  }
+
+  private canStart(job: Job) {
+    if (this.running.size === 0) return true
+    if (this.running.size >= this.concurrency) return false
+    if (job.parallel !== true) return false
+    for (const r of this.running) {
+      if (r.parallel !== true) return false
+    }
+    return true
   }
 
   private process() {
-    if (this._currentPromise !== undefined) return // job is running
+    if (this._currentPromise !== undefined) return // jobs are running
     this._currentPromise = new Promise((resolve, reject) => {
-      setImmediate(() => {
-        this.tickWithCb(resolve, err => {
-          JobRunner.debug(err)
-          this._currentPromise = undefined
-          reject(err)
-          this.process()
-        })
-      })
+      this._resolve = () => { resolve() }
+      this._reject = reject
+      setImmediate(() => { this.fill() })
     })
   }
 
-  // In order to support `await this.done()` keep daisy-chaining the ticks
-  private tickWithCb(resolve: () => void, reject: (err: any) => void) {
-    const current = this.pop()
-    if (current !== undefined) {
-      this.tick(current).then(() => { this.tickWithCb(resolve, reject) }, reject)
-    } else {
-      resolve()
+  // Start as many jobs as we are allowed to. Since the highest priority job is
+  // re-checked every time a job finishes, newly enqueued interactive jobs
+  // preempt the remainder of a slow batch.
+  //
+  // In order to support `await this.done()` the promise only resolves once
+  // nothing is pending and nothing is running.
+  private fill() {
+    let next: Opt<PendingJob>
+    while ((next = this.peek()) !== undefined && this.canStart(next.job)) {
+      this.stacks[next.priority].pop()
+      this.pending.delete(next.key)
+      this.start(next.job)
+    }
+    if (this.running.size === 0 && this.length() === 0 && this._currentPromise !== undefined) {
       this._currentPromise = undefined
+      this._resolve()
     }
   }
 
+  private start(job: Job) {
+    this.running.add(job)
+    this._counters.executed++
+    this.tick(job).then(() => {
+      this.running.delete(job)
+      this.fill()
+    }, err => {
+      this.running.delete(job)
+      JobRunner.debug(err)
+      const reject = this._reject
+      this._currentPromise = undefined
+      reject(err)
+      this.process()
+    })
+  }
+
   private async tick(current: Job) {
     const [ms] = await profileAsync(async () => {
       const c = expectValue(current, 'BUG: nothing should have changed in this time')
-      JobRunner.debug('[JOB_RUNNER] Starting job', c.type, this.toString(c.context), c.slow === true ? '(slow)' : '(fast)')
+      JobRunner.debug('[JOB_RUNNER] Starting job', c.type, this.toString(c.context), `(priority ${priorityOf(c)})`)
       await c.fn()
     })
     JobRunner.debug('[JOB_RUNNER] Finished job', current.type, this.toString(current.context), 'took', ms, 'ms')
     if (this.length() === 0) {
-      JobRunner.debug('[JOB_RUNNER] No more pending jobs. Taking a nap.')
+      JobRunner.debug('[JOB_RUNNER] No more pending jobs. Taking a nap.', this._counters)
     } else {
       JobRunner.debug('[JOB_RUNNER] Remaining jobs', this.length())
     }
@@ -74,3 +162,11 @@ export class JobRunner {
     if (nodeOrString instanceof Fileish) { return nodeOrString.workspacePath } else return path.relative(nodeOrString.workspace, nodeOrString.doc)
   }
 }
+
+function contextKey(context: Fileish | URIPair) {
+  return context instanceof Fileish ? context.absPath : `${context.workspace}\0${context.doc}`
+}
+
+function priorityOf(job: Job) {
+  return job.priority ?? (job.slow === true ? JobPriority.BACKGROUND : JobPriority.INTERACTIVE)
+}
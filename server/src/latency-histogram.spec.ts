@@ -0,0 +1,27 @@
+import { expect } from '@jest/globals'
+import { LatencyHistogram } from './latency-histogram'
+
+describe('LatencyHistogram', () => {
+  it('counts durations in buckets that double in size', () => {
+    const h = new LatencyHistogram()
+    expect(h.percentile(50)).toBe(0)
+    ;[0.2, 0.5, 1, 3, 3.5, 100].forEach(ms => { h.record(ms) })
+    expect(h.count).toBe(6)
+    expect(h.totalMs).toBeCloseTo(108.2)
+    expect(h.percentile(0)).toBe(1)
+    expect(h.percentile(50)).toBe(2)
+    expect(h.percentile(80)).toBe(4)
+    expect(h.percentile(99)).toBe(128)
+    expect(h.toString().split('\n')).toEqual([
+      '6 samples, p50 < 2 ms, p90 < 128 ms, p99 < 128 ms',
+      '  <      1 ms      2 ##############',
+      '  <      2 ms      1 #######',
+      '  <      4 ms      2 ##############',
+      '  <      8 ms      0 ',
+      '  <     16 ms      0 ',
+      '  <     32 ms      0 ',
+      '  <     64 ms      0 ',
+      '  <    128 ms      1 #######'
+    ])
+  })
+})
@@ -0,0 +1,36 @@
+// Counts durations in buckets that double in size (under 1 ms, under 2 ms,
+// under 4 ms, ...) so the spread of a latency can be logged without keeping
+// every sample.
+export class LatencyHistogram {
+  private readonly counts: number[] = []
+  private _count = 0
+  private _totalMs = 0
+
+  public get count() { return this._count }
+  public get totalMs() { return this._totalMs }
+
+  public record(ms: number) {
+    const bucket = ms < 1 ? 0 : Math.floor(Math.log2(ms)) + 1
+    while (this.counts.length <= bucket) this.counts.push(0)
+    this.counts[bucket]++
+    this._count++
+    this._totalMs += ms
+  }
+
+  // The upper bound of the bucket that the p-th percentile (0-100) is in
+  public percentile(p: number) {
+    const rank = Math.max(1, Math.ceil(this._count * p / 100))
+    let seen = 0
+    for (let i = 0; i < this.counts.length; i++) {
+      seen += this.counts[i]
+      if (seen >= rank) return 2 ** i
+    }
+    return 0
+  }
+
+  public toString() {
+    const summary = `${this._count} samples, p50 < ${this.percentile(50)} ms, p90 < ${this.percentile(90)} ms, p99 < ${this.percentile(99)} ms`
+    const rows = this.counts.map((n, i) => `  < ${String(2 ** i).padStart(6)} ms ${String(n).padStart(6)} ${'#'.repeat(Math.ceil(40 * n / this._count))}`)
+    return [summary, ...rows].join('\n')
+  }
+}
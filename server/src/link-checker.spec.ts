@@ -0,0 +1,148 @@
+import { expect } from '@jest/globals'
+import fs from 'fs'
+import http from 'http'
+import os from 'os'
+import path from 'path'
+import { type AddressInfo } from 'net'
+import { findLinkProblem, isCheckableUrl, LinkChecker, type LinkCheckerOptions } from './link-checker'
+
+// A local stand-in for the websites that pages link to
+type Route = (req: http.IncomingMessage, res: http.ServerResponse) => void
+const routes = new Map<string, Route>()
+const hits = new Map<string, number>()
+let inFlight = 0
+let maxInFlight = 0
+let server: http.Server
+let base: string
+
+const status = (code: number, location?: string): Route => (_req, res) => {
+  res.writeHead(code, location === undefined ? {} : { Location: location })
+  res.end()
+}
+
+beforeAll(async () => {
+  server = http.createServer((req, res) => {
+    const url = req.url ?? ''
+    hits.set(url, (hits.get(url) ?? 0) + 1)
+    inFlight++
+    maxInFlight = Math.max(maxInFlight, inFlight)
+    res.on('finish', () => { inFlight-- })
+    const route = routes.get(url) ?? status(404)
+    // Respond a little later so concurrent requests overlap
+    setTimeout(() => { route(req, res) }, 5)
+  })
+  await new Promise<void>(resolve => { server.listen(0, '127.0.0.1', resolve) })
+  base = `http://127.0.0.1:${(server.address() as AddressInfo).port}`
+})
+afterAll(async () => {
+  // fetch keeps connections alive
+  server.closeAllConnections()
+  await new Promise(resolve => server.close(resolve))
+})
+beforeEach(() => {
+  routes.clear()
+  hits.clear()
+  maxInFlight = 0
+})
+
+const makeChecker = (options: Partial<LinkCheckerOptions> = {}) => new LinkChecker({ perHostIntervalMs: 0, retryDelayMs: 1, ...options })
+
+describe('LinkChecker', () => {
+  it('reports links in the same format as before', async () => {
+    routes.set('/ok', status(200))
+    routes.set('/moved', status(301, '/ok'))
+    routes.set('/moved-twice', status(302, '/moved'))
+    routes.set('/moved-to-404', status(301, '/gone'))
+    const checker = makeChecker()
+    expect(await findLinkProblem(checker, `${base}/ok`)).toBeUndefined()
+    expect(await findLinkProblem(checker, `${base}/moved`)).toBeUndefined()
+    expect(await findLinkProblem(checker, `${base}/gone`)).toEqual({ code: 404, toUrl: '', secondToUrl: '', isError: true })
+    expect(await findLinkProblem(checker, `${base}/moved-to-404`)).toEqual({ code: 404, toUrl: `${base}/gone`, secondToUrl: '', isError: true })
+    expect(await findLinkProblem(checker, `${base}/moved-twice`)).toEqual({ code: 'double_redirect', toUrl: `${base}/moved`, secondToUrl: `${base}/ok`, isError: true })
+    expect(await findLinkProblem(checker, 'not a url')).toEqual({ code: 'parse', toUrl: '', secondToUrl: '', isError: true })
+    expect(isCheckableUrl('#ost/api/ex/1234')).toBe(false)
+    expect(isCheckableUrl(`${base}/ok`)).toBe(true)
+  })
+  it('follows every hop of a redirect chain and stops at maxRedirects', async () => {
+    routes.set('/a', status(301, '/b'))
+    routes.set('/b', status(301, `${base}/c`))
+    routes.set('/c', status(200))
+    routes.set('/loop', status(301, '/loop'))
+    const checker = makeChecker({ maxRedirects: 3 })
+    expect(await checker.check(`${base}/a`)).toMatchObject({ status: 200, redirects: [`${base}/b`, `${base}/c`] })
+    expect(await checker.check(`${base}/loop`)).toMatchObject({ status: 301, redirects: [`${base}/loop`, `${base}/loop`, `${base}/loop`] })
+  })
+  it('requests each URL once even when many pages link to it', async () => {
+    routes.set('/ok', status(200))
+    const checker = makeChecker()
+    await Promise.all([1, 2, 3, 4, 5].map(async () => await checker.check(`${base}/ok`)))
+    expect(hits.get('/ok')).toBe(1)
+  })
+  it('limits the requests per host and for the whole run', async () => {
+    const urls = Array.from({ length: 10 }, (_, i) => `${base}/page${i}`)
+    urls.forEach(u => routes.set(new URL(u).pathname, status(200)))
+    const limited = makeChecker({ perHostConcurrency: 2 })
+    await Promise.all(urls.map(async u => await limited.check(u)))
+    expect(maxInFlight).toBeLessThanOrEqual(2)
+
+    const budgeted = makeChecker({ maxRequests: 3 })
+    const problems = await Promise.all(urls.map(async u => await findLinkProblem(budgeted, u)))
+    expect(budgeted.counters.requests).toBe(3)
+    expect(problems.filter(p => p?.code === 'budget_exceeded').length).toBe(7)
+    expect(problems.every(p => p?.isError !== true)).toBe(true)
+  })
+  it('retries with a backoff', async () => {
+    let calls = 0
+    routes.set('/flaky', (req, res) => { status(++calls < 3 ? 503 : 200)(req, res) })
+    routes.set('/down', status(500))
+    const checker = makeChecker({ retries: 2 })
+    expect(await checker.check(`${base}/flaky`)).toMatchObject({ status: 200 })
+    expect(hits.get('/flaky')).toBe(3)
+    expect(await checker.check(`${base}/down`)).toMatchObject({ status: 500 })
+    expect(hits.get('/down')).toBe(3)
+  })
+  it('reports network errors without failing the run', async () => {
+    const checker = makeChecker({ retries: 0, fetch: async () => { throw new Error('ECONNREFUSED') } })
+    expect(await findLinkProblem(checker, 'https://example.com')).toEqual({ code: 'fetch_failed_maybe', toUrl: '', secondToUrl: 'ECONNREFUSED', isError: false })
+  })
+  it('does not request URLs again until their cached result expires', async () => {
+    // A real directory because mock-fs and the local server do not mix
+    const cacheFile = path.join(fs.mkdtempSync(path.join(os.tmpdir(), 'poet-links-')), 'links.json')
+    routes.set('/ok', status(200))
+    const first = makeChecker({ cacheFile })
+    await first.check(`${base}/ok`)
+    await first.save()
+
+    const reopen = async (cacheTtlMs: number) => {
+      const checker = makeChecker({ cacheFile, cacheTtlMs })
+      await checker.open()
+      return checker
+    }
+    const fresh = await reopen(60 * 1000)
+    expect(await fresh.check(`${base}/ok`)).toMatchObject({ status: 200 })
+    expect(fresh.counters).toEqual({ requests: 0, cacheHits: 1 })
+
+    const expired = await reopen(-1)
+    await expired.check(`${base}/ok`)
+    expect(expired.counters).toEqual({ requests: 1, cacheHits: 0 })
+    expect(hits.get('/ok')).toBe(2)
+    fs.rmSync(path.dirname(cacheFile), { recursive: true })
+  })
+  it('does not cache responses that may succeed when tried again', async () => {
+    const cacheFile = path.join(fs.mkdtempSync(path.join(os.tmpdir(), 'poet-links-')), 'links.json')
+    routes.set('/busy', status(429))
+    routes.set('/down', status(503))
+    routes.set('/gone', status(404))
+    const first = makeChecker({ cacheFile, retries: 0 })
+    for (const url of ['/busy', '/down', '/gone']) await first.check(`${base}${url}`)
+    await first.save()
+
+    const second = makeChecker({ cacheFile, retries: 0 })
+    await second.open()
+    expect(await second.check(`${base}/busy`)).toMatchObject({ status: 429 })
+    expect(await second.check(`${base}/down`)).toMatchObject({ status: 503 })
+    expect(await second.check(`${base}/gone`)).toMatchObject({ status: 404 })
+    expect(second.counters).toEqual({ requests: 2, cacheHits: 1 })
+    fs.rmSync(path.dirname(cacheFile), { recursive: true })
+  })
+})
@@ -0,0 +1,225 @@
+import fs from 'fs'
+import path from 'path'
+import { type Opt } from './model/utils'
+
+export const LINK_CACHE_SCHEMA = 'poet-links-1'
+
+// The outcome of HEAD-ing a URL and following its redirects.
+// `redirects` lists every Location that was followed, in order.
+export interface LinkResult {
+  checkedAt: number
+  redirects: string[]
+  status?: number // of the last response
+  error?: string // the request failed without a response
+  budgetExceeded?: boolean // maxRequests was reached before this URL could be checked
+}
+
+// One row of the `links` CSV. `code` is 'parse', 'double_redirect',
+// 'fetch_failed_maybe', 'budget_exceeded' or the HTTP status.
+export interface LinkProblem {
+  code: string | number
+  toUrl: string
+  secondToUrl: string
+  isError: boolean // fetch_failed_maybe is only a hint and does not fail the run
+}
+
+export type FetchLike = (url: string, init: { method: string, redirect: 'manual' }) => Promise<{ status: number, headers: { get: (name: string) => string | null } }>
+
+export interface LinkCheckerOptions {
+  perHostConcurrency: number
+  perHostIntervalMs: number // minimum time between two requests to the same host
+  maxRequests: number // for the whole run, including redirects and retries
+  maxRedirects: number
+  retries: number // for network errors, 429 and 5xx
+  retryDelayMs: number // doubled after every retry
+  cacheTtlMs: number
+  cacheFile?: string
+  fetch: FetchLike
+}
+
+export const DEFAULT_LINK_CHECKER_OPTIONS: LinkCheckerOptions = {
+  perHostConcurrency: 2,
+  perHostIntervalMs: 100,
+  maxRequests: Infinity,
+  maxRedirects: 10,
+  retries: 2,
+  retryDelayMs: 1000,
+  cacheTtlMs: 7 * 24 * 60 * 60 * 1000,
+  fetch: async (url, init) => await fetch(url, init)
+}
+
+interface HostSlots { active: number, waiting: Array<() => void>, nextStart: number }
+interface CacheFile { schema: string, entries: Record<string, LinkResult> }
+
+const sleep = async (ms: number) => await new Promise((resolve) => setTimeout(resolve, ms))
+const isRedirect = (status: number) => status >= 300 && status < 400
+const isRetryable = (status: number) => status === 429 || status >= 500
+
+class BudgetExceededError extends Error {}
+
+// Checks external URLs. Every URL is requested at most once per run (and not
+// at all while its cached result is younger than cacheTtlMs). Requests are
+// limited per host, spaced out per host, and capped for the whole run.
+export class LinkChecker {
+  public readonly counters = { requests: 0, cacheHits: 0 }
+  private readonly options: LinkCheckerOptions
+  private readonly hosts = new Map<string, HostSlots>()
+  private readonly inFlight = new Map<string, Promise<LinkResult>>()
+  private entries = new Map<string, LinkResult>()
+  private dirty = false
+
+  constructor(options: Partial<LinkCheckerOptions> = {}) {
+    this.options = { ...DEFAULT_LINK_CHECKER_OPTIONS, ...options }
+  }
+
+  // Reads the cache file (if there is one)
+  public async open() {
+    const { cacheFile } = this.options
+    if (cacheFile === undefined) return
+    try {
+      const json: CacheFile = JSON.parse(await fs.promises.readFile(cacheFile, 'utf-8'))
+      if (json.schema === LINK_CACHE_SCHEMA) {
+        this.entries = new Map(Object.entries(json.entries))
+      }
+    } catch {
+      // Missing or corrupt. Start over
+    }
+  }
+
+  public async save() {
+    const { cacheFile } = this.options
+    if (cacheFile === undefined || !this.dirty) return
+    this.dirty = false
+    const json: CacheFile = { schema: LINK_CACHE_SCHEMA, entries: Object.fromEntries(this.entries) }
+    const tmp = `${cacheFile}.${process.pid}.tmp`
+    await fs.promises.mkdir(path.dirname(cacheFile), { recursive: true })
+    await fs.promises.writeFile(tmp, JSON.stringify(json), 'utf-8')
+    await fs.promises.rename(tmp, cacheFile)
+  }
+
+  public async check(url: string): Promise<LinkResult> {
+    const cached = this.entries.get(url)
+    if (cached !== undefined && Date.now() - cached.checkedAt < this.options.cacheTtlMs) {
+      this.counters.cacheHits++
+      return cached
+    }
+    let pending = this.inFlight.get(url)
+    if (pending === undefined) {
+      pending = this.follow(url)
+      this.inFlight.set(url, pending)
+    }
+    return await pending
+  }
+
+  private async follow(url: string): Promise<LinkResult> {
+    const redirects: string[] = []
+    let current = url
+    for (;;) {
+      let status: number
+      let location: string | null
+      try {
+        ({ status, location } = await this.request(current))
+      } catch (err) {
+        // Not cached: only remember what the servers said and try again next time
+        return { checkedAt: Date.now(), redirects, error: (err as Error).message, budgetExceeded: err instanceof BudgetExceededError }
+      }
+      if (!isRedirect(status) || location === null || redirects.length >= this.options.maxRedirects) {
+        const result = { checkedAt: Date.now(), redirects, status }
+        // A 429 or 5xx that outlasted the retries is the server's problem today, not the link's
+        return isRetryable(status) ? result : this.remember(url, result)
+      }
+      current = new URL(location, current).toString()
+      redirects.push(current)
+    }
+  }
+
+  private remember(url: string, result: LinkResult) {
+    this.entries.set(url, result)
+    this.dirty = true
+    return result
+  }
+
+  // One HEAD request (with retries)
+  private async request(url: string) {
+    const host = new URL(url).host
+    for (let attempt = 0; ; attempt++) {
+      if (this.counters.requests >= this.options.maxRequests) {
+        throw new BudgetExceededError(`Request budget of ${this.options.maxRequests} exceeded`)
+      }
+      this.counters.requests++
+      let response: Opt<{ status: number, location: string | null }>
+      let failure: Opt<Error>
+      await this.acquire(host)
+      try {
+        const res = await this.options.fetch(url, { method: 'HEAD', redirect: 'manual' })
+        response = { status: res.status, location: res.headers.get('location') }
+      } catch (err) {
+        failure = err as Error
+      } finally {
+        this.release(host)
+      }
+      if (response !== undefined && (!isRetryable(response.status) || attempt >= this.options.retries)) {
+        return response
+      }
+      if (failure !== undefined && attempt >= this.options.retries) {
+        throw failure
+      }
+      await sleep(this.options.retryDelayMs * 2 ** attempt)
+    }
+  }
+
+  private async acquire(host: string) {
+    let slots = this.hosts.get(host)
+    if (slots === undefined) {
+      slots = { active: 0, waiting: [], nextStart: 0 }
+      this.hosts.set(host, slots)
+    }
+    if (slots.active >= this.options.perHostConcurrency) {
+      const s = slots
+      await new Promise<void>(resolve => { s.waiting.push(resolve) })
+    } else {
+      slots.active++
+    }
+    const now = Date.now()
+    const start = Math.max(now, slots.nextStart)
+    slots.nextStart = start + this.options.perHostIntervalMs
+    if (start > now) await sleep(start - now)
+  }
+
+  private release(host: string) {
+    const slots = this.hosts.get(host)
+    if (slots === undefined) return
+    const next = slots.waiting.shift()
+    if (next !== undefined) {
+      next() // Hand the slot over without freeing it
+    } else {
+      slots.active--
+    }
+  }
+}
+
+// Skip injected exercises
+export const isCheckableUrl = (url: string) => !url.startsWith('#ost/api/ex') && !url.startsWith('#exercise/')
+
+// What the `links` command prints for a URL, or undefined when the link is fine
+export async function findLinkProblem(checker: LinkChecker, url: string): Promise<Opt<LinkProblem>> {
+  // Parse the URL first because it might not be valid
+  try {
+    // eslint-disable-next-line no-new
+    new URL(url)
+  } catch {
+    return { code: 'parse', toUrl: '', secondToUrl: '', isError: true }
+  }
+  const { redirects, status, error, budgetExceeded } = await checker.check(url)
+  if (error !== undefined) {
+    const code = budgetExceeded === true ? 'budget_exceeded' : 'fetch_failed_maybe'
+    return { code, toUrl: redirects[redirects.length - 1] ?? '', secondToUrl: error, isError: false }
+  }
+  if (redirects.length >= 2) {
+    return { code: 'double_redirect', toUrl: redirects[0], secondToUrl: redirects[1], isError: true }
+  }
+  if (status !== undefined && status >= 200 && status < 300) {
+    return undefined
+  }
+  return { code: status ?? 'fetch_failed_maybe', toUrl: redirects[0] ?? '', secondToUrl: '', isError: true }
+}
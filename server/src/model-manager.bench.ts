@@ -0,0 +1,60 @@
+import { expect } from '@jest/globals'
+import { performance } from 'perf_hooks'
+import { type Connection } from 'vscode-languageserver'
+import { ModelManager } from './model-manager'
+import { LatencyHistogram } from './latency-histogram'
+import { first, loadSuccess, makeBundle, pageMaker } from './model/spec-helpers.spec'
+
+ModelManager.debug = () => {} // Turn off logging
+
+const conn = { sendDiagnostics: () => {} } as unknown as Connection
+const sleep = async (ms: number) => { await new Promise(resolve => setTimeout(resolve, ms)) }
+
+// A long section being typed in, one character at a time
+function keystrokes(count: number) {
+  const extraCnxml = Array.from({ length: 300 }, (_, i) => `<section id="s${i}"><title>Section ${i}</title>
+  <para id="p${i}">Some <emphasis>text</emphasis> with a <term>term</term>.</para>
+  <note id="n${i}"><para id="np${i}">A note</para></note>
+</section>`).join('\n')
+  return Array.from({ length: count }, (_, i) => pageMaker({ title: `Typing ${'x'.repeat(i)}`, extraCnxml }))
+}
+
+async function type(edits: string[], onEdit: (contents: string, version: number) => void) {
+  const handlerTime = new LatencyHistogram()
+  for (const [i, contents] of edits.entries()) {
+    const start = performance.now()
+    onEdit(contents, i + 1)
+    handlerTime.record(performance.now() - start)
+    await sleep(10)
+  }
+  return handlerTime
+}
+
+function makeManager() {
+  const manager = new ModelManager(makeBundle(), conn, () => {})
+  const page = loadSuccess(first(loadSuccess(first(loadSuccess(manager.bundle).books)).pages))
+  return { manager, page }
+}
+
+describe('Document sync', () => {
+  it('parses a page that is being typed in once the typing stops instead of on every keystroke', async () => {
+    const edits = keystrokes(40)
+
+    const everyEdit = makeManager()
+    const parsedEveryEdit = await type(edits, contents => { everyEdit.manager.updateFileContents(everyEdit.page.absPath, contents) })
+
+    const debounced = makeManager()
+    const scheduled = await type(edits, (contents, version) => { debounced.manager.scheduleFileContents(debounced.page.absPath, contents, version) })
+    while (debounced.manager.documentSyncLatency.count === 0) await sleep(10)
+
+    console.log([
+      `Typing ${edits.length} characters into a ${Math.round(edits[0].length / 1024)} KB page`,
+      `Time spent in each change event, parsing every edit (updateFileContents): ${parsedEveryEdit.toString()}`,
+      `Time spent in each change event, debounced (scheduleFileContents): ${scheduled.toString()}`,
+      `Last edit to diagnostics, debounced: ${debounced.manager.documentSyncLatency.toString()}`
+    ].join('\n'))
+    expect(debounced.page.title).toBe(everyEdit.page.title)
+    expect(debounced.manager.documentSyncLatency.count).toBe(1)
+    expect(scheduled.totalMs).toBeLessThan(parsedEveryEdit.totalMs)
+  })
+})
@@ -7,17 +7,24 @@ import I from 'immutable'
 import { createConnection, type WatchDog } from 'vscode-languageserver'
 import { DiagnosticSeverity, FileChangeType, type Logger, type ProtocolConnection, type PublishDiagnosticsParams } from 'vscode-languageserver-protocol'
 import xmlFormat from 'xml-formatter'
-import { expectValue, type Opt, join, PathKind } from './model/utils'
+import { expectValue, type Opt, join, PathKind, type WithRange } from './model/utils'
 import { Bundle, BundleValidationKind } from './model/bundle'
 import { ModelManager } from './model-manager'
+import { type ParserPool } from './parser-pool'
+import { extractFacts } from './parse-worker'
 import { bookMaker, bundleMaker, first, FS_PATH_HELPER, ignoreConsoleWarnings, loadSuccess, makeBundle, type PageInfo, pageMaker, newH5PPath } from './model/spec-helpers.spec'
 import { type Job, JobRunner } from './job-runner'
+import { FactCache } from './fact-cache'
 
 import { PageNode, PageValidationKind } from './model/page'
-import { type TocModification, TocModificationKind, TocNodeKind } from '../../common/src/toc'
-import { type BooksAndOrphans, DiagnosticSource } from '../../common/src/requests'
+import { BookRootNode, type BookToc, type ClientTocNode, type TocModification, TocModificationKind, TocNodeKind } from '../../common/src/toc'
+import { applyBookTocsPatch, type BooksAndOrphans, type BookTocsPatch, DiagnosticSource, ExtensionServerNotification, type VersionedBooksAndOrphans } from '../../common/src/requests'
 import { URI, Utils } from 'vscode-uri'
 import { H5PExercise } from './model/h5p-exercise'
+import { TocIdMap, toString, writeCollection } from './book-toc-utils'
+import { FactsKind, readXML } from './model/fileish'
+import { extractBookFacts } from './model/book'
+import { scanPageFacts } from './model/page-scanner'
 
 ModelManager.debug = () => {} // Turn off logging
 JobRunner.debug = () => {} // Turn off logging
@@ -140,6 +147,97 @@ describe('Bundle Manager', () => {
   })
 })
 
+describe('scheduleFileContents()', () => {
+  const sinon = SinonRoot.createSandbox()
+  let manager = null as unknown as ModelManager
+  let sendDiagnosticsStub = null as unknown as SinonRoot.SinonStub<[params: PublishDiagnosticsParams], void>
+  // Lets the awaits in a sync that was waiting on a parse continue
+  const settle = async () => { for (let i = 0; i < 10; i++) await Promise.resolve() }
+
+  beforeEach(() => {
+    jest.useFakeTimers()
+    manager = new ModelManager(makeBundle(), conn)
+    sendDiagnosticsStub = sinon.stub(conn, 'sendDiagnostics')
+  })
+  afterEach(() => {
+    jest.useRealTimers()
+    sinon.restore()
+  })
+  const loadPage = () => loadSuccess(first(loadSuccess(first(loadSuccess(manager.bundle).books)).pages))
+
+  it('parses only the newest version once the edits stop', () => {
+    const page = loadPage()
+    const loadSpy = sinon.spy(page, 'loadFacts')
+    manager.scheduleFileContents(page.absPath, pageMaker({ title: 'v1' }), 1)
+    jest.advanceTimersByTime(ModelManager.documentSyncDelay - 1)
+    manager.scheduleFileContents(page.absPath, pageMaker({ title: 'v2' }), 2)
+    // Features that read the text see the edit right away
+    expect(manager.getOpenDocContents(page.absPath)).toBe(pageMaker({ title: 'v2' }))
+    jest.advanceTimersByTime(ModelManager.documentSyncDelay - 1)
+    expect(loadSpy.callCount).toBe(0)
+    jest.advanceTimersByTime(1)
+    expect(loadSpy.callCount).toBe(1)
+    expect(page.title).toBe('v2')
+    expect(sendDiagnosticsStub.callCount).toBe(1)
+    expect(manager.documentSyncLatency.count).toBe(1)
+  })
+  it('drops a parse that a newer edit superseded while it ran', async () => {
+    const page = loadPage()
+    const parses: Array<() => void> = []
+    manager.parserPool = {
+      parse: async (kind: FactsKind, content: string) => await new Promise(resolve => { parses.push(() => { resolve(extractFacts(kind, content)) }) })
+    } as unknown as ParserPool
+    const loadFactsSpy = sinon.spy(page, 'loadFacts')
+    // The scanner leaves pages with a DOCTYPE to the parser threads
+    const version = (title: string) => `<!DOCTYPE document>\n${pageMaker({ title })}`
+    manager.scheduleFileContents(page.absPath, version('v1'), 1)
+    jest.advanceTimersByTime(ModelManager.documentSyncDelay)
+    manager.scheduleFileContents(page.absPath, version('v2'), 2)
+    jest.advanceTimersByTime(ModelManager.documentSyncDelay)
+    expect(parses.length).toBe(2)
+    parses[1]()
+    await settle()
+    parses[0]()
+    await settle()
+    expect(loadFactsSpy.callCount).toBe(1)
+    expect(page.title).toBe('v2')
+    expect(sendDiagnosticsStub.callCount).toBe(1)
+  })
+  it('moves the facts after an edit inside one element of an open page', () => {
+    const page = loadPage()
+    const v1 = pageMaker({ extraCnxml: '<section id="s1"><para id="p1">Text</para></section>\n<para id="p2"/>' })
+    const v2 = v1.replace('Text', 'More\n<note id="n1">text</note>')
+    manager.scheduleFileContents(page.absPath, v1, 1)
+    jest.advanceTimersByTime(ModelManager.documentSyncDelay)
+    manager.scheduleFileContents(page.absPath, v2, 2)
+    jest.advanceTimersByTime(ModelManager.documentSyncDelay)
+    const expected = expectValue(scanPageFacts(v2), 'The page scans').elementIds
+    // The page keeps compact ranges, so compare the positions
+    const positions = (ids: Iterable<WithRange<string>>) => Object.fromEntries([...ids].map(({ v, range }) => [v, [range.start, range.end]]))
+    expect(page.elementIds.keySeq().toSet()).toEqual(I.Set(['s1', 'p1', 'n1', 'p2']))
+    expect(positions(page.elementIds.values())).toEqual(positions(expected))
+  })
+  it('logs a sync that fails instead of stopping the server', async () => {
+    const page = loadPage()
+    sinon.stub(page, 'loadFacts').throws(new Error('Broken'))
+    const errorStub = sinon.stub(console, 'error')
+    manager.scheduleFileContents(page.absPath, pageMaker({ title: 'v1' }), 1)
+    await manager.flushDocument(page.absPath)
+    expect(errorStub.callCount).toBe(1)
+    expect(errorStub.firstCall.args).toContain(page.absPath)
+  })
+  it('drops the edits that were not parsed when the document closes', () => {
+    const page = loadPage()
+    const loadSpy = sinon.spy(page, 'loadFacts')
+    manager.scheduleFileContents(page.absPath, pageMaker({ title: 'v1' }), 1)
+    manager.closeDocument(page.absPath)
+    jest.advanceTimersByTime(ModelManager.documentSyncDelay)
+    expect(loadSpy.callCount).toBe(0)
+    expect(sendDiagnosticsStub.callCount).toBe(0)
+    expect(manager.getOpenDocContents(page.absPath)).toBeUndefined()
+  })
+})
+
 describe('Unexpected files/directories', () => {
   const sinon = SinonRoot.createSandbox()
   let manager = null as unknown as ModelManager
@@ -192,13 +290,24 @@ describe('Find orphaned files', () => {
     mockfs({
       'META-INF/books.xml': bundleMaker({}),
       'modules/m2468/index.cnxml': pageMaker({}),
-      'modules/m1357/index.cnxml': pageMaker({})
+      'modules/m1357/index.cnxml': pageMaker({}),
+      'media/diagram.svg': '<svg xmlns="http://www.w3.org/2000/svg"/>',
+      'media/handout.pdf': '%PDF-1.4'
     })
   })
   afterEach(() => {
     mockfs.restore()
     sinon.restore()
   })
+  it('finds orphaned Resources without reading them', async () => {
+    sinon.stub(conn, 'sendDiagnostics')
+    const readFile = sinon.spy(fs.promises, 'readFile')
+    const manager = new ModelManager(new Bundle(FS_PATH_HELPER, process.cwd()), conn)
+    await manager.loadEnoughForOrphans()
+    expect(manager.orphanedResources.size).toBe(2)
+    manager.orphanedResources.forEach(r => { expect(r.exists).toBe(true) })
+    expect(readFile.getCalls().map(c => String(c.args[0])).filter(p => p.includes('media'))).toEqual([])
+  })
   it('finds orphaned Pages', async () => {
     sinon.stub(conn, 'sendDiagnostics')
     const manager = new ModelManager(new Bundle(FS_PATH_HELPER, process.cwd()), conn)
@@ -254,6 +363,88 @@ describe('updating files', () => {
   })
 })
 
+describe('ensureIds', () => {
+  const sinon = SinonRoot.createSandbox()
+  const concurrency = ModelManager.ensureIdsConcurrency
+  const missing = '<para>one</para><para>two</para>'
+  afterEach(() => {
+    mockfs.restore()
+    sinon.restore()
+    ModelManager.ensureIdsConcurrency = concurrency
+  })
+
+  it('fixes the pages with missing ids a few at a time and keeps the finished ones when cancelled', async () => {
+    mockfs({
+      'META-INF/books.xml': bundleMaker({}),
+      'modules/m1/index.cnxml': pageMaker({ extraCnxml: missing }),
+      'modules/m2/index.cnxml': pageMaker({ extraCnxml: missing }),
+      'modules/m3/index.cnxml': pageMaker({ extraCnxml: missing }),
+      'modules/m4/index.cnxml': pageMaker({ extraCnxml: '<para id="p1">fine</para>' })
+    })
+    const manager = new ModelManager(makeBundle(), conn)
+    const pages = ['m1', 'm2', 'm3', 'm4'].map(m => {
+      const p = manager.bundle.allPages.getOrAdd(path.join(manager.bundle.absPath, '..', '..', 'modules', m, 'index.cnxml'))
+      p.load(fs.readFileSync(p.absPath, 'utf-8'))
+      return p
+    })
+    const sendDiagnosticsStub = sinon.stub(conn, 'sendDiagnostics')
+    const sendProgressStub = sinon.stub(conn, 'sendProgress')
+    ModelManager.ensureIdsConcurrency = 1
+
+    const stopAfterTwo = { isCancellationRequested: false, onCancellationRequested: jest.fn() }
+    sendDiagnosticsStub.callsFake(() => { stopAfterTwo.isCancellationRequested = sendDiagnosticsStub.callCount >= 2 })
+    expect(await manager.ensureIds('token', stopAfterTwo as any)).toEqual({ pages: 2, ids: 4, cancelled: true })
+    expect(pages.filter(p => fs.readFileSync(p.absPath, 'utf-8').includes('id="para-00002"')).length).toBe(2)
+    expect(sendProgressStub.lastCall.args[2]).toEqual({ kind: 'end' })
+
+    const never = { isCancellationRequested: false, onCancellationRequested: jest.fn() }
+    expect(await manager.ensureIds(undefined, never as any)).toEqual({ pages: 1, ids: 2, cancelled: false })
+    expect(pages.every(p => p.elementsMissingIds.isEmpty())).toBe(true)
+    expect(pages.some(p => p.validationErrors.errors.some(e => e.title === PageValidationKind.MISSING_ID.title))).toBe(false)
+    expect(await manager.ensureIds(undefined, never as any)).toEqual({ pages: 0, ids: 0, cancelled: false })
+  })
+  it('leaves the page as it was when the fixed file cannot be written', async () => {
+    mockfs({
+      'META-INF/books.xml': bundleMaker({}),
+      'modules/m1/index.cnxml': pageMaker({ extraCnxml: missing })
+    })
+    const manager = new ModelManager(makeBundle(), conn)
+    manager.factCache = new FactCache('/cache/facts.json')
+    const page = manager.bundle.allPages.getOrAdd(path.join(manager.bundle.absPath, '..', '..', 'modules', 'm1', 'index.cnxml'))
+    page.load(fs.readFileSync(page.absPath, 'utf-8'))
+    sinon.stub(conn, 'sendDiagnostics')
+    sinon.stub(conn, 'sendProgress')
+    sinon.stub(fs.promises, 'writeFile').rejects(new Error('Read-only file system'))
+
+    const never = { isCancellationRequested: false, onCancellationRequested: jest.fn() }
+    await expect(manager.ensureIds(undefined, never as any)).rejects.toThrow(/Read-only/)
+    expect(page.elementsMissingIds.size).toBe(2)
+    expect(manager.factCache.size).toBe(0)
+  })
+  it('does not use the facts of a page that has edits waiting to be parsed', async () => {
+    mockfs({
+      'META-INF/books.xml': bundleMaker({}),
+      'modules/m1/index.cnxml': pageMaker({ extraCnxml: missing })
+    })
+    const manager = new ModelManager(makeBundle(), conn)
+    const page = manager.bundle.allPages.getOrAdd(path.join(manager.bundle.absPath, '..', '..', 'modules', 'm1', 'index.cnxml'))
+    page.load(fs.readFileSync(page.absPath, 'utf-8'))
+    sinon.stub(conn, 'sendDiagnostics')
+    sinon.stub(conn, 'sendProgress')
+    // Typed in the editor but not parsed yet
+    manager.scheduleFileContents(page.absPath, pageMaker({ extraCnxml: `<para id="para-00001">zero</para>\n${missing}<para>three</para>` }), 2)
+
+    const never = { isCancellationRequested: false, onCancellationRequested: jest.fn() }
+    // Counted from the text that was fixed, not from the facts of the last parse
+    expect(await manager.ensureIds(undefined, never as any)).toEqual({ pages: 1, ids: 3, cancelled: false })
+    const written = fs.readFileSync(page.absPath, 'utf-8')
+    expect(written.match(/id="para-00001"/g)?.length).toBe(1)
+    expect(written).toContain('>zero</para>')
+    expect(page.elementsMissingIds.isEmpty()).toBe(true)
+    manager.closeDocument(page.absPath)
+  })
+})
+
 describe('processFilesystemChange()', () => {
   const sinon = SinonRoot.createSandbox()
   let manager = null as unknown as ModelManager
@@ -388,6 +579,65 @@ describe('processFilesystemChange()', () => {
     expect((await fireChange(FileChangeType.Deleted, page.workspacePath)).size).toBe(1)
     expect((await fireChange(FileChangeType.Deleted, bundle.workspacePath)).size).toBe(1)
   })
+  it('caches the facts under the stat from before the file was read', async () => {
+    const cache = new FactCache('/cache/facts.json')
+    manager.factCache = cache
+    await fireChange(FileChangeType.Created, 'META-INF/books.xml')
+    await fireChange(FileChangeType.Created, 'collections/slug2.collection.xml')
+    const pagePath = path.resolve('modules/m1234/index.cnxml')
+    const readFile = fs.promises.readFile
+    sinon.stub(fs.promises, 'readFile').callsFake(async (...args: any[]) => {
+      const content = await (readFile as any)(...args)
+      // Saved again right after it was read
+      if (path.resolve(String(args[0])) === pagePath) fs.writeFileSync(pagePath, pageMaker({ elementIds: ['changed'] }))
+      return content
+    })
+    await fireChange(FileChangeType.Changed, 'modules/m1234/index.cnxml')
+    sinon.restore()
+    await cache.save()
+    const reopened = new FactCache('/cache/facts.json')
+    await reopened.open()
+    // The entry is for the old contents so the new file does not match it
+    expect(reopened.size).toBe(1)
+    expect(reopened.get(pagePath, FactsKind.PAGE, fs.statSync(pagePath))).toBeUndefined()
+  })
+  it('forgets the cached facts of deleted files', async () => {
+    const cache = new FactCache('/cache/facts.json')
+    manager.factCache = cache
+    const content = pageMaker({})
+    cache.set(path.resolve('modules/m1234/index.cnxml'), FactsKind.PAGE, { mtimeMs: 1, size: content.length }, content, extractFacts(FactsKind.PAGE, content))
+    await fireChange(FileChangeType.Deleted, 'modules')
+    expect(cache.size).toBe(0)
+    await cache.save()
+  })
+  it('only revalidates the nodes a change can affect but sends the same diagnostics as a full sweep', async () => {
+    fs.writeFileSync('modules/m1234/index.cnxml', pageMaker({ pageLinks: [{ targetPage: 'm5678' }] }))
+    fs.mkdirSync('modules/m5678')
+    fs.writeFileSync('modules/m5678/index.cnxml', pageMaker({})) // Same uuid as m1234
+    const sendDiagnostics = async (fullSweep: boolean) => {
+      ModelManager.fullDiagnosticsSweep = fullSweep
+      try {
+        manager = new ModelManager(new Bundle(FS_PATH_HELPER, process.cwd()), conn)
+        sinon.stub(manager.jobRunner, 'enqueue')
+        sendDiagnosticsStub.resetHistory()
+        await fireChange(FileChangeType.Changed, 'META-INF/books.xml')
+        await fireChange(FileChangeType.Changed, 'collections/slug2.collection.xml')
+        await fireChange(FileChangeType.Changed, 'modules/m1234/index.cnxml')
+        await fireChange(FileChangeType.Created, 'modules/m5678/index.cnxml')
+        await fireChange(FileChangeType.Deleted, 'modules/m5678/index.cnxml')
+        return sendDiagnosticsStub.getCalls()
+          .map(c => `${c.args[0].uri}: ${c.args[0].diagnostics.map(d => d.message).join(', ')}`)
+          .sort()
+      } finally {
+        ModelManager.fullDiagnosticsSweep = false
+      }
+    }
+    const incremental = await sendDiagnostics(false)
+    expect(incremental).toEqual(await sendDiagnostics(true))
+    const m1234 = incremental.filter(d => d.includes('m1234'))
+    expect(m1234.some(d => d.includes(PageValidationKind.DUPLICATE_UUID.title))).toBe(true)
+    expect(m1234.some(d => d.includes(PageValidationKind.MISSING_TARGET.title))).toBe(true)
+  })
   it('Uses the unsaved content even when a filesystem change event occurs', async () => {
     // Load the Bundle, Book, and Page
     const bundle = loadSuccess(manager.bundle)
@@ -442,6 +692,42 @@ describe('Image Autocomplete', () => {
     fn.mockRestore()
   })
 
+  it('Sees an image that was just typed and is not parsed yet', async () => {
+    const page = first(loadSuccess(first(loadSuccess(manager.bundle).books)).pages)
+    const imagePath = '../../media/image.png'
+    manager.bundle.allResources.getOrAdd(joinPath(page, imagePath)).load('image-bits')
+    manager.updateFileContents(page.absPath, pageMaker({}))
+    const fn = jest.spyOn(manager, 'loadEnoughForOrphans').mockResolvedValue()
+    // Still inside documentSyncDelay
+    const typed = pageMaker({ imageHrefs: ['../../media/im'] })
+    manager.scheduleFileContents(page.absPath, typed, 2)
+    expect(page.resourceLinks.size).toBe(0)
+    const lines = typed.split('\n')
+    const line = lines.findIndex(l => l.includes('<image src="'))
+    const character = lines[line].indexOf('"/>')
+    const results = await manager.autocompleteResources(page, { line, character })
+    expect(results.map((r) => r.label)).toStrictEqual([imagePath])
+    manager.closeDocument(page.absPath)
+    fn.mockRestore()
+  })
+
+  it('Suggests the orphaned images that match what was typed as links change', async () => {
+    const page = first(loadSuccess(first(loadSuccess(manager.bundle).books)).pages)
+    const [cat, dog, catalog] = ['../../media/cat.png', '../../media/dog.png', '../../media/catalog.png']
+    ;[cat, dog, catalog].forEach(p => { manager.bundle.allResources.getOrAdd(joinPath(page, p)).load('image-bits') })
+    const fn = jest.spyOn(manager, 'loadEnoughForOrphans').mockResolvedValue()
+    const complete = async (href: string, typed: string) => {
+      manager.updateFileContents(page.absPath, pageMaker({ imageHrefs: [href] }))
+      const link = first(page.resourceLinks)
+      const cursor = { line: link.range.start.line, character: link.range.start.character + `<image src="${typed}`.length }
+      return (await manager.autocompleteResources(page, cursor)).map(r => r.label)
+    }
+    expect(await complete(cat, '../../media/cat')).toEqual([catalog])
+    expect(await complete(dog, '../../')).toEqual([cat, catalog])
+    expect(await complete(dog, '../../media/d')).toEqual([])
+    fn.mockRestore()
+  })
+
   it('Returns no results outside image tag', async () => {
     const page = first(loadSuccess(first(loadSuccess(manager.bundle).books)).pages)
 
@@ -614,9 +900,105 @@ describe('documentLinks()', () => {
   })
 })
 
+describe('writeCollection', () => {
+  let tokens = 0
+  const page = (fileId: string): ClientTocNode => ({ type: TocNodeKind.Page, value: { token: `t${tokens++}`, title: fileId, fileId, absPath: `/modules/${fileId}/index.cnxml` } })
+  const subbook = (title: string, children: ClientTocNode[]): ClientTocNode => ({ type: TocNodeKind.Subbook, value: { token: `t${tokens++}`, title }, children })
+  const bookToc = (title: string, tocTree: ClientTocNode[]): BookToc => ({
+    type: BookRootNode.Singleton,
+    absPath: '/collections/slug.collection.xml',
+    uuid: '00000000-0000-4000-0000-000000000000',
+    title,
+    slug: 'slug',
+    language: 'en',
+    licenseUrl: 'http://creativecommons.org/licenses/by/4.0/',
+    tocTree
+  })
+
+  it('writes the same bytes as toString and the facts that parsing them would give', () => {
+    const tocs = [
+      bookToc('Empty', []),
+      bookToc("Newton's Laws & \"Friends\"", [
+        page('m1'),
+        subbook('  Chapter 1 ', [page('m2'), subbook('Empty section', []), subbook('Section', [page('m3'), page('m4')])]),
+        subbook('Chapter 2', [page('m5')]),
+        page('m6')
+      ])
+    ]
+    for (const t of tocs) {
+      const written = expectValue(writeCollection(t), 'Nothing in these needs special escaping')
+      expect(written.xml).toBe(toString(t))
+      expect(written.facts).toEqual(extractBookFacts(readXML(written.xml).doc))
+    }
+  })
+  it('leaves titles and attributes that need more escaping to toString', () => {
+    expect(writeCollection(bookToc('a < b', []))).toBeUndefined()
+    expect(writeCollection(bookToc('Two\nlines', []))).toBeUndefined()
+    expect(writeCollection(bookToc('Chapter', [subbook(' ', [])]))).toBeUndefined()
+    expect(writeCollection(bookToc('Chapter', [page('m"1')]))).toBeUndefined()
+  })
+})
+
+describe('TocIdMap', () => {
+  const page = (token: string): ClientTocNode => ({ type: TocNodeKind.Page, value: { token, title: token, fileId: token, absPath: `/modules/${token}/index.cnxml` } })
+  const subbook = (token: string, children: ClientTocNode[]): ClientTocNode => ({ type: TocNodeKind.Subbook, value: { token, title: token }, children })
+  const bookToc = (slug: string, tocTree: ClientTocNode[]): BookToc => ({
+    type: BookRootNode.Singleton,
+    absPath: `/collections/${slug}.collection.xml`,
+    uuid: '00000000-0000-4000-0000-000000000000',
+    title: slug,
+    slug,
+    language: 'en',
+    licenseUrl: 'http://creativecommons.org/licenses/by/4.0/',
+    tocTree
+  })
+  const newMap = () => new TocIdMap(() => { throw new Error('BUG: Not used by these tests') })
+
+  it('knows the parent, book and index of every node', () => {
+    const [p3, p4, p5] = [page('p3'), page('p4'), page('p5')]
+    const inner = subbook('inner', [page('p2'), p3])
+    const outer = subbook('outer', [page('p1'), inner])
+    const books = [bookToc('a', [outer, p4]), bookToc('b', [p5])]
+    const m = newMap()
+    m.placeBooks(books)
+    expect(m.placeOf('p3')).toEqual({ node: p3, parent: inner, bookIndex: 0, childIndex: 1 })
+    expect(m.placeOf('inner')).toEqual({ node: inner, parent: outer, bookIndex: 0, childIndex: 1 })
+    expect(m.placeOf('p4')).toEqual({ node: p4, parent: books[0], bookIndex: 0, childIndex: 1 })
+    expect(m.placeOf('p5')).toEqual({ node: p5, parent: books[1], bookIndex: 1, childIndex: 0 })
+    expect(m.placeOf('nope')).toBeUndefined()
+  })
+  it('finds a page that is in the ToC more than once where it first appears', () => {
+    const books = [bookToc('a', [subbook('s', [page('p1')]), page('p1')]), bookToc('b', [page('p1')])]
+    const m = newMap()
+    m.placeBooks(books)
+    expect(m.placeOf('p1')?.parent).toBe(books[0].tocTree[0])
+  })
+  it('follows the edits that are made in place', () => {
+    const [p1, p2] = [page('p1'), page('p2')]
+    const moved = subbook('moved', [p1])
+    const books = [bookToc('a', [page('p0'), moved]), bookToc('b', [p2])]
+    const m = newMap()
+    m.placeBooks(books)
+    books[0].tocTree = books[0].tocTree.filter(n => n !== moved)
+    m.place(books[0], 0)
+    books[1].tocTree.unshift(moved)
+    m.place(books[1], 1, true)
+    expect(m.placeOf('p1')).toEqual({ node: p1, parent: moved, bookIndex: 1, childIndex: 0 })
+    expect(m.placeOf('p2')?.childIndex).toBe(1)
+    books[1].tocTree = [p2]
+    m.unplace(moved)
+    m.place(books[1], 1)
+    expect(m.placeOf('p2')?.childIndex).toBe(0)
+    expect(m.placeOf('moved')).toBeUndefined()
+    expect(m.placeOf('p1')).toBeUndefined()
+    expect(m.placeOf('p0')?.childIndex).toBe(0)
+  })
+})
+
 describe('modifyToc()', () => {
   let manager = null as unknown as ModelManager
   let params = null as unknown as BooksAndOrphans
+  let tocUpdates = 0
   beforeEach(() => {
     const bookSlug = 'slug2'
     const pageId = 'm1234'
@@ -627,7 +1009,7 @@ describe('modifyToc()', () => {
       'modules/m1234/index.cnxml': pageMaker({})
     })
     const bundle = new Bundle(FS_PATH_HELPER, process.cwd())
-    manager = new ModelManager(bundle, conn, (p) => { params = p })
+    manager = new ModelManager(bundle, conn, (p) => { params = p; tocUpdates++ })
   })
   afterEach(() => { mockfs.restore() })
 
@@ -689,6 +1071,12 @@ describe('modifyToc()', () => {
     const tocNode = book.toc[0]
     expect(tocNode.type === TocNodeKind.Subbook && tocNode.title).toBe(newTitle)
   })
+  it('sends subbooks with only the fields of a ClientTocNode', async () => {
+    // A range loses its toJSON in structuredClone, so full sends and patches used to disagree on it
+    const t = getInner(0)
+    expect(Object.keys(t).sort()).toEqual(['children', 'type', 'value'])
+    expect(Object.keys(t.value).sort()).toEqual(['title', 'token'])
+  })
   it('Remove Subbook', async () => {
     const book = loadSuccess(first(loadSuccess(manager.bundle).books))
 
@@ -869,6 +1257,174 @@ describe('modifyToc()', () => {
     // Add another page for code coverage reasons
     await manager.createAncillary(bookIndex, undefined, 'TEST_TITLE2')
   })
+  describe('modifyTocs()', () => {
+    const sinon = SinonRoot.createSandbox()
+    afterEach(() => { sinon.restore() })
+    it('writes each collection once and sends one ToC update for the whole batch', async () => {
+      const book = loadSuccess(first(loadSuccess(manager.bundle).books))
+      const bookIndex = 0
+      const collectionPath = path.resolve('collections/slug2.collection.xml')
+      const writeFileSpy = sinon.spy(fs.promises, 'writeFile')
+      const subbookToken = getInner(bookIndex).value.token
+      const pageToken = getLeaf(bookIndex).value.token
+      tocUpdates = 0
+      await manager.modifyTocs([
+        { type: TocModificationKind.SubbookRename, newTitle: 'NEW_TITLE', nodeToken: subbookToken, bookIndex },
+        { type: TocModificationKind.PageRename, newTitle: 'NEW_PAGE_TITLE', nodeToken: pageToken, bookIndex },
+        { type: TocModificationKind.Move, nodeToken: pageToken, newParentToken: undefined, newChildIndex: 1, bookIndex },
+        { type: TocNodeKind.Subbook, title: 'TEST_TITLE', bookIndex, parentNodeToken: undefined },
+        { type: TocNodeKind.Page, title: 'TEST_PAGE', bookIndex, parentNodeToken: undefined },
+        { type: TocNodeKind.Page, title: 'TEST_PAGE2', bookIndex, parentNodeToken: undefined }
+      ])
+      expect(writeFileSpy.getCalls().filter(c => path.resolve(String(c.args[0])) === collectionPath).length).toBe(1)
+      // The collection, the renamed page and the 2 new pages
+      expect(writeFileSpy.callCount).toBe(4)
+      expect(tocUpdates).toBe(1)
+      expect(book.toc.map(n => n.type)).toEqual([TocNodeKind.Page, TocNodeKind.Page, TocNodeKind.Subbook, TocNodeKind.Subbook, TocNodeKind.Page])
+      expect(book.toc.map(n => n.type === TocNodeKind.Subbook ? n.title : n.page.title)).toEqual(['TEST_PAGE2', 'TEST_PAGE', 'TEST_TITLE', 'NEW_TITLE', 'NEW_PAGE_TITLE'])
+    })
+    it('writes nothing when one of the events fails', async () => {
+      const book = loadSuccess(first(loadSuccess(manager.bundle).books))
+      const bookIndex = 0
+      const writeFileSpy = sinon.spy(fs.promises, 'writeFile')
+      const subbookToken = getInner(bookIndex).value.token
+      const pageCount = manager.bundle.allPages.all.size
+      await expect(manager.modifyTocs([
+        { type: TocModificationKind.SubbookRename, newTitle: 'NEW_TITLE', nodeToken: subbookToken, bookIndex },
+        { type: TocNodeKind.Page, title: 'TEST_PAGE', bookIndex, parentNodeToken: undefined },
+        { type: TocModificationKind.Remove, nodeToken: 'not-a-token', bookIndex }
+      ])).rejects.toThrow(/not yet implemented/)
+      expect(writeFileSpy.callCount).toBe(0)
+      // The page that would have been created is not in the bundle
+      expect(manager.bundle.allPages.all.size).toBe(pageCount)
+      // The in-memory ToC was put back so later events see what is on disk
+      await manager.createSubbook(bookIndex, undefined, 'TEST_TITLE')
+      expect(book.toc.map(n => n.type === TocNodeKind.Subbook && n.title)).toEqual(['TEST_TITLE', 'subbook'])
+    })
+    it('puts the ToC back when a file cannot be written', async () => {
+      const book = loadSuccess(first(loadSuccess(manager.bundle).books))
+      const bookIndex = 0
+      const subbookToken = getInner(bookIndex).value.token
+      const pageCount = manager.bundle.allPages.all.size
+      sinon.stub(fs.promises, 'writeFile').rejects(new Error('Disk full'))
+      await expect(manager.modifyTocs([
+        { type: TocModificationKind.SubbookRename, newTitle: 'NEW_TITLE', nodeToken: subbookToken, bookIndex },
+        { type: TocNodeKind.Page, title: 'TEST_PAGE', bookIndex, parentNodeToken: undefined }
+      ])).rejects.toThrow(/Disk full/)
+      expect(manager.bundle.allPages.all.size).toBe(pageCount)
+      sinon.restore()
+      await manager.createSubbook(bookIndex, undefined, 'TEST_TITLE')
+      expect(book.toc.map(n => n.type === TocNodeKind.Subbook && n.title)).toEqual(['TEST_TITLE', 'subbook'])
+    })
+    it('keeps the token of a subbook when another one is added before it', async () => {
+      const book = loadSuccess(first(loadSuccess(manager.bundle).books))
+      const bookIndex = 0
+      const subbookToken = getInner(bookIndex).value.token
+      await manager.createSubbook(bookIndex, undefined, 'TEST_TITLE')
+      const [added, moved] = params.books[bookIndex].tocTree
+      expect(added.value.token).not.toBe(subbookToken)
+      expect(moved.value.token).toBe(subbookToken)
+      // A client that has not seen the new subbook yet still renames the one it meant
+      await manager.modifyTocs([{ type: TocModificationKind.SubbookRename, newTitle: 'NEW_TITLE', nodeToken: subbookToken, bookIndex }])
+      expect(book.toc.map(n => n.type === TocNodeKind.Subbook && n.title)).toEqual(['TEST_TITLE', 'NEW_TITLE'])
+    })
+  })
+})
+
+describe('BookTocs notifications', () => {
+  const sinon = SinonRoot.createSandbox()
+  afterEach(() => { sinon.restore() })
+  it('sends the whole ToC once and then patches that keep the client in sync', () => {
+    const sendNotificationStub = sinon.stub(conn, 'sendNotification')
+    const bundle = makeBundle()
+    const manager = new ModelManager(bundle, conn)
+    bundle.load(bundleMaker({ books: ['slug1'] }))
+    const book = first(bundle.books)
+    const pagePath = (id: string) => join(FS_PATH_HELPER, PathKind.COLLECTION_TO_MODULEID, book.absPath, id)
+    const loadPage = (id: string, title: string) => { bundle.allPages.getOrAdd(pagePath(id)).load(pageMaker({ title })) }
+    book.load(bookMaker({ toc: [{ title: 'Unit 1', children: ['m1', 'm2'] }, 'm3', { title: 'Unit 2', children: ['m4'] }] }))
+    ;['m1', 'm2', 'm3', 'm4', 'm5'].forEach(id => { loadPage(id, `Title ${id}`) })
+
+    // What the client would have after applying everything it was sent
+    let client = undefined as unknown as VersionedBooksAndOrphans
+    let fullSends = 0
+    const sent = () => sendNotificationStub.getCalls().map(c => c.args as unknown as [string, unknown])
+    const receive = () => {
+      sent().forEach(([method, params]) => {
+        if (method === ExtensionServerNotification.BookTocs) {
+          client = JSON.parse(JSON.stringify(params))
+          fullSends++
+        } else if (method === ExtensionServerNotification.BookTocsPatch) {
+          const patch = params as BookTocsPatch
+          expect(patch.baseVersion).toBe(client.version)
+          applyBookTocsPatch(client, JSON.parse(JSON.stringify(patch.ops)))
+          client.version = patch.version
+        }
+      })
+      sendNotificationStub.resetHistory()
+      expect(client).toEqual(JSON.parse(JSON.stringify(manager.bookTocsSnapshot)))
+    }
+    receive()
+    expect(fullSends).toBeGreaterThan(0)
+    fullSends = 0
+    expect(client.orphans.map(o => o.title)).toEqual(['Title m5'])
+
+    // Retitling a page only sends the new title
+    loadPage('m2', 'Renamed')
+    const [[, retitle]] = sent()
+    expect(retitle).toEqual({ baseVersion: client.version, version: client.version + 1, ops: [{ kind: 'BookTocsPatchKind.Retitle', token: `servertoken:page:${pagePath('m2')}`, title: 'Renamed' }] })
+    receive()
+
+    // Moving, adding and removing pages and subbooks
+    book.load(bookMaker({ toc: [{ title: 'Unit 1', children: ['m2', 'm5', 'm1'] }, { title: 'Unit 2 renamed', children: [] }, { title: 'Unit 3', children: ['m4'] }] }))
+    receive()
+    book.load(bookMaker({ toc: ['m3', { title: 'Unit 1', children: ['m1', 'm1'] }, { title: 'Unit 2', children: ['m4', 'm2'] }] }))
+    receive()
+    const unchanged = sendNotificationStub.callCount
+    book.load(bookMaker({ toc: ['m3', { title: 'Unit 1', children: ['m1', 'm1'] }, { title: 'Unit 2', children: ['m4', 'm2'] }] }))
+    expect(sendNotificationStub.callCount).toBe(unchanged)
+    expect(fullSends).toBe(0)
+
+    // Editing the book itself sends everything again
+    book.load(bookMaker({ title: 'New book title', toc: ['m3'] }))
+    receive()
+    expect(fullSends).toBe(1)
+  })
+
+  it('keeps the tokens of subbooks when the collection is edited', () => {
+    sinon.stub(conn, 'sendNotification')
+    const bundle = makeBundle()
+    const manager = new ModelManager(bundle, conn)
+    bundle.load(bundleMaker({ books: ['slug1'] }))
+    const book = first(bundle.books)
+    const tokens = () => new Map(manager.bookTocsSnapshot.books[0].tocTree.map(n => [n.value.title, n.value.token]))
+    book.load(bookMaker({ toc: [{ title: 'Unit 1', children: [] }, { title: 'Unit 2', children: [] }] }))
+    const before = tokens()
+    book.load(bookMaker({ toc: [{ title: 'Unit 0', children: [] }, { title: 'Unit 1', children: [] }, { title: 'Unit 2', children: [] }] }))
+    const after = tokens()
+    expect(after.get('Unit 1')).toBe(before.get('Unit 1'))
+    expect(after.get('Unit 2')).toBe(before.get('Unit 2'))
+    expect([...before.values()]).not.toContain(after.get('Unit 0'))
+    // Removed tokens are not handed out again
+    book.load(bookMaker({ toc: [{ title: 'Unit 2', children: [] }] }))
+    book.load(bookMaker({ toc: [{ title: 'Unit 3', children: [] }, { title: 'Unit 2', children: [] }] }))
+    expect([...after.values()]).not.toContain(tokens().get('Unit 3'))
+    expect(tokens().get('Unit 2')).toBe(before.get('Unit 2'))
+  })
+  it('rejects ToC edits made against an older version', async () => {
+    sinon.stub(conn, 'sendNotification')
+    const bundle = makeBundle()
+    const manager = new ModelManager(bundle, conn)
+    bundle.load(bundleMaker({ books: ['slug1'] }))
+    const book = first(bundle.books)
+    book.load(bookMaker({ toc: [{ title: 'Unit 1', children: [] }] }))
+    const { version, books } = manager.bookTocsSnapshot
+    const nodeToken = books[0].tocTree[0].value.token
+    book.load(bookMaker({ toc: [{ title: 'Unit 0', children: [] }, { title: 'Unit 1', children: [] }] }))
+    expect(manager.bookTocsSnapshot.version).toBeGreaterThan(version)
+    await expect(manager.modifyTocs([{ type: TocModificationKind.SubbookRename, newTitle: 'Renamed', nodeToken, bookIndex: 0 }], version)).rejects.toThrow(/changed since/)
+    expect(book.toc.map(n => n.type === TocNodeKind.Subbook && n.title)).toEqual(['Unit 0', 'Unit 1'])
+  })
 })
 
 // ------------ Stubs ------------
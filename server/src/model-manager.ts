@@ -1,25 +1,34 @@
 import { v4 as uuid4 } from 'uuid'
-import { glob } from 'glob'
 import fs from 'fs'
+import { performance } from 'perf_hooks'
 import * as path from 'path'
 import I from 'immutable'
 import * as Quarx from 'quarx'
-import { type Connection } from 'vscode-languageserver'
+import { type CancellationToken, type Connection } from 'vscode-languageserver'
 import { CompletionItem, CompletionItemKind, Diagnostic, DocumentLink, FileChangeType, type FileEvent, TextEdit } from 'vscode-languageserver-protocol'
 import { URI, Utils } from 'vscode-uri'
-import { type BookToc, type ClientTocNode, type TocModification, TocModificationKind, type TocSubbook, type ClientSubbookish, type ClientPageish, TocNodeKind, type Token, BookRootNode, type TocPage } from '../../common/src/toc'
-import { type Opt, expectValue, type Position, inRange, type Range, equalsArray, selectOne } from './model/utils'
+import { type BookToc, type ClientTocNode, type TocModification, TocModificationKind, type TocSubbook, type ClientSubbookish, type ClientPageish, TocNodeKind, type Token, BookRootNode, type TocPage, type TocEvent } from '../../common/src/toc'
+import { type Opt, expectValue, type Position, inRange, type Range, equalsArray, selectOne, forEachLimit } from './model/utils'
 import { type Bundle } from './model/bundle'
-import { PageLinkKind, PageNode } from './model/page'
+import { PageLinkKind, PageNode, type PageFacts } from './model/page'
 import { type Fileish, type ValidationResponse } from './model/fileish'
-import { JobRunner } from './job-runner'
-import { equalsBookToc, equalsClientPageishArray, fromBook, fromPage, IdMap, renameTitle, toString } from './book-toc-utils'
-import { type BooksAndOrphans, DiagnosticSource, ExtensionServerNotification } from '../../common/src/requests'
+import { JobPriority, JobRunner } from './job-runner'
+import { type ParserPool } from './parser-pool'
+import { extractFacts } from './parse-worker'
+import { type FactCache, type FileStat } from './fact-cache'
+import { diffBooksAndOrphans, equalsBookToc, equalsClientPageishArray, fromBook, fromPage, renameTitle, SubbookTokens, TocIdMap, toString, writeCollection } from './book-toc-utils'
+import { type BooksAndOrphans, type BookTocsPatch, DiagnosticSource, EMPTY_BOOKS_AND_ORPHANS, type EnsureIdsSummary, ExtensionServerNotification, type VersionedBooksAndOrphans } from '../../common/src/requests'
 import { type BookNode, type TocSubbookWithRange } from './model/book'
 import { mkdirp } from 'fs-extra'
 import { DOMParser, XMLSerializer } from 'xmldom'
 import { H5PExercise } from './model/h5p-exercise'
-import { walkDir, readdirSync, isDirectorySync, followSymbolicLinks } from './fs-utils'
+import { ResourceNode } from './model/resource'
+import { CompletionIndex } from './completion-index'
+import { type Cancellable, findFiles, followSymbolicLinks, readdirAsync, walkDirAsync } from './fs-utils'
+import { idFixer, spliceIds } from './fix-document-ids'
+import { LatencyHistogram } from './latency-histogram'
+import { DirectoryListings } from './directory-listings'
+import { rescanPage, scanPage, type ScannedPage } from './model/page-scanner'
 
 // Note: `[^/]+` means "All characters except slash"
 const IMAGE_RE = /\/media\/[^/]+\.[^.]+$/
@@ -28,21 +37,89 @@ const BOOK_RE = /\/collections\/[^/]+\.collection\.xml$/
 
 const PATH_SEP = path.sep
 
-interface NodeAndParent { node: ClientTocNode, parent: BookToc | ClientTocNode }
+const PAGE_TEMPLATE = `
+<document xmlns="http://cnx.rice.edu/cnxml">
+  <title/>
+  <metadata xmlns:md="http://cnx.rice.edu/mdml">
+    <md:title/>
+    <md:content-id/>
+    <md:uuid/>
+  </metadata>
+  <content>
+  </content>
+</document>`.trim()
+
+const ANCILLARY_TEMPLATE = `
+<document xmlns="http://cnx.rice.edu/cnxml" class="super">
+  <title/>
+  <metadata xmlns:md="http://cnx.rice.edu/mdml">
+    <md:title/>
+    <md:content-id/>
+    <md:uuid/>
+    <md:super>
+    </md:super>
+  </metadata>
+  <content class="super">
+  </content>
+</document>`.trim()
+
+// ToC changes that were made in memory and still have to be saved
+interface TocTransaction {
+  books: Set<BookToc>
+  // By fsPath. Created or renamed pages. A created page has no PageNode until
+  // it is written so a transaction that fails leaves nothing in the bundle
+  pages: Map<string, { page: Opt<PageNode>, content: string }>
+}
+// An edit to an open document that was not parsed yet (see scheduleFileContents)
+interface PendingSync {
+  version: number
+  contents: string
+  editedAt: number // performance.now() when the edit came in
+  timer: Opt<NodeJS.Timeout> // Undefined once the parse started
+  parsed: Opt<Promise<void>> // Set once the parse started
+}
+interface CacheKey { fsPath: string, stat: FileStat }
 interface Autocompleter {
   hasLinkNearCursor: (page: PageNode, cursor: Position) => boolean
-  getRange: (cursor: Position, content: string) => Range | undefined
-  getCompletionItems: (page: PageNode, range: Range) => Promise<CompletionItem[]>
+  getRange: (cursor: Position, line: string) => Range | undefined
+  getCompletionItems: (page: PageNode, range: Range, typed: string) => Promise<CompletionItem[]>
 }
-function childrenOf(n: ClientTocNode) {
-  /* istanbul ignore else */
-  if (n.type === TocNodeKind.Subbook) {
+function childrenOf(n: ClientTocNode | BookToc) {
+  if (n.type === BookRootNode.Singleton) {
+    return n.tocTree
+  } else /* istanbul ignore else */ if (n.type === TocNodeKind.Subbook) {
     return n.children
   } else {
     throw new Error('BUG: Unreachable code')
   }
 }
 
+// The line without splitting the whole document into lines
+function lineAt(content: string, line: number) {
+  let start = 0
+  for (let i = 0; i < line; i++) {
+    const newline = content.indexOf('\n', start)
+    if (newline < 0) return ''
+    start = newline + 1
+  }
+  const end = content.indexOf('\n', start)
+  return content.substring(start, end < 0 ? content.length : end)
+}
+
+// What is left to match after the part of `typed` that every candidate starts with
+function afterCommonPrefix(typed: string, prefix: string) {
+  if (typed.startsWith(prefix)) return typed.substring(prefix.length)
+  return prefix.startsWith(typed) ? '' : typed
+}
+
+function updateIndex<T>(index: CompletionIndex<T>, item: T, isIncluded: boolean) {
+  if (isIncluded) {
+    index.add(item)
+  } else {
+    index.delete(item)
+  }
+}
+
 function loadedAndExists(n: Fileish) {
   return n.isLoaded && n.exists
 }
@@ -79,22 +156,22 @@ export function pageToModuleId(page: PageNode) {
   return path.basename(path.dirname(page.absPath))
 }
 
-// https://stackoverflow.com/a/35008327
-const checkFileExists = async (s: string): Promise<boolean> => {
+const statOrNull = async (s: string): Promise<Opt<fs.Stats>> => {
   try {
-    await fs.promises.access(s, fs.constants.F_OK)
-    return true
+    return await fs.promises.stat(s)
   } catch {
-    return false
+    return undefined
   }
 }
 
-function walkDirectorySync(start: string, onError: (err: Error) => void) {
+async function * walkDirectory(start: string, onError: (err: Error) => void, token: Cancellable) {
   const shouldWalk = followSymbolicLinks()
-  const readdir = readdirSync
-  return walkDir({ readdir, shouldWalk, onError }, start)
+  const realpath = await fs.promises.realpath(start).catch(() => start) // Gone already? onError hears about it
+  yield * walkDirAsync({ readdir: readdirAsync, shouldWalk, onError }, { path: start, realpath }, token)
 }
 
+const isVisible = (name: string) => !name.startsWith('.')
+
 function toStringFileChangeType(t: FileChangeType) {
   switch (t) {
     case FileChangeType.Changed: return 'CHANGED'
@@ -135,39 +212,83 @@ export class ModelManager {
   public static debug: (...args: any[]) => void = console.debug
 
   public readonly jobRunner = new JobRunner()
+  // When set, pages and books are parsed in worker threads
+  public parserPool: Opt<ParserPool>
+  // When set, the facts of unchanged pages and books are reused between runs
+  public factCache: Opt<FactCache>
   private readonly openDocuments = new Map<string, string>()
+  // The newest edit of each open document that is waiting to be parsed
+  private readonly pendingSyncs = new Map<string, PendingSync>()
+  // The last version of each open page that scanned, to rescan only what an edit changed
+  private readonly scannedPages = new Map<string, ScannedPage>()
+  // The directories that are being searched for new files, stopped when they are removed
+  private readonly directoryWalks = new Map<{ isCancellationRequested: boolean }, string>()
+  private readonly directoryListings = new DirectoryListings()
+  // Open documents are parsed again once no edit came in for this long (ms)
+  public static documentSyncDelay = 150
+  // From an edit coming in to the diagnostics of that version being sent
+  public readonly documentSyncLatency = new LatencyHistogram()
   private readonly errorHashesByPath = new Map<string, I.Set<number>>()
+  // Nodes whose diagnostics may have changed since sendAllDiagnostics last ran
+  private readonly staleDiagnostics = new Set<Fileish>()
+  // Revalidate every node in sendAllDiagnostics instead of only the stale ones
+  public static fullDiagnosticsSweep = false
   private loadOrphansTask: Promise<void> | undefined
   private bookTocs: BookToc[] = []
-  private tocIdMap = new IdMap<string, TocSubbookWithRange | PageNode>(x => {
+  // Settles once the running ToC transaction (see modifyTocs) is saved
+  private tocTransactions: Promise<void> = Promise.resolve()
+  // What the client was last sent (see publishBookTocs)
+  private sentTocs: Opt<VersionedBooksAndOrphans>
+  // Built on the first autocomplete and then kept up to date as nodes become orphans or stop being ones
+  private completionIndexes: Opt<{ resources: CompletionIndex<ResourceNode>, h5p: CompletionIndex<H5PExercise> }>
+  // Autocomplete returns at most this many items of each kind
+  public static autocompleteLimit = 100
+  // ensureIds reads, fixes and writes at most this many pages at a time
+  public static ensureIdsConcurrency = 8
+  private readonly subbookTokens = new SubbookTokens()
+  private tocIdMap = new TocIdMap(x => {
     /* istanbul ignore next */
     throw new Error('BUG: has not been set yet')
   })
 
   constructor(public bundle: Bundle, private readonly conn: Connection, bookTocHandler?: (params: BooksAndOrphans) => void) {
-    const defaultHandler = (params: BooksAndOrphans) => { conn.sendNotification(ExtensionServerNotification.BookTocs, params) }
+    const defaultHandler = (params: BooksAndOrphans) => { this.publishBookTocs(params) }
     const handler = bookTocHandler ?? defaultHandler
+    bundle.onChange(affected => { affected.forEach(n => this.staleDiagnostics.add(n)) })
+    bundle.onOrphanChange((node, isOrphan) => {
+      const indexes = this.completionIndexes
+      if (indexes === undefined) return
+      if (node instanceof ResourceNode) {
+        updateIndex(indexes.resources, node, isOrphan)
+      } else if (node instanceof H5PExercise) {
+        updateIndex(indexes.h5p, node, isOrphan)
+      }
+    })
     // BookTocs
     const computeFn = () => {
-      let idCounter = 0
-      const tocIdMap = new IdMap<string, TocSubbookWithRange | PageNode>((v) => {
+      let subbookTokens = new Map<TocSubbookWithRange, string>()
+      const tocIdMap = new TocIdMap((v) => {
         if (v instanceof PageNode) {
           return `servertoken:page:${v.absPath}`
         } else {
-          return `servertoken:inner:${idCounter++}:${v.title}`
+          return expectValue(subbookTokens.get(v), 'BUG: Subbook is not in any book')
         }
       })
       if (loadedAndExists(this.bundle)) {
+        const books = this.bundle.books.filter(loadedAndExists).toArray()
+        subbookTokens = this.subbookTokens.assign(books)
+        const bookTocs = books.map(b => fromBook(tocIdMap, b))
+        tocIdMap.placeBooks(bookTocs)
         return {
           tocIdMap,
-          books: this.bundle.books.filter(loadedAndExists).toArray().map(b => fromBook(tocIdMap, b)),
+          books: bookTocs,
           orphans: this.orphanedPages.filter(loadedAndExists).toArray().map(p => fromPage(tocIdMap, p).value)
         }
       }
       ModelManager.debug('[MODEL_MANAGER] bundle file is not loaded yet or does not exist')
       return { tocIdMap, books: [], orphans: [] }
     }
-    const sideEffectFn = (v: BooksAndOrphans & { tocIdMap: IdMap<string, TocSubbookWithRange | PageNode> }) => {
+    const sideEffectFn = (v: BooksAndOrphans & { tocIdMap: TocIdMap }) => {
       this.tocIdMap = v.tocIdMap
       this.bookTocs = v.books
       const params: BooksAndOrphans = {
@@ -180,31 +301,47 @@ export class ModelManager {
     memoizeTempValue(equalsBooksAndOrphans, computeFn, sideEffectFn)
   }
 
+  // Sends only what changed since the last time, or everything the first time
+  // and whenever the books themselves change
+  private publishBookTocs(next: BooksAndOrphans) {
+    const prev = this.sentTocs
+    const ops = prev === undefined ? undefined : diffBooksAndOrphans(prev, next)
+    if (ops !== undefined && ops.length === 0) return
+    const version = (prev?.version ?? 0) + 1
+    // A copy because modifyTocs edits this.bookTocs in place before writing the book
+    this.sentTocs = { ...structuredClone(next), version }
+    if (prev === undefined || ops === undefined) {
+      this.conn.sendNotification(ExtensionServerNotification.BookTocs, this.sentTocs)
+    } else {
+      const patch: BookTocsPatch = { baseVersion: prev.version, version, ops }
+      this.conn.sendNotification(ExtensionServerNotification.BookTocsPatch, patch)
+    }
+  }
+
+  // For a client that missed a patch
+  public get bookTocsSnapshot(): VersionedBooksAndOrphans {
+    return this.sentTocs ?? { ...EMPTY_BOOKS_AND_ORPHANS, version: 0 }
+  }
+
   public get allPages() {
     return this.bundle.allPages.all
   }
 
+  // These are kept up to date by the Bundle as books and pages load (see OrphanIndex)
   public get orphanedBooks() {
-    const loadedBooks = this.bundle.allBooks.all.filter((n) => n.isLoaded)
-    const referencedBooks = this.bundle.books
-    return !this.bundle.exists ? loadedBooks : loadedBooks.subtract(referencedBooks)
+    return this.bundle.orphanedBooks
   }
 
   public get orphanedPages() {
-    const books = this.bundle.books.filter(loadedAndExists)
-    return this.bundle.allPages.all.filter((n) => n.isLoaded).subtract(books.flatMap(b => b.pages))
+    return this.bundle.orphanedPages
   }
 
   public get orphanedResources() {
-    const books = this.bundle.books.filter(loadedAndExists)
-    const pages = books.flatMap(b => b.pages).filter(loadedAndExists)
-    return this.bundle.allResources.all.filter((n) => n.isLoaded).subtract(pages.flatMap(p => p.resources))
+    return this.bundle.orphanedResources
   }
 
   public get orphanedH5P() {
-    const books = this.bundle.books.filter(loadedAndExists)
-    const pages = books.flatMap(b => b.pages).filter(loadedAndExists)
-    return this.bundle.allH5P.all.filter((n) => n.isLoaded).subtract(pages.flatMap(p => p.h5p))
+    return this.bundle.orphanedH5P
   }
 
   public get orphanedNodes() {
@@ -233,11 +370,23 @@ export class ModelManager {
       this.loadOrphansTask = (async () => {
         await this.loadEnoughForToc()
         const { pagesRoot, mediaRoot, booksRoot, publicRoot } = this.bundle.paths
-        // Add all the orphaned Images/Pages/Books dangling around in the filesystem without loading them
-        const files = glob.sync(`{${pagesRoot}/*/*.cnxml,${mediaRoot}/*.*,${booksRoot}/*.collection.xml,${publicRoot}/*/h5p.json}`, { cwd: URI.parse(this.bundle.workspaceRootUri).fsPath, absolute: true })
-        Quarx.batch(() => {
-          files.forEach(absPath => expectValue(findOrCreateNode(this.bundle, this.bundle.pathHelper.canonicalize(absPath)), `BUG? We found files that the bundle did not recognize: ${absPath}`))
-        })
+        const root = URI.parse(this.bundle.workspaceRootUri).fsPath
+        // Add all the orphaned Images/Pages/Books dangling around in the filesystem without loading them.
+        // The glob {modules/*/*.cnxml,media/*.*,collections/*.collection.xml,interactives/*/h5p.json}, read
+        // a batch at a time so the server keeps answering requests on big repositories
+        const found = [
+          findFiles(path.join(root, pagesRoot), [isVisible, n => isVisible(n) && n.endsWith('.cnxml')]),
+          findFiles(path.join(root, mediaRoot), [n => isVisible(n) && n.includes('.')]),
+          findFiles(path.join(root, booksRoot), [n => isVisible(n) && n.endsWith('.collection.xml')]),
+          findFiles(path.join(root, publicRoot), [isVisible, n => n === 'h5p.json'])
+        ]
+        for (const batches of found) {
+          for await (const files of batches) {
+            Quarx.batch(() => {
+              files.forEach(absPath => expectValue(findOrCreateNode(this.bundle, this.bundle.pathHelper.canonicalize(absPath)), `BUG? We found files that the bundle did not recognize: ${absPath}`))
+            })
+          }
+        }
         // Load everything before we can know where the orphans are
         this.performInitialValidation()
         await this.jobRunner.done()
@@ -252,7 +401,9 @@ export class ModelManager {
 
   private sendAllDiagnostics() {
     ModelManager.debug('Sending All Diagnostics')
-    for (const node of this.bundle.allNodes) {
+    const nodes = ModelManager.fullDiagnosticsSweep ? this.bundle.allNodes : I.Set(this.staleDiagnostics)
+    this.staleDiagnostics.clear()
+    for (const node of nodes) {
       if (node.isLoaded) {
         const validationErrors = node.validationErrors
         const errorHashes = validationErrors.errors.map(I.hash)
@@ -271,6 +422,8 @@ export class ModelManager {
 
     // Could be adding an Image/Page/Book, or removing/adding a directory, or adding some other file
     ModelManager.debug(`[FILESYSTEM_EVENT] Start ${toStringFileChangeType(type)} ${uri}`)
+    if (type !== FileChangeType.Changed) this.directoryListings.forget(URI.parse(uri).fsPath)
+    if (type === FileChangeType.Deleted) this.factCache?.delete(URI.parse(uri).fsPath)
 
     if (type === FileChangeType.Created) {
       // Check if we are adding an Image/Page/Book
@@ -286,19 +439,24 @@ export class ModelManager {
         relatedNodes.push(node)
       } else {
         const { fsPath } = URI.parse(uri)
-        if (!isDirectorySync(fsPath)) {
+        if ((await statOrNull(fsPath))?.isDirectory() !== true) {
           // No, we are adding something unknown. Ignore
           ModelManager.debug('[FILESYSTEM_EVENT] New path did not match anything we understand. Ignoring', uri)
           return I.Set()
         }
         ModelManager.debug('[FILESYSTEM_EVENT] Searching directory', fsPath)
         const onError = (err: Error) => { ModelManager.debug('[MODEL_MANAGER]', err) }
-        for (const dirent of walkDirectorySync(fsPath, onError)) {
-          if (!dirent.isFile()) continue
-          const node = await tryGetUpdatedNode(bundle, dirent.path)
-          if (node === undefined) continue
-          relatedNodes.push(node)
+        const walk = { isCancellationRequested: false }
+        this.directoryWalks.set(walk, uri)
+        try {
+          for await (const dirents of walkDirectory(fsPath, onError, walk)) {
+            const nodes = await Promise.all(dirents.filter(d => d.isFile()).map(async d => await tryGetUpdatedNode(bundle, d.path)))
+            nodes.forEach(node => { if (node !== undefined) relatedNodes.push(node) })
+          }
+        } finally {
+          this.directoryWalks.delete(walk)
         }
+        if (walk.isCancellationRequested) ModelManager.debug('[FILESYSTEM_EVENT] Stopped searching the removed directory', fsPath)
       }
       this.sendAllDiagnostics()
       return I.Set(relatedNodes)
@@ -316,6 +474,9 @@ export class ModelManager {
       // Now, we might be deleting a whole directory.
       // Remove anything inside that directory
       ModelManager.debug('[FILESYSTEM_EVENT] Removing everything with this URI (including subdirectories if they exist)', uri)
+      this.directoryWalks.forEach((walkUri, walk) => {
+        if (walkUri === uri || walkUri.startsWith(`${uri}${PATH_SEP}`)) walk.isCancellationRequested = true
+      })
 
       const removedNodes = I.Set<Fileish>().withMutations(s => {
         const markRemoved = <T extends Fileish>(n: T) => {
@@ -370,7 +531,94 @@ export class ModelManager {
     this.openDocuments.set(absPath, contents)
   }
 
+  // Like updateFileContents but for every edit in an editor. Each document
+  // is parsed only once the edits stop (see documentSyncDelay), a newer edit
+  // drops the parse of an older one even when it already started, and
+  // diagnostics are only sent for the newest version.
+  public scheduleFileContents(absPath: string, contents: string, version: number) {
+    this.openDocuments.set(absPath, contents) // What autocomplete and links read right away
+    const prev = this.pendingSyncs.get(absPath)
+    if (prev?.timer !== undefined) clearTimeout(prev.timer)
+    const sync: PendingSync = { version, contents, editedAt: performance.now(), timer: undefined, parsed: undefined }
+    sync.timer = setTimeout(() => { this.startSync(absPath, sync) }, ModelManager.documentSyncDelay)
+    this.pendingSyncs.set(absPath, sync)
+  }
+
+  // Parses the edits to an open document that are still waiting out
+  // documentSyncDelay right away. Requests that read the facts of the page
+  // (autocomplete, document links) call this so they see what was just typed.
+  public async flushDocument(absPath: string) {
+    let sync = this.pendingSyncs.get(absPath)
+    while (sync !== undefined) {
+      if (sync.timer !== undefined) {
+        clearTimeout(sync.timer)
+        this.startSync(absPath, sync)
+      }
+      await sync.parsed
+      // An edit that came in during the parse replaced it
+      const next = this.pendingSyncs.get(absPath)
+      sync = next !== sync ? next : undefined
+    }
+  }
+
+  private startSync(absPath: string, sync: PendingSync) {
+    sync.timer = undefined
+    // Rethrowing would be an unhandled rejection, which stops the server
+    sync.parsed = this.syncDocument(absPath, sync.contents, sync).catch(err => {
+      console.error('[DOC_UPDATER] Could not update', absPath, err)
+    })
+  }
+
+  private async syncDocument(absPath: string, contents: string, sync: PendingSync) {
+    const node = findOrCreateNode(this.bundle, absPath)
+    if (node === undefined) {
+      ModelManager.debug('[DOC_UPDATER] Could not find model for this file so ignoring update events', absPath)
+      this.pendingSyncs.delete(absPath)
+      return
+    }
+    const kind = node.factsKind
+    const scanned = node instanceof PageNode ? this.scanOpenPage(absPath, contents) : undefined
+    // Off the main thread when there are parser threads. The XML errors are
+    // in the facts so a failure here is a bug in the worker; parse it here then
+    const facts = scanned !== undefined
+      ? { facts: scanned.facts }
+      : kind !== undefined && this.parserPool !== undefined
+        ? await this.parserPool.parse(kind, contents).catch(() => undefined)
+        : undefined
+    // Superseded by a newer edit or the document was closed
+    if (this.pendingSyncs.get(absPath) !== sync) return
+    this.pendingSyncs.delete(absPath)
+    ModelManager.debug('[DOC_UPDATER] Updating contents of', node.workspacePath, 'version', sync.version)
+    if (facts !== undefined) {
+      node.loadFacts(facts)
+    } else {
+      node.load(contents)
+    }
+    this.sendFileDiagnostics(node)
+    this.documentSyncLatency.record(performance.now() - sync.editedAt)
+    if (this.documentSyncLatency.count % 100 === 0) {
+      ModelManager.debug(`[DOC_UPDATER] Edit to diagnostics latency: ${this.documentSyncLatency.toString()}`)
+    }
+  }
+
+  // An edit inside one element of a page only scans that element again (see
+  // rescanPage). Pages the scanner cannot handle are parsed like before.
+  private scanOpenPage(absPath: string, contents: string) {
+    const prev = this.scannedPages.get(absPath)
+    const scanned = (prev !== undefined ? rescanPage(prev, contents) : undefined) ?? scanPage(contents)
+    if (scanned !== undefined) {
+      this.scannedPages.set(absPath, scanned)
+    } else {
+      this.scannedPages.delete(absPath)
+    }
+    return scanned
+  }
+
   public closeDocument(absPath: string) {
+    const pending = this.pendingSyncs.get(absPath)
+    if (pending?.timer !== undefined) clearTimeout(pending.timer)
+    this.pendingSyncs.delete(absPath)
+    this.scannedPages.delete(absPath)
     this.openDocuments.delete(absPath)
   }
 
@@ -385,25 +633,64 @@ export class ModelManager {
       return unsavedContents
     }
     const { fsPath } = URI.parse(uri)
-    if (await checkFileExists(fsPath)) {
-      const stat = await fs.promises.stat(fsPath)
-      if (stat.isFile()) { // Example: <image src=""/> resolves to 'modules/m123' which is a directory.
-        return ['.jpg', '.png'].some((ext) => uri.endsWith(ext))
-          ? '<fakeimagedata>'
-          : await fs.promises.readFile(fsPath, 'utf-8')
-      }
+    // Images, iframes and H5P manifests only need to know that the file is there
+    if (!node.readsContent) {
+      return await this.directoryListings.isFile(fsPath) ? '' : undefined
+    }
+    const stat = await statOrNull(fsPath)
+    if (stat?.isFile() === true) { // Example: <image src=""/> resolves to 'modules/m123' which is a directory.
+      return await fs.promises.readFile(fsPath, 'utf-8')
     }
   }
 
   private async readAndLoad(node: Fileish) {
     if (node.isLoaded) { return }
+    // Stat before reading. If the file changes in between, the cache entry
+    // has the old mtime and is checked against the contents next time
+    const key = await this.cacheKey(node)
+    // Warm start: files that did not change are loaded from the cache without even reading them
+    if (key !== undefined && this.loadFromCache(node, key)) { return }
     const fileContent = await this.readOrNull(node)
-    node.load(fileContent)
+    await this.loadContents(node, fileContent, key)
   }
 
   private async readAndUpdate(node: Fileish) {
+    const key = await this.cacheKey(node)
     const fileContent = await this.readOrNull(node)
-    node.load(fileContent)
+    await this.loadContents(node, fileContent, key)
+  }
+
+  // `key` is from before `fileContent` was read. Without it the facts are not cached
+  private async loadContents(node: Fileish, fileContent: Opt<string>, key: Opt<CacheKey>) {
+    const kind = node.factsKind
+    if (kind === undefined || fileContent === undefined || (this.parserPool === undefined && this.factCache === undefined)) {
+      node.load(fileContent)
+      return
+    }
+    let result = key === undefined ? undefined : this.factCache?.get(key.fsPath, kind, key.stat, fileContent)
+    if (result === undefined) {
+      result = this.parserPool !== undefined ? await this.parserPool.parse(kind, fileContent) : extractFacts(kind, fileContent)
+      if (key !== undefined) this.factCache?.set(key.fsPath, kind, key.stat, fileContent, result)
+    }
+    node.loadFacts(result)
+  }
+
+  private loadFromCache(node: Fileish, key: CacheKey) {
+    const kind = node.factsKind
+    if (kind === undefined) return false
+    const result = this.factCache?.get(key.fsPath, kind, key.stat)
+    if (result === undefined) return false
+    node.loadFacts(result)
+    return true
+  }
+
+  // Only files on disk are cached, not the unsaved contents of an open editor
+  private async cacheKey(node: Fileish): Promise<Opt<CacheKey>> {
+    if (this.factCache === undefined || this.getOpenDocContents(node.absPath) !== undefined) return undefined
+    await this.factCache.open()
+    const { fsPath } = URI.parse(node.absPath)
+    const stat = await statOrNull(fsPath)
+    return stat?.isFile() === true ? { fsPath, stat } : undefined
   }
 
   private sendFileDiagnostics(node: Fileish, validationErrors?: ValidationResponse) {
@@ -422,14 +709,14 @@ export class ModelManager {
       if (!unloadedNodes.isEmpty()) {
         // push this task back onto the job stack and then add loading jobs for each node that needs to load
         ModelManager.debug('[SEND_DIAGNOSTICS] Dependencies to check validity were not met yet. Enqueuing dependencies and then re-enqueueing this job', node.absPath, unloadedNodes.map(n => n.absPath).toArray())
-        this.jobRunner.enqueue({ type: 'SEND_DELAYED_DIAGNOSTICS', context: node, fn: () => { this.sendFileDiagnostics(node) } })
-        unloadedNodes.forEach(n => { this.jobRunner.enqueue({ type: 'LOAD_DEPENDENCY', context: n, fn: async () => { await this.readAndLoad(n) } }) })
+        this.jobRunner.enqueue({ type: 'SEND_DELAYED_DIAGNOSTICS', priority: JobPriority.DEPENDENCY, context: node, fn: () => { this.sendFileDiagnostics(node) } })
+        unloadedNodes.forEach(n => { this.jobRunner.enqueue({ type: 'LOAD_DEPENDENCY', priority: JobPriority.DEPENDENCY, parallel: true, context: n, fn: async () => { await this.readAndLoad(n) } }) })
       }
     }
   }
 
   performInitialValidation() {
-    const enqueueLoadJob = (node: Fileish) => { this.jobRunner.enqueue({ slow: true, type: 'INITIAL_LOAD_DEP', context: node, fn: async () => { await this.readAndLoad(node) } }) }
+    const enqueueLoadJob = (node: Fileish) => { this.jobRunner.enqueue({ slow: true, parallel: true, type: 'INITIAL_LOAD_DEP', context: node, fn: async () => { await this.readAndLoad(node) } }) }
     const jobs = [
       { slow: true, type: 'INITIAL_LOAD_BUNDLE', context: this.bundle, fn: async () => { await this.readAndLoad(this.bundle) } },
       { slow: true, type: 'INITIAL_LOAD_ALL_BOOKS', context: this.bundle, fn: () => this.bundle.allBooks.all.forEach(enqueueLoadJob) },
@@ -446,10 +733,11 @@ export class ModelManager {
     const context = { workspace: workspaceUri, doc: uri }
     // load the books to see if this URI is a page in a book
     const jobs = [
-      { type: 'FILEOPENED_LOAD_BUNDLE_DEP', context, fn: async () => { await this.readAndLoad(this.bundle) } },
-      { type: 'FILEOPENED_LOAD_BOOKS_DEP', context, fn: async () => await Promise.all(this.bundle.books.map(async f => { await this.readAndLoad(f) })) },
+      { type: 'FILEOPENED_LOAD_BUNDLE_DEP', priority: JobPriority.INTERACTIVE, context, fn: async () => { await this.readAndLoad(this.bundle) } },
+      { type: 'FILEOPENED_LOAD_BOOKS_DEP', priority: JobPriority.INTERACTIVE, context, fn: async () => await Promise.all(this.bundle.books.map(async f => { await this.readAndLoad(f) })) },
       {
         type: 'FILEOPENED_SEND_DIAGNOSTICS',
+        priority: JobPriority.INTERACTIVE,
         context,
         fn: () => {
           const node = findNode(this.bundle, uri)
@@ -471,6 +759,7 @@ export class ModelManager {
     cursor: Position,
     autocompleter: Autocompleter
   ) {
+    await this.flushDocument(page.absPath)
     if (!autocompleter.hasLinkNearCursor(page, cursor)) { return [] }
 
     const content = expectValue(
@@ -478,20 +767,20 @@ export class ModelManager {
       'BUG: This file should be open and have been sent from the vscode client'
     )
 
-    const range = autocompleter.getRange(cursor, content)
+    const line = lineAt(content, cursor.line)
+    const range = autocompleter.getRange(cursor, line)
     if (range === undefined) { return [] }
 
-    return await autocompleter.getCompletionItems(page, range)
+    return await autocompleter.getCompletionItems(page, range, line.substring(range.start.character, cursor.character))
   }
 
   private rangeFinderFactory(start: string, end: string) {
-    return (cursor: Position, content: string) => {
-      const lines = content.split('\n')
+    return (cursor: Position, line: string) => {
       // We're in an autocomplete context
       // Now check and see if we are right at the start of the thing we
       // want to autocomplete (src, url, etc.)
-      const beforeCursor = lines[cursor.line].substring(0, cursor.character)
-      const afterCursor = lines[cursor.line].substring(cursor.character)
+      const beforeCursor = line.substring(0, cursor.character)
+      const afterCursor = line.substring(cursor.character)
       const startOffset = beforeCursor.lastIndexOf(start)
       const endOffset = afterCursor.indexOf(end)
       return startOffset < 0 || endOffset < 0
@@ -503,6 +792,18 @@ export class ModelManager {
     }
   }
 
+  private getCompletionIndexes() {
+    if (this.completionIndexes === undefined) {
+      const root = this.bundle.workspaceRootUri
+      const resources = new CompletionIndex<ResourceNode>(r => path.relative(root, r.absPath))
+      const h5p = new CompletionIndex<H5PExercise>(h => path.basename(path.dirname(h.absPath)))
+      this.orphanedResources.forEach(r => { resources.add(r) })
+      this.orphanedH5P.forEach(h => { h5p.add(h) })
+      this.completionIndexes = { resources, h5p }
+    }
+    return this.completionIndexes
+  }
+
   public async autocompleteResources(page: PageNode, cursor: Position) {
     const resourceAutocompleter: Autocompleter = {
       hasLinkNearCursor: (page, cursor) => {
@@ -512,13 +813,16 @@ export class ModelManager {
           .length > 0
       },
       getRange: this.rangeFinderFactory('src="', '"'),
-      getCompletionItems: async (page, range) => {
+      getCompletionItems: async (page, range, typed) => {
         await this.loadEnoughForOrphans(500)
-        return this.orphanedResources
-          .filter((r) => r.exists)
-          .toArray()
+        const pageDir = path.dirname(page.absPath)
+        // Resources are indexed by their path from the workspace root
+        const toRoot = path.relative(pageDir, this.bundle.workspaceRootUri)
+        const query = afterCommonPrefix(typed, toRoot === '' ? '' : `${toRoot}/`)
+        return this.getCompletionIndexes().resources
+          .search(query, ModelManager.autocompleteLimit, r => r.exists)
           .map(i => {
-            const insertText = path.relative(path.dirname(page.absPath), i.absPath)
+            const insertText = path.relative(pageDir, i.absPath)
             const item = CompletionItem.create(insertText)
             item.textEdit = TextEdit.replace(range, insertText)
             item.kind = CompletionItemKind.File
@@ -539,13 +843,12 @@ export class ModelManager {
           .length > 0
       },
       getRange: this.rangeFinderFactory('url="', '"'),
-      getCompletionItems: async (_page, range) => {
+      getCompletionItems: async (_page, range, typed) => {
         await this.loadEnoughForOrphans(500)
-        return this.orphanedH5P
-          .filter((h) => h.exists)
-          .toArray()
-          .map((h) => path.dirname(h.absPath))
-          .map((p) => path.basename(p))
+        const query = afterCommonPrefix(typed, `${H5PExercise.PLACEHOLDER}/`)
+        return this.getCompletionIndexes().h5p
+          .search(query, ModelManager.autocompleteLimit, h => h.exists)
+          .map((h) => path.basename(path.dirname(h.absPath)))
           .map((name) => {
             const text = `${H5PExercise.PLACEHOLDER}/${name}`
             const item = CompletionItem.create(text)
@@ -560,6 +863,7 @@ export class ModelManager {
   }
 
   async getDocumentLinks(page: PageNode) {
+    await this.flushDocument(page.absPath)
     await this.readAndLoad(page)
     const ret: DocumentLink[] = []
     for (const pageLink of page.pageLinks) {
@@ -591,58 +895,120 @@ export class ModelManager {
   }
 
   async modifyToc(evt: TocModification) {
-    ModelManager.debug('[MODIFY_TOC]', evt)
+    await this.modifyTocs([evt])
+  }
+
+  // Applies the events in order to the ToCs in memory and then saves what
+  // changed: each collection is written once and clients get one ToC update
+  // for the whole batch. Nothing is written when one of the events fails.
+  // `version` is the version of the BookTocs the client made the events
+  // against (see publishBookTocs). The events are rejected when the ToCs have
+  // changed since, because their tokens and indexes may no longer mean the same.
+  public async modifyTocs(events: TocEvent[], version?: number) {
+    ModelManager.debug('[MODIFY_TOCS]', events)
+    await this.inTocTransaction(async tx => {
+      const current = this.bookTocsSnapshot.version
+      if (version !== undefined && version < current) {
+        throw new Error(`The ToC changed since version ${version} (it is now at version ${current}). Try again once it is up to date`)
+      }
+      for (const evt of events) {
+        await this.applyTocEvent(evt, tx)
+      }
+    })
+  }
+
+  private async applyTocEvent(evt: TocEvent, tx: TocTransaction) {
+    if (evt.type === TocNodeKind.Page) {
+      await this.createDocument(evt.bookIndex, evt.parentNodeToken, evt.title, 'page', PAGE_TEMPLATE, tx)
+    } else if (evt.type === TocNodeKind.Subbook) {
+      this.addSubbook(evt.bookIndex, evt.title, tx)
+    } else if (evt.type === TocNodeKind.Ancillary) {
+      await this.createDocument(evt.bookIndex, evt.parentNodeToken, evt.title, 'ancilliary', ANCILLARY_TEMPLATE, tx)
+    } else {
+      await this.applyModification(evt, tx)
+    }
+  }
 
-    // !!WARNING!!
-    // When this function calls `writeBookToc`, it causes`this.bookTocs` to
-    // update with a new array, distinct from the old, before the function
-    // continues. This can cause variables that reference `this.bookTocs` to
-    // become stale which can result in unexpected behavior. For more
-    // information, see `sideEffectFn` in ModelManager constructor.
-    // !!WARNING!!
+  // Transactions run one at a time. The BookTocs are edited in place while
+  // the events are applied and only replaced (see `sideEffectFn` in the
+  // constructor) once the changed files are loaded at the end.
+  private async inTocTransaction<T>(fn: (tx: TocTransaction) => Promise<T>): Promise<T> {
+    const run = this.tocTransactions.then(async () => await this.runTocTransaction(fn))
+    this.tocTransactions = run.then(() => undefined, () => undefined)
+    return await run
+  }
 
+  private async runTocTransaction<T>(fn: (tx: TocTransaction) => Promise<T>): Promise<T> {
+    const tx: TocTransaction = { books: new Set(), pages: new Map() }
+    const bookTocs = this.bookTocs
+    const snapshot = structuredClone(bookTocs.map(b => b.tocTree))
+    try {
+      const ret = await fn(tx)
+      const books = [...tx.books].map(bookToc => serializeBookToc(expectValue(this.bundle.allBooks.get(bookToc.absPath), 'BUG: Book no longer exists'), bookToc))
+      const pages = [...tx.pages]
+      await Promise.all([
+        ...pages.map(async ([fsPath, { content }]) => {
+          await mkdirp(path.dirname(fsPath))
+          await fs.promises.writeFile(fsPath, content)
+        }),
+        ...books.map(async b => { await fs.promises.writeFile(b.fsPath, b.xml) })
+      ])
+      books.forEach(b => { this.subbookTokens.wrote(b.bookToc) })
+      // Just speed up the process. In one batch so the ToCs are rebuilt and sent once
+      Quarx.batch(() => {
+        pages.forEach(([fsPath, { page, content }]) => { (page ?? this.bundle.allPages.getOrAdd(fsPath)).load(content) })
+        books.forEach(b => { b.load() })
+      })
+      return ret
+    } catch (err) {
+      // Undo the edits that were made in memory. When only some of the files
+      // were written the file watcher loads them like any other change
+      bookTocs.forEach((b, i) => { b.tocTree = snapshot[i] })
+      this.tocIdMap.placeBooks(bookTocs)
+      throw err
+    }
+  }
+
+  private async applyModification(evt: TocModification, tx: TocTransaction) {
     const bookToc = this.bookTocs[evt.bookIndex]
-    const book = expectValue(this.bundle.allBooks.get(bookToc.absPath), 'BUG: Book no longer exists')
-    const nodeAndParent = this.lookupToken(evt.nodeToken)
+    const place = this.tocIdMap.placeOf(evt.nodeToken)
 
-    if (nodeAndParent !== undefined) {
+    if (place !== undefined) {
       // We are manipulating an item in a Book ToC
-      const { node, parent } = nodeAndParent
+      const { node, parent } = place
       if (evt.type === TocModificationKind.PageRename || evt.type === TocModificationKind.SubbookRename || evt.type === TocModificationKind.AncillaryRename) {
         if (node.type === TocNodeKind.Page) {
-          const page = expectValue(this.bundle.allPages.get(node.value.absPath), `BUG: This node should exist: ${node.value.absPath}`)
           const fsPath = URI.parse(node.value.absPath).fsPath
-          const oldXml = expectValue(await this.readOrNull(page), `BUG? This file should exist right? ${fsPath}`)
-          const newXml = renameTitle(evt.newTitle, oldXml)
-          await fs.promises.writeFile(fsPath, newXml)
-          page.load(newXml) // Just speed up the process
+          // The page may have been created or changed earlier in this transaction
+          const changed = tx.pages.get(fsPath)
+          if (changed !== undefined) {
+            tx.pages.set(fsPath, { page: changed.page, content: renameTitle(evt.newTitle, changed.content) })
+          } else {
+            const page = expectValue(this.bundle.allPages.get(node.value.absPath), `BUG: This node should exist: ${node.value.absPath}`)
+            const oldXml = expectValue(await this.readOrNull(page), `BUG? This file should exist right? ${fsPath}`)
+            tx.pages.set(fsPath, { page, content: renameTitle(evt.newTitle, oldXml) })
+          }
         } else {
           node.value.title = evt.newTitle
-          await writeBookToc(book, bookToc)
+          tx.books.add(bookToc)
         }
       } else if (evt.type === TocModificationKind.Remove) {
         removeNode(parent, node)
-        await writeBookToc(book, bookToc)
+        this.tocIdMap.unplace(node)
+        this.tocIdMap.place(parent, place.bookIndex)
+        tx.books.add(bookToc)
       } else if (evt.type === TocModificationKind.Move) {
-        const recFindParentBook = (n: ClientTocNode | BookToc): BookToc => {
-          if (n.type === BookRootNode.Singleton) return n
-          const { parent } = expectValue(this.lookupToken(n.value.token), `BUG: Unexpected orphaned node: ${n.value.token}`)
-          return recFindParentBook(parent)
-        }
-        const srcBookToc = recFindParentBook(parent)
+        const srcBookToc = this.bookTocs[place.bookIndex]
         removeNode(parent, node)
+        this.tocIdMap.place(parent, place.bookIndex)
         // Add the node
-        const newParentChildren = evt.newParentToken !== undefined ? childrenOf(expectValue(this.lookupToken(evt.newParentToken), 'BUG: should always have a parent').node) : bookToc.tocTree
-        newParentChildren.splice(evt.newChildIndex, 0, node)
-        await writeBookToc(book, bookToc)
+        const newParent = this.newParent(evt.newParentToken, bookToc)
+        childrenOf(newParent).splice(evt.newChildIndex, 0, node)
+        // Everything below the node moved to the other book too
+        this.tocIdMap.place(newParent, evt.bookIndex, place.bookIndex !== evt.bookIndex)
         // When moving between books in a bundle, update both collection files
-        if (srcBookToc.absPath !== bookToc.absPath) {
-          const srcBookNode = expectValue(
-            this.bundle.allBooks.get(srcBookToc.absPath),
-            `BUG: Parent book did not exist in bundle: ${srcBookToc.absPath}`
-          )
-          await writeBookToc(srcBookNode, srcBookToc)
-        }
+        tx.books.add(bookToc)
+        tx.books.add(srcBookToc)
       }
     } else /* istanbul ignore else */ if (evt.type === TocModificationKind.Move) {
       // We are manipulating an orphaned Page (probably moving it into the ToC of a book)
@@ -659,11 +1025,10 @@ export class ModelManager {
           }
         }
         // Add the node
-        const newParentChildren = evt.newParentToken !== undefined
-          ? /* istanbul ignore next */ childrenOf(expectValue(this.lookupToken(evt.newParentToken), 'BUG: should always have a parent').node)
-          : bookToc.tocTree
-        newParentChildren.splice(evt.newChildIndex, 0, node)
-        await writeBookToc(book, bookToc)
+        const newParent = this.newParent(evt.newParentToken, bookToc)
+        childrenOf(newParent).splice(evt.newChildIndex, 0, node)
+        this.tocIdMap.place(newParent, evt.bookIndex)
+        tx.books.add(bookToc)
       } else {
         throw new Error(`BUG: The orphaned item being dragged around was not a PageNode. nodeToken='${evt.nodeToken}' That is really unexpected. Maybe the client is stale?`)
       }
@@ -672,26 +1037,14 @@ export class ModelManager {
     }
   }
 
-  private recFind(token: Token, parent: ClientTocNode | BookToc, nodes: ClientTocNode[]): Opt<NodeAndParent> {
-    for (const node of nodes) {
-      if (node.value.token === token) {
-        return { node, parent }
-      }
-      if (node.type === TocNodeKind.Subbook) {
-        const ret = this.recFind(token, node, node.children)
-        if (ret !== undefined) return ret
-      }
-    }
+  // The subbook with the token or the book when there is no token
+  private newParent(parentToken: Opt<Token>, bookToc: BookToc): BookToc | ClientTocNode {
+    return parentToken !== undefined
+      ? expectValue(this.tocIdMap.placeOf(parentToken), 'BUG: should always have a parent').node
+      : bookToc
   }
 
-  private lookupToken(token: string): Opt<NodeAndParent> {
-    for (const b of this.bookTocs) {
-      const ret = this.recFind(token, b, b.tocTree)
-      if (ret !== undefined) return ret
-    }
-  }
-
-  public async createDocument(bookIndex: number, parentNodeToken: string | undefined, title: string, documentType: string, template: string) {
+  public async createDocument(bookIndex: number, parentNodeToken: string | undefined, title: string, documentType: string, template: string, tx: TocTransaction) {
     const workspaceRootUri = URI.parse(this.bundle.workspaceRootUri)
     const pageDirUri = Utils.joinPath(workspaceRootUri, 'modules')
     let moduleNumber = 0
@@ -699,12 +1052,13 @@ export class ModelManager {
     while (moduleNumber < 1000) {
       moduleNumber += 1
       const newModuleId = `m${moduleNumber.toString().padStart(5, '0')}`
-      if (moduleDirs.has(newModuleId)) {
-        // File exists already, try again
+      const pageUri = Utils.joinPath(pageDirUri, newModuleId, 'index.cnxml')
+      if (moduleDirs.has(newModuleId) || tx.pages.has(pageUri.fsPath)) {
+        // File exists already (or will once this transaction is saved), try again
         continue
       }
-      const pageUri = Utils.joinPath(pageDirUri, newModuleId, 'index.cnxml')
-      const page = this.bundle.allPages.getOrAdd(pageUri.fsPath) // fsPath works for tests and gets converted to file:// for real
+      // fsPath works for tests and gets converted to file:// for real
+      const absPath = this.bundle.pathHelper.canonicalize(pageUri.fsPath)
 
       const doc = new DOMParser().parseFromString(template, 'text/xml')
       selectOne('/cnxml:document/cnxml:title', doc).textContent = title
@@ -712,69 +1066,50 @@ export class ModelManager {
       selectOne('/cnxml:document/cnxml:metadata/md:uuid', doc).textContent = uuid4()
       const xmlStr = new XMLSerializer().serializeToString(doc)
 
-      page.load(xmlStr)
-      await mkdirp(Utils.joinPath(pageDirUri, newModuleId).fsPath)
-      await fs.promises.writeFile(pageUri.fsPath, xmlStr)
+      tx.pages.set(pageUri.fsPath, { page: undefined, content: xmlStr })
       ModelManager.debug(`[NEW_${documentType.toUpperCase()}] Created: ${pageUri.fsPath}`)
 
       const bookToc = this.bookTocs[bookIndex]
-      const book = expectValue(this.bundle.allBooks.get(bookToc.absPath), 'BUG: Book no longer exists')
-      /* istanbul ignore next */
-      const newParentChildren = parentNodeToken !== undefined ? childrenOf(expectValue(this.lookupToken(parentNodeToken), 'BUG: should always have a parent').node) : bookToc.tocTree
-      newParentChildren.splice(0, 0, {
+      const newParent = this.newParent(parentNodeToken, bookToc)
+      childrenOf(newParent).splice(0, 0, {
         type: TocNodeKind.Page,
-        value: { token: 'unused-when-writing', title: undefined, fileId: newModuleId, absPath: page.absPath }
+        value: { token: 'unused-when-writing', title: undefined, fileId: newModuleId, absPath }
       })
-      await writeBookToc(book, bookToc)
+      this.tocIdMap.place(newParent, bookIndex)
+      tx.books.add(bookToc)
       ModelManager.debug(`[CREATE_${documentType.toUpperCase()}] Prepended to Book: ${pageUri.fsPath}`)
-      return { page, id: newModuleId }
+      return { fsPath: pageUri.fsPath, id: newModuleId }
     }
     /* istanbul ignore next */
     throw new Error('Error: Too many page directories already exist')
   }
 
   public async createPage(bookIndex: number, parentToken: string | undefined, title: string) {
-    return await this.createDocument(bookIndex, parentToken, title, 'page', `
-<document xmlns="http://cnx.rice.edu/cnxml">
-  <title/>
-  <metadata xmlns:md="http://cnx.rice.edu/mdml">
-    <md:title/>
-    <md:content-id/>
-    <md:uuid/>
-  </metadata>
-  <content>
-  </content>
-</document>`.trim())
+    const { fsPath, id } = await this.inTocTransaction(async tx => await this.createDocument(bookIndex, parentToken, title, 'page', PAGE_TEMPLATE, tx))
+    return { page: this.bundle.allPages.getOrAdd(fsPath), id }
   }
 
   public async createAncillary(bookIndex: number, parentNodeToken: string | undefined, title: string) {
-    return await this.createDocument(bookIndex, parentNodeToken, title, 'ancilliary', `
-<document xmlns="http://cnx.rice.edu/cnxml" class="super">
-  <title/>
-  <metadata xmlns:md="http://cnx.rice.edu/mdml">
-    <md:title/>
-    <md:content-id/>
-    <md:uuid/>
-    <md:super>
-    </md:super>
-  </metadata>
-  <content class="super">
-  </content>
-</document>`.trim())
+    const { fsPath, id } = await this.inTocTransaction(async tx => await this.createDocument(bookIndex, parentNodeToken, title, 'ancilliary', ANCILLARY_TEMPLATE, tx))
+    return { page: this.bundle.allPages.getOrAdd(fsPath), id }
   }
 
   public async createSubbook(bookIndex: number, parentNodeToken: string | undefined, title: string) {
+    await this.inTocTransaction(async tx => { this.addSubbook(bookIndex, title, tx) })
+  }
+
+  private addSubbook(bookIndex: number, title: string, tx: TocTransaction) {
     ModelManager.debug(`[CREATE_SUBBOOK] Creating: ${title}`)
     const bookToc = this.bookTocs[bookIndex]
-    const book = expectValue(this.bundle.allBooks.get(bookToc.absPath), 'BUG: Book no longer exists')
     const tocNode: TocSubbook<ClientSubbookish, ClientPageish> = {
       type: TocNodeKind.Subbook,
-      value: { title, token: 'unused-when-writing' },
+      value: { title, token: this.subbookTokens.fresh() },
       children: []
     }
     // Prepend new Subbook to top of Book so it is visible to the user
     bookToc.tocTree.unshift(tocNode)
-    await writeBookToc(book, bookToc)
+    this.tocIdMap.place(bookToc, bookIndex)
+    tx.books.add(bookToc)
   }
 
   public async modifyFileish(node: Fileish, fn: (input: string, absPath: string /* Just for debugging */) => string) {
@@ -793,6 +1128,63 @@ export class ModelManager {
     await fs.promises.writeFile(fsPath, out)
     return true
   }
+
+  // Adds the missing element ids to every page that has some. Only a few pages
+  // are held in memory at a time. Each one is written as soon as it is fixed
+  // so cancelling keeps the work that was done.
+  public async ensureIds(workDoneToken: Opt<string>, token: CancellationToken): Promise<EnsureIdsSummary> {
+    const pages = this.bundle.allPages.all
+      .filter(p => p.exists && p.isLoaded && p.isValidXML && !p.elementsMissingIds.isEmpty())
+      .toArray()
+    const progress = this.conn.window.attachWorkDoneProgress(workDoneToken)
+    progress.begin('Creating Auto Element IDs', 0, `0 of ${pages.length} pages`, true)
+    const summary: EnsureIdsSummary = { pages: 0, ids: 0, cancelled: false }
+    try {
+      await forEachLimit(pages, ModelManager.ensureIdsConcurrency, async page => {
+        summary.ids += await this.fixIds(page)
+        summary.pages++
+        progress.report(Math.floor(100 * summary.pages / pages.length), `${summary.pages} of ${pages.length} pages`)
+      }, () => token.isCancellationRequested)
+    } finally {
+      progress.done()
+    }
+    summary.cancelled = summary.pages < pages.length
+    ModelManager.debug('[ENSURE_IDS]', `Added ${summary.ids} id(s) to ${summary.pages} of ${pages.length} page(s)`)
+    return summary
+  }
+
+  // Like modifyFileish(page, idFixer) but the ids are spliced into the text
+  // at the positions found when the page was parsed. If the page changed since
+  // then a DOM is fixed instead (off the main thread when there are parser
+  // threads). Returns how many ids were added.
+  private async fixIds(page: PageNode) {
+    const fileContents = expectValue(await this.readOrNull(page), `BUG? This file should exist right? ${page.absPath}`)
+    // An edit that is waiting to be parsed (see scheduleFileContents) is
+    // already in the text but not in the facts. The facts would put the ids in
+    // the wrong places and miss the ids that were just typed
+    const parsed = !this.pendingSyncs.has(page.absPath)
+    const missing = parsed ? page.elementsMissingIds.size : await this.countMissingIds(page, fileContents)
+    const spliced = parsed ? spliceIds(fileContents, page.elementIds.keys(), page.elementsMissingIds.toArray()) : undefined
+    const fixed = spliced === undefined && this.parserPool !== undefined ? await this.parserPool.fixIds(page.factsKind, fileContents) : undefined
+    const out = spliced ?? fixed?.content ?? idFixer(fileContents, page.absPath)
+    // Written before the page is loaded so a failed write does not leave the
+    // page looking fixed. The fact cache is left out: the file on disk
+    // could already be different from `out` by the time it is stat'ed
+    await fs.promises.writeFile(URI.parse(page.absPath).fsPath, out)
+    if (fixed !== undefined) {
+      page.loadFacts(fixed.result)
+    } else {
+      await this.loadContents(page, out, undefined)
+    }
+    this.sendFileDiagnostics(page)
+    return missing - page.elementsMissingIds.size
+  }
+
+  private async countMissingIds(page: PageNode, content: string) {
+    const kind = page.factsKind
+    const result = this.parserPool !== undefined ? await this.parserPool.parse(kind, content) : extractFacts(kind, content)
+    return result.error === undefined ? (result.facts as PageFacts).elementsMissingIds.length : 0
+  }
 }
 
 export function removeNode(parent: ClientTocNode | BookToc, node: ClientTocNode) {
@@ -815,10 +1207,19 @@ export function removeNode(parent: ClientTocNode | BookToc, node: ClientTocNode)
   }
 }
 
+// The collection XML and how to load it into the book once it is written
+function serializeBookToc(book: BookNode, bookToc: BookToc) {
+  const written = writeCollection(bookToc)
+  const xml = written?.xml ?? toString(bookToc)
+  const load = written !== undefined
+    ? () => { book.loadFacts({ facts: written.facts }) }
+    : () => { book.load(xml) }
+  return { bookToc, fsPath: URI.parse(bookToc.absPath).fsPath, xml, load }
+}
+
 export async function writeBookToc(book: BookNode, bookToc: BookToc) {
-  const bookXmlStr = toString(bookToc)
-  const fsPath = URI.parse(bookToc.absPath).fsPath
-  await fs.promises.writeFile(fsPath, bookXmlStr)
-  book.load(bookXmlStr) // Just speed up the process
+  const { fsPath, xml, load } = serializeBookToc(book, bookToc)
+  await fs.promises.writeFile(fsPath, xml)
+  load() // Just speed up the process
   return book
 }
@@ -5,11 +5,12 @@
 import glob from 'glob'
 import { DOMParser, XMLSerializer } from 'xmldom'
 import fs from 'fs'
+import { type ChildProcess, fork } from 'child_process'
 import path from 'path'
 import I from 'immutable'
-import { expectValue, type PathHelper, select, TocNodeKind } from './utils'
+import { expectValue, forEachLimit, type Opt, type PathHelper, type Range, select, TocNodeKind } from './utils'
 import { Bundle } from './bundle'
-import { type Fileish } from './fileish'
+import { type Fileish, ValidationSeverity } from './fileish'
 import { type PageLink, PageLinkKind, type PageNode } from './page'
 import { BookNode, type TocNodeWithRange, type TocPageWithRange, type TocSubbookWithRange } from './book'
 import { type ResourceNode } from './resource'
@@ -17,6 +18,11 @@ import { removeNode, writeBookToc } from '../model-manager'
 import { BookRootNode, type BookToc, type ClientTocNode } from '../../../common/src/toc'
 import { fromBook, IdMap } from '../book-toc-utils'
 import { generateReadmeForWorkspace } from '../readme-generator'
+import { ParserPool } from '../parser-pool'
+import { extractFacts } from '../parse-worker'
+import { FactCache, hashContent } from '../fact-cache'
+import { loadDependencies } from '../dependency-loader'
+import { findLinkProblem, isCheckableUrl, LinkChecker } from '../link-checker'
 
 const ALLOWED_FILES = [
   'LICENSE',
@@ -39,8 +45,6 @@ function logCsv(bundle: Bundle, page: PageNode, link: PageLink, errorCode: strin
 info('WARN: Manually setting NODE_ENV=production so we get nicer error messages')
 process.env.NODE_ENV = 'production'
 
-const sleep = async (ms: number) => await new Promise((resolve) => setTimeout(resolve, ms))
-
 function toRelPath(p: string) {
   return path.relative(process.cwd(), p)
 }
@@ -50,6 +54,48 @@ function loadNode(n: Fileish) {
   n.load(bits)
 }
 
+// Set by --parser-threads N
+let parserPool: Opt<ParserPool>
+// Set by --cache DIR
+let factCache: Opt<FactCache>
+let cacheDir: Opt<string>
+// Set by --report FILE
+let reportFile: Opt<string>
+// Set by --cache DIR and --max-requests N (links)
+let linkCacheFile: Opt<string>
+let maxLinkRequests: Opt<number>
+
+const READ_BATCH_SIZE = 64
+
+async function readOrUndefined(absPath: string) {
+  try {
+    return await fs.promises.readFile(absPath, 'utf-8')
+  } catch {
+    return undefined // missing (or a directory)
+  }
+}
+
+async function loadNodeAsync(n: Fileish) {
+  const kind = n.factsKind
+  if ((parserPool === undefined && factCache === undefined) || kind === undefined || !fs.existsSync(n.absPath)) {
+    n.load(await readOrUndefined(n.absPath))
+    return
+  }
+  const stat = await fs.promises.stat(n.absPath)
+  const cached = factCache?.get(n.absPath, kind, stat)
+  if (cached !== undefined) {
+    n.loadFacts(cached)
+    return
+  }
+  const bits = await fs.promises.readFile(n.absPath, 'utf-8')
+  let result = factCache?.get(n.absPath, kind, stat, bits)
+  if (result === undefined) {
+    result = parserPool !== undefined ? await parserPool.parse(kind, bits) : extractFacts(kind, bits)
+    factCache?.set(n.absPath, kind, stat, bits, result)
+  }
+  n.loadFacts(result)
+}
+
 const pathHelper: PathHelper<string> = {
   join: (root, ...components) => path.join(root, ...components),
   dirname: (p) => path.dirname(p),
@@ -57,14 +103,12 @@ const pathHelper: PathHelper<string> = {
   canonicalize: (x) => x
 }
 
-function loadRepo(repoPath: string) {
+async function loadRepo(repoPath: string) {
   const bundle = new Bundle(pathHelper, repoPath)
-  let nodesToLoad = I.Set<Fileish>()
-  do {
-    nodesToLoad = bundle.allNodes.flatMap(n => n.validationErrors.nodesToLoad).filter(n => !n.isLoaded && n.validationErrors.errors.size === 0)
-    info('Loading', nodesToLoad.size, 'file(s)...')
-    nodesToLoad.forEach(loadNode)
-  } while (nodesToLoad.size > 0)
+  const waves = await loadDependencies(I.Set([bundle]), async nodes => {
+    await forEachLimit(nodes, READ_BATCH_SIZE, loadNodeAsync)
+  }, ({ round, files }) => { info(`Loading ${files} file(s) (round ${round})...`) })
+  info('Loaded', waves.reduce((sum, w) => sum + w.files, 0), 'file(s) in', waves.length, 'round(s)')
   return bundle
 }
 
@@ -73,7 +117,7 @@ async function load(bookDirs: string[]): Promise<[boolean, Bundle[]]> {
   const bundles = []
   for (const rootPath of bookDirs) {
     info('Validating', toRelPath(rootPath))
-    const bundle = loadRepo(path.resolve(rootPath))
+    const bundle = await loadRepo(path.resolve(rootPath))
 
     info('')
     info('This directory contains:')
@@ -85,6 +129,10 @@ async function load(bookDirs: string[]): Promise<[boolean, Bundle[]]> {
     bundles.push(bundle)
     errorCount += validationErrors.size
   }
+  if (factCache !== undefined) {
+    info('Cache:', factCache.counters.hits, 'hit(s)', factCache.counters.misses, 'miss(es)')
+    await factCache.save()
+  }
   return [errorCount > 0, bundles]
 }
 
@@ -101,105 +149,221 @@ function printErrors(bundles: Bundle[]) {
   })
 }
 
+// One line of the JSON lines report (--report FILE or --jobs N)
+interface ReportLine {
+  repo: string
+  path: string // relative to the repo
+  range: Range | null // null when the whole file is the problem
+  severity: string
+  title: string
+}
+
+const SEVERITY_NAMES = new Map([
+  [ValidationSeverity.ERROR, 'error'],
+  [ValidationSeverity.WARNING, 'warning'],
+  [ValidationSeverity.INFORMATION, 'information'],
+  [ValidationSeverity.HINT, 'hint']
+])
+
+type ReportCommand = 'validate' | 'orphans'
+
+function repoRootOf(bundle: Bundle) {
+  return path.join(path.dirname(bundle.absPath), '..')
+}
+
+function validationReport(repo: string, bundle: Bundle): ReportLine[] {
+  const repoRoot = repoRootOf(bundle)
+  return bundle.allNodes.flatMap(n => n.validationErrors.errors).toArray().map(e => ({
+    repo,
+    path: path.relative(repoRoot, e.node.absPath),
+    range: e.range,
+    severity: expectValue(SEVERITY_NAMES.get(e.severity), 'BUG: unknown severity'),
+    title: e.title
+  }))
+}
+
+function orphansReport(repo: string, bundle: Bundle): ReportLine[] {
+  const repoRoot = repoRootOf(bundle)
+  return findOrphans(bundle).toArray().map(o => ({
+    repo,
+    path: path.relative(repoRoot, o),
+    range: null,
+    severity: 'error',
+    title: 'Orphaned file'
+  }))
+}
+
+async function writeReport(lines: ReportLine[], reportFile: Opt<string>) {
+  const jsonl = lines.map(l => JSON.stringify(l)).join('\n')
+  if (reportFile !== undefined) {
+    await fs.promises.writeFile(reportFile, lines.length > 0 ? `${jsonl}\n` : '', 'utf-8')
+  } else if (lines.length > 0) {
+    logText(jsonl)
+  }
+}
+
 async function validate(bookDirs: string[]) {
   const [hasErrors, bundles] = await load(bookDirs)
   printErrors(bundles)
+  if (reportFile !== undefined) {
+    await writeReport(bundles.flatMap((b, i) => validationReport(bookDirs[i], b)), reportFile)
+  }
   process.exit(hasErrors ? 111 : 0)
 }
 
 async function lintLinks(bookDirs: string[]) {
   let [hasErrors, bundles] = await load(bookDirs)
+  const checker = new LinkChecker({ cacheFile: linkCacheFile, ...(maxLinkRequests !== undefined ? { maxRequests: maxLinkRequests } : {}) })
+  await checker.open()
   for (const bundle of bundles) {
-    for (const page of bundle.allPages.all.filter(page => page.isLoaded && page.exists)) {
-      for (const link of page.pageLinks) {
-        if (link.type === PageLinkKind.URL) {
-          const url = link.url
-          info('Checking Link to URL', url)
-
-          // Skip injected exercises
-          if (url.startsWith('#ost/api/ex') || url.startsWith('#exercise/')) {
-            continue
-          }
-
-          // Parse the URL first because it might not be valid
-          try {
-            // eslint-disable-next-line no-new
-            new URL(url)
-          } catch {
-            hasErrors = true
-            logCsv(bundle, page, link, 'parse', encodeURI(url))
-            continue
-          }
-
-          let destUrl = ''
-          try {
-            const res = await fetch(url, { method: 'HEAD', redirect: 'manual' })
-            if (res.status !== undefined) {
-              if (res.status >= 200 && res.status < 300) {
-                info('Ok:', res.status, link.url)
-              } else if (res.status >= 300 && res.status < 400) {
-                info('Following Redirect:', res.status, link.url)
-                destUrl = res.headers.get('location') ?? ''
-                if (destUrl !== undefined && destUrl !== null) {
-                  // -------------------
-                  // Avert your eyes!
-                  // This is lazy copy/pasta
-                  // -------------------
-
-                  const res2 = await fetch(destUrl, { method: 'HEAD', redirect: 'manual' })
-                  if (res2.status !== undefined) {
-                    if (res2.status >= 200 && res2.status < 300) {
-                      info('Ok:', res2.status, link.url, 'to', destUrl)
-                    } else if (res2.status >= 300 && res2.status < 400) {
-                      hasErrors = true
-                      logCsv(bundle, page, link, 'double_redirect', link.url, destUrl, res2.headers.get('location') ?? '')
-                    } else {
-                      hasErrors = true
-                      logCsv(bundle, page, link, res.status, link.url, destUrl)
-                    }
-                  }
-                }
-              } else {
-                hasErrors = true
-                logCsv(bundle, page, link, res.status, link.url)
-              }
-            }
-          } catch (err) {
-            logCsv(bundle, page, link, 'fetch_failed_maybe', url, destUrl, (err as Error).message)
-          }
-        }
-      }
-      await sleep(100)
-    }
+    const links = bundle.allPages.all.filter(page => page.isLoaded && page.exists).toArray()
+      .flatMap(page => page.pageLinks.toArray().map(link => ({ page, link })))
+      .filter(({ link }) => link.type === PageLinkKind.URL && isCheckableUrl(link.url))
+    info('Checking', links.length, 'link(s) to URLs')
+    // Check them all at once (the checker does the throttling) but print them in order
+    const problems = await Promise.all(links.map(async ({ link }) => await findLinkProblem(checker, link.url)))
+    links.forEach(({ page, link }, i) => {
+      const problem = problems[i]
+      if (problem === undefined) return
+      const url = link.url
+      hasErrors = hasErrors || problem.isError
+      logCsv(bundle, page, link, problem.code, problem.code === 'parse' ? encodeURI(url) : url, problem.toUrl, problem.secondToUrl)
+    })
   }
-  info('----------------------------')
-  await sleep(10 * 1000)
+  info('Requests:', checker.counters.requests, 'Cache hits:', checker.counters.cacheHits)
+  await checker.save()
   process.exit(hasErrors ? 111 : 0)
 }
 
+function findOrphans(bundle: Bundle) {
+  const repoRoot = repoRootOf(bundle)
+  const allFiles = I.Set(glob.sync('**/*', { cwd: repoRoot, absolute: true, nodir: true, ignore: ALLOWED_FILES }))
+  const books = bundle.books
+  const pages = books.flatMap(b => b.pages).filter(o => o.exists)
+  const images = pages.flatMap(p => p.resources).filter(o => o.exists)
+
+  const referencedNodes = books.union(pages).union(images).union(I.Set([bundle]))
+  const referencedFiles = referencedNodes.map(o => path.resolve(o.absPath))
+
+  return allFiles.subtract(referencedFiles)
+}
+
 async function orphans(bookDirs: string[]) {
   let [hasErrors, bundles] = await load(bookDirs)
 
   for (const bundle of bundles) {
-    const repoRoot = path.join(path.dirname(bundle.absPath), '..')
-    const allFiles = I.Set(glob.sync('**/*', { cwd: repoRoot, absolute: true, nodir: true, ignore: ALLOWED_FILES }))
-    const books = bundle.books
-    const pages = books.flatMap(b => b.pages).filter(o => o.exists)
-    const images = pages.flatMap(p => p.resources).filter(o => o.exists)
-
-    const referencedNodes = books.union(pages).union(images).union(I.Set([bundle]))
-    const referencedFiles = referencedNodes.map(o => path.resolve(o.absPath))
-
-    const orphans = allFiles.subtract(referencedFiles)
+    const orphans = findOrphans(bundle)
 
     info('Found orphans', orphans.size)
     orphans.forEach(o => { console.log(toRelPath(o)) })
 
     hasErrors = hasErrors || orphans.size > 0
   }
+  if (reportFile !== undefined) {
+    await writeReport(bundles.flatMap((b, i) => orphansReport(bookDirs[i], b)), reportFile)
+  }
   process.exit(hasErrors ? 111 : 0)
 }
 
+// --jobs N: Each repository is loaded in one of N child processes (running
+// this same script) and their reports are merged in the order the
+// repositories were given.
+interface RepoTask { command: ReportCommand, repo: string }
+interface RepoReport { lines: ReportLine[], hasErrors: boolean }
+type RepoResult = ({ repo: string } & RepoReport) | { repo: string, error: string }
+
+const REPO_WORKER_COMMAND = '__repo-worker'
+
+// Each repository gets its own facts file in --jobs mode. Children that
+// shared one would each write back only what they had loaded, dropping the
+// entries of the others
+function repoFactCacheFile(dir: string, repo: string) {
+  return path.join(dir, 'repos', `${hashContent(path.resolve(repo)).slice(0, 16)}.facts.json`)
+}
+
+async function reportRepo({ command, repo }: RepoTask): Promise<RepoReport> {
+  info('Validating', toRelPath(repo))
+  if (cacheDir !== undefined) {
+    factCache = new FactCache(repoFactCacheFile(cacheDir, repo))
+    await factCache.open()
+  }
+  const bundle = await loadRepo(path.resolve(repo))
+  const validationLines = validationReport(repo, bundle)
+  const lines = command === 'validate' ? validationLines : orphansReport(repo, bundle)
+  await factCache?.save()
+  // Same exit status as without --jobs: orphans also fails on validation errors
+  return { lines, hasErrors: validationLines.length > 0 || lines.length > 0 }
+}
+
+// The child side: answers one RepoTask at a time over IPC
+function runRepoWorker() {
+  process.once('disconnect', () => {
+    parserPool?.terminate().catch(err => { info('Could not stop the parser threads', err) })
+  })
+  process.on('message', (task: RepoTask) => {
+    const send = (result: RepoResult) => { expectValue(process.send, 'BUG: the repo worker must be started with an IPC channel')(result) }
+    reportRepo(task).then(
+      report => { send({ repo: task.repo, ...report }) },
+      err => { send({ repo: task.repo, error: (err as Error).stack ?? String(err) }) }
+    )
+  })
+}
+
+function forkRepoWorker(forwardedArgs: string[]) {
+  // The CLI normally runs through ts-node so the child needs it too
+  const execArgv = __filename.endsWith('.ts') ? [...process.execArgv, '-r', 'ts-node/register'] : process.execArgv
+  return fork(__filename, [REPO_WORKER_COMMAND, ...forwardedArgs], { execArgv })
+}
+
+async function askRepoWorker(child: ChildProcess, task: RepoTask): Promise<RepoReport> {
+  return await new Promise((resolve, reject) => {
+    const onExit = (code: number | null) => { reject(new Error(`Worker for ${task.repo} exited with ${String(code)}`)) }
+    child.once('exit', onExit)
+    child.once('message', (result: RepoResult) => {
+      child.off('exit', onExit)
+      if ('error' in result) {
+        reject(new Error(`Could not check ${result.repo}: ${result.error}`))
+      } else {
+        resolve({ lines: result.lines, hasErrors: result.hasErrors })
+      }
+    })
+    child.send(task)
+  })
+}
+
+async function runJobs(command: ReportCommand, repos: string[], jobs: number, forwardedArgs: string[]) {
+  const results = new Map<string, RepoReport>()
+  const queue = repos.slice()
+  const children: ChildProcess[] = []
+  try {
+    await Promise.all(Array.from({ length: Math.min(jobs, repos.length) }, async () => {
+      const child = forkRepoWorker(forwardedArgs)
+      children.push(child)
+      try {
+        let repo
+        while ((repo = queue.shift()) !== undefined) {
+          results.set(repo, await askRepoWorker(child, { command, repo }))
+        }
+      } finally {
+        if (child.connected) child.disconnect()
+      }
+    }))
+  } catch (err) {
+    // Do not leave the other children checking repositories nobody waits for
+    children.forEach(c => {
+      if (c.connected) c.disconnect()
+      c.kill()
+    })
+    info((err as Error).message)
+    process.exit(1)
+  }
+  const reports = repos.map(r => expectValue(results.get(r), 'BUG: every repo was checked'))
+  const lines = reports.flatMap(r => r.lines)
+  info('Found', lines.length, 'problem(s) in', repos.length, 'repo(s)')
+  await writeReport(lines, reportFile)
+  process.exit(reports.some(r => r.hasErrors) ? 111 : 0)
+}
+
 function recFindLeafPages(acc: TocPageWithRange[], node: TocSubbookWithRange) {
   node.children.forEach(c => {
     if (c.type === TocNodeKind.Page) {
@@ -280,7 +444,7 @@ async function shrink(repoDir: string, entries: MinDefinition[]) {
   const keepBooks = new Set<BookNode>()
   const keepPages = new Set<PageNode>()
   const keepResources = new Set<ResourceNode>()
-  const bundle = loadRepo(repoDir)
+  const bundle = await loadRepo(repoDir)
 
   // Load up the initial dependencies (these will be Pages)
   entries.forEach(entry => {
@@ -354,11 +518,61 @@ async function generateReadme(repoPath: string, extras?: Record<string, string>)
   await fs.promises.writeFile(path.join(repoPath, 'README.md'), readme, 'utf-8')
 }
 
+// Removes `name value` from the arguments and returns the value
+function takeOption(args: string[], name: string): Opt<string> {
+  const i = args.indexOf(name)
+  if (i < 0) return undefined
+  const [, value] = args.splice(i, 2)
+  return value
+}
+
+// Same for options that are a count of processes or threads
+function takeCountOption(args: string[], name: string): Opt<number> {
+  const value = takeOption(args, name)
+  if (value === undefined) return undefined
+  const n = Number(value)
+  if (!Number.isInteger(n) || n < 1) {
+    info(`${name} expects a whole number of at least 1 but got '${String(value)}'`)
+    process.exit(1)
+  }
+  return n
+}
+
 (async function () {
+  const forwardedArgs: string[] = [] // Options that child processes (--jobs) need too
+  const jobs = takeCountOption(process.argv, '--jobs')
+  const parserThreads = takeCountOption(process.argv, '--parser-threads')
+  if (parserThreads !== undefined) {
+    parserPool = new ParserPool(parserThreads)
+    forwardedArgs.push('--parser-threads', String(parserThreads))
+  }
+  const cacheOption = takeOption(process.argv, '--cache')
+  if (cacheOption !== undefined) {
+    cacheDir = path.resolve(cacheOption)
+    linkCacheFile = path.join(cacheDir, 'links.json')
+    forwardedArgs.push('--cache', cacheDir)
+    // The --jobs children open a facts file for each repository instead
+    const inChildren = process.argv[2] === REPO_WORKER_COMMAND || (jobs !== undefined && ['validate', 'orphans'].includes(process.argv[2]))
+    if (!inChildren) {
+      factCache = new FactCache(path.join(cacheDir, 'facts.json'))
+      await factCache.open()
+    }
+  }
+  const report = takeOption(process.argv, '--report')
+  reportFile = report !== undefined ? path.resolve(report) : undefined
+  maxLinkRequests = takeCountOption(process.argv, '--max-requests')
   switch (process.argv[2]) {
+    case REPO_WORKER_COMMAND: {
+      runRepoWorker()
+      return // Keep running until the parent disconnects
+    }
     case 'validate': {
       const bookDirs = process.argv.length >= 4 ? process.argv.slice(3) : [process.cwd()]
-      await validate(bookDirs)
+      if (jobs !== undefined) {
+        await runJobs('validate', bookDirs, jobs, forwardedArgs)
+      } else {
+        await validate(bookDirs)
+      }
       break
     }
     case 'links': {
@@ -368,7 +582,11 @@ async function generateReadme(repoPath: string, extras?: Record<string, string>)
     }
     case 'orphans': {
       const bookDirs = process.argv.length >= 4 ? process.argv.slice(3) : [process.cwd()]
-      await orphans(bookDirs)
+      if (jobs !== undefined) {
+        await runJobs('orphans', bookDirs, jobs, forwardedArgs)
+      } else {
+        await orphans(bookDirs)
+      }
       break
     }
     case 'shrink': {
@@ -401,6 +619,13 @@ async function generateReadme(repoPath: string, extras?: Record<string, string>)
       info('    orphans <directory>')
       info('    shrink <directory> bookslug:0,9.0,9.7 bookslug2:13.0')
       info('    generate-readme <directory> [extra-values...]')
+      info('Options:')
+      info('    --parser-threads N  Parse pages and books in N worker threads')
+      info('    --cache DIR         Reuse the parsed pages and books that did not change since the last run (and recent link checks). With --jobs each directory has its own file')
+      info('    --max-requests N    links: stop sending requests after N of them')
+      info('    --jobs N            validate/orphans: check the directories in N processes and print a JSON lines report')
+      info('    --report FILE       validate/orphans: write the JSON lines report (repo, path, range, severity, title) to FILE')
     }
   }
+  await parserPool?.terminate()
 })().then(null, (err) => { throw err })
@@ -2,8 +2,9 @@ import I from 'immutable'
 import * as Quarx from 'quarx'
 import { type PageNode } from './page'
 import { type Opt, type WithRange, textWithRange, select, selectOne, findDuplicates, calculateElementPositions, expectValue, type HasRange, join, equalsOpt, equalsWithRange, tripleEq, equalsPos, equalsArray, PathKind, TocNodeKind, NOWHERE } from './utils'
-import { Fileish, type ValidationCheck, ValidationKind } from './fileish'
+import { Fileish, FactsKind, type ValidationCheck, ValidationKind } from './fileish'
 import { getCCLicense } from './cc-license'
+import { RangeInterner } from './ranges'
 
 const equalsTocNodeWithRange = (n1: TocNodeWithRange, n2: TocNodeWithRange): boolean => {
   /* istanbul ignore else */
@@ -27,6 +28,60 @@ export type TocNodeWithRange = TocPageWithRange | TocSubbookWithRange
 export type TocSubbookWithRange = HasRange & { readonly type: TocNodeKind.Subbook, title: string, children: TocNodeWithRange[] }
 export type TocPageWithRange = HasRange & { readonly type: TocNodeKind.Page, readonly page: PageNode }
 
+// Everything a BookNode needs from its XML, as plain data (see PageFacts)
+export type TocNodeFact = HasRange & ({ type: TocNodeKind.Subbook, title: string, children: TocNodeFact[] } | { type: TocNodeKind.Page, pageId: string })
+export interface BookFacts {
+  uuid: WithRange<string>
+  title: WithRange<string>
+  slug: WithRange<string>
+  language: WithRange<string>
+  licenseUrl: WithRange<string>
+  licenseText: WithRange<string>
+  toc: TocNodeFact[]
+}
+
+export function extractBookFacts(doc: Document): BookFacts {
+  return {
+    uuid: textWithRange(selectOne('/col:collection/col:metadata/md:uuid', doc)),
+    title: textWithRange(selectOne('/col:collection/col:metadata/md:title', doc)),
+    slug: textWithRange(selectOne('/col:collection/col:metadata/md:slug', doc)),
+    language: textWithRange(selectOne('/col:collection/col:metadata/md:language', doc)),
+    licenseUrl: textWithRange(selectOne('/col:collection/col:metadata/md:license', doc), 'url'),
+    licenseText: textWithRange(selectOne('/col:collection/col:metadata/md:license', doc)),
+    toc: extractTocChildren(selectOne('/col:collection/col:content', doc))
+  }
+}
+
+function extractTocChildren(root: Element): TocNodeFact[] {
+  return (select('./col:*', root) as Element[]).map((childNode): TocNodeFact => {
+    const range = calculateElementPositions(childNode)
+    switch (childNode.localName) {
+      case 'subcollection': {
+        const titleNode = selectOne('md:title', childNode)
+        const range = calculateElementPositions(titleNode)
+        return {
+          type: TocNodeKind.Subbook,
+          title: expectValue(titleNode.textContent, 'ERROR: Malformed or missing md:title element in Subcollection'),
+          children: extractTocChildren(selectOne('./col:content', childNode)),
+          range
+        }
+      }
+      case 'module': {
+        const pageId = expectValue(selectOne('@document', childNode).nodeValue, 'BUG: missing @document on col:module')
+        return {
+          type: TocNodeKind.Page,
+          pageId,
+          range
+        }
+      }
+      /* istanbul ignore next */
+      default:
+        /* istanbul ignore next */
+        throw new Error(`ERROR: Unknown element in the ToC. '${childNode.localName}'`)
+    }
+  })
+}
+
 export class BookNode extends Fileish {
   private readonly _uuid = Quarx.observable.box<Opt<WithRange<string>>>(undefined, { equals: equalsOptWithRange })
   private readonly _title = Quarx.observable.box<Opt<WithRange<string>>>(undefined, { equals: equalsOptWithRange })
@@ -36,47 +91,30 @@ export class BookNode extends Fileish {
   private readonly _licenseText = Quarx.observable.box<Opt<WithRange<string>>>(undefined, { equals: equalsOptWithRange })
   private readonly _toc = Quarx.observable.box<Opt<TocNodeWithRange[]>>(undefined, { equals: equalsOptArrayToc })
 
-  protected parseXML = (doc: Document) => {
-    this._uuid.set(textWithRange(selectOne('/col:collection/col:metadata/md:uuid', doc)))
-    this._title.set(textWithRange(selectOne('/col:collection/col:metadata/md:title', doc)))
-    this._slug.set(textWithRange(selectOne('/col:collection/col:metadata/md:slug', doc)))
-    this._language.set(textWithRange(selectOne('/col:collection/col:metadata/md:language', doc)))
-    this._licenseUrl.set(textWithRange(selectOne('/col:collection/col:metadata/md:license', doc), 'url'))
-    this._licenseText.set(textWithRange(selectOne('/col:collection/col:metadata/md:license', doc)))
-    const root: Element = selectOne('/col:collection/col:content', doc)
-    this._toc.set(this.buildChildren(root))
-  }
-
-  private buildChildren(root: Element): TocNodeWithRange[] {
-    const ret = (select('./col:*', root) as Element[]).map((childNode): TocNodeWithRange => {
-      const range = calculateElementPositions(childNode)
-      switch (childNode.localName) {
-        case 'subcollection': {
-          const titleNode = selectOne('md:title', childNode)
-          const range = calculateElementPositions(titleNode)
-          return {
-            type: TocNodeKind.Subbook,
-            title: expectValue(titleNode.textContent, 'ERROR: Malformed or missing md:title element in Subcollection'),
-            children: this.buildChildren(selectOne('./col:content', childNode)),
-            range
-          }
-        }
-        case 'module': {
-          const pageId = expectValue(selectOne('@document', childNode).nodeValue, 'BUG: missing @document on col:module')
-          const page = super.bundle.allPages.getOrAdd(join(this.pathHelper, PathKind.COLLECTION_TO_MODULEID, this.absPath, pageId))
-          return {
-            type: TocNodeKind.Page,
-            page,
-            range
-          }
-        }
-        /* istanbul ignore next */
-        default:
-          /* istanbul ignore next */
-          throw new Error(`ERROR: Unknown element in the ToC. '${childNode.localName}'`)
+  public readonly factsKind = FactsKind.BOOK
+  protected parseXML = (doc: Document) => { this.installFacts(extractBookFacts(doc)) }
+
+  protected installFacts = (facts: BookFacts) => {
+    const compact = new RangeInterner()
+    this._uuid.set(compact.withRange(facts.uuid))
+    this._title.set(compact.withRange(facts.title))
+    this._slug.set(compact.withRange(facts.slug))
+    this._language.set(compact.withRange(facts.language))
+    this._licenseUrl.set(compact.withRange(facts.licenseUrl))
+    this._licenseText.set(compact.withRange(facts.licenseText))
+    this._toc.set(this.buildChildren(facts.toc, compact))
+  }
+
+  private buildChildren(children: TocNodeFact[], compact: RangeInterner): TocNodeWithRange[] {
+    return children.map((child): TocNodeWithRange => {
+      const range = compact.range(child.range)
+      if (child.type === TocNodeKind.Subbook) {
+        return { type: TocNodeKind.Subbook, title: child.title, children: this.buildChildren(child.children, compact), range }
+      } else {
+        const page = this.bundle.allPages.getOrAdd(join(this.pathHelper, PathKind.COLLECTION_TO_MODULEID, this.absPath, child.pageId))
+        return { type: TocNodeKind.Page, page, range }
       }
     })
-    return ret
   }
 
   private get __toc() {
@@ -1,6 +1,10 @@
 import { expect } from '@jest/globals'
+import I from 'immutable'
 import { type Bundle, BundleValidationKind } from './bundle'
-import { bookMaker, bundleMaker, expectErrors, first, loadSuccess, makeBundle, read } from './spec-helpers.spec'
+import { type Fileish } from './fileish'
+import { PageNode } from './page'
+import { H5PExercise } from './h5p-exercise'
+import { bookMaker, bundleMaker, expectErrors, first, loadSuccess, makeBundle, pageMaker, read } from './spec-helpers.spec'
 
 describe('Bundle validations', () => {
   it(BundleValidationKind.NO_BOOKS.title, () => {
@@ -44,3 +48,56 @@ describe('Happy path', () => {
     loadSuccess(page)
   })
 })
+
+describe('Orphans', () => {
+  const paths = (nodes: I.Set<Fileish>) => nodes.map(n => n.absPath).toArray().sort()
+  // What the orphans used to be recomputed as on every read
+  const recomputed = (bundle: Bundle) => {
+    const books = bundle.books.filter(b => b.isLoaded && b.exists)
+    const pages = books.flatMap(b => b.pages).filter(p => p.isLoaded && p.exists)
+    return {
+      books: paths(bundle.allBooks.all.filter(n => n.isLoaded).subtract(bundle.books)),
+      pages: paths(bundle.allPages.all.filter(n => n.isLoaded).subtract(books.flatMap(b => b.pages))),
+      resources: paths(bundle.allResources.all.filter(n => n.isLoaded).subtract(pages.flatMap(p => p.resources))),
+      h5p: paths(bundle.allH5P.all.filter(n => n.isLoaded).subtract(pages.flatMap(p => p.h5p)))
+    }
+  }
+  const maintained = (bundle: Bundle) => ({
+    books: paths(bundle.orphanedBooks),
+    pages: paths(bundle.orphanedPages),
+    resources: paths(bundle.orphanedResources),
+    h5p: paths(bundle.orphanedH5P)
+  })
+
+  it('are kept up to date as books and pages change', () => {
+    const bundle = makeBundle()
+    const check = () => { expect(maintained(bundle)).toEqual(recomputed(bundle)) }
+    const loadAll = () => { bundle.allNodes.filter(n => !n.isLoaded).forEach(n => { n.load(n instanceof PageNode ? pageMaker({}) : 'bits') }) }
+    bundle.load(bundleMaker({ books: ['slug1'] }))
+    const book = first(bundle.books)
+    book.load(bookMaker({ toc: ['m1'] }))
+    const other = bundle.allBooks.getOrAdd(bundle.pathHelper.join(bundle.workspaceRootUri, 'collections/other.collection.xml'))
+    other.load(bookMaker({ slug: 'other', toc: ['m2'] }))
+    const [m1, m2] = ['m1', 'm2'].map(id => bundle.allPages.getOrAdd(bundle.pathHelper.join(bundle.workspaceRootUri, 'modules', id, 'index.cnxml')))
+    m1.load(pageMaker({ imageHrefs: ['../../media/a.png', '../../media/shared.png'] }))
+    m2.load(pageMaker({ imageHrefs: ['../../media/b.png', '../../media/shared.png'], pageLinks: [{ url: `${H5PExercise.PLACEHOLDER}/abc` }] }))
+    loadAll()
+    check()
+    expect(maintained(bundle).pages).toEqual([m2.absPath])
+    expect(maintained(bundle).books).toEqual([other.absPath])
+
+    book.load(bookMaker({ toc: ['m2'] }))
+    check()
+    expect(maintained(bundle).pages).toEqual([m1.absPath])
+
+    m2.load(undefined)
+    check()
+    book.load(bookMaker({ toc: ['m1', 'm2'] }))
+    m2.load(pageMaker({}))
+    check()
+
+    bundle.load(bundleMaker({}))
+    check()
+    expect(maintained(bundle).pages).toEqual(paths(I.Set([m1, m2])))
+  })
+})
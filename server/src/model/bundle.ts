@@ -1,22 +1,31 @@
 import I from 'immutable'
 import * as Quarx from 'quarx'
-import { type Bundleish, findDuplicates, type Opt, type PathHelper, PathKind, select, type WithRange, calculateElementPositions, expectValue, NOWHERE, join } from './utils'
+import { type Bundleish, type Opt, type PathHelper, PathKind, select, type WithRange, calculateElementPositions, expectValue, NOWHERE, join } from './utils'
 import { Factory } from './factory'
 import { PageNode } from './page'
 import { BookNode } from './book'
 import { Fileish, type ValidationCheck, ValidationKind } from './fileish'
 import { ResourceNode } from './resource'
 import { H5PExercise } from './h5p-exercise'
+import { DuplicateIndex } from './duplicate-index'
+import { OrphanIndex } from './orphan-index'
 
 export class Bundle extends Fileish implements Bundleish {
-  public readonly allResources: Factory<ResourceNode> = new Factory<ResourceNode>((absPath: string) => new ResourceNode(this, this.pathHelper, absPath), (x) => this.pathHelper.canonicalize(x))
-  public readonly allPages: Factory<PageNode> = new Factory<PageNode>((absPath: string) => new PageNode(this, this.pathHelper, absPath), (x) => this.pathHelper.canonicalize(x))
-  public readonly allH5P: Factory<H5PExercise> = new Factory<H5PExercise>((absPath: string) => new H5PExercise(this, this.pathHelper, absPath), (x) => this.pathHelper.canonicalize(x))
-  public readonly allBooks = new Factory((absPath: string) => new BookNode(this, this.pathHelper, absPath), (x) => this.pathHelper.canonicalize(x))
+  public readonly allResources: Factory<ResourceNode> = new Factory<ResourceNode>((absPath: string) => new ResourceNode(this, this.pathHelper, absPath), (x) => this.pathHelper.canonicalize(x), (n) => { this.unindex(n) })
+  public readonly allPages: Factory<PageNode> = new Factory<PageNode>((absPath: string) => new PageNode(this, this.pathHelper, absPath), (x) => this.pathHelper.canonicalize(x), (n) => { this.unindex(n) })
+  public readonly allH5P: Factory<H5PExercise> = new Factory<H5PExercise>((absPath: string) => new H5PExercise(this, this.pathHelper, absPath), (x) => this.pathHelper.canonicalize(x), (n) => { this.unindex(n) })
+  public readonly allBooks = new Factory((absPath: string) => new BookNode(this, this.pathHelper, absPath), (x) => this.pathHelper.canonicalize(x), (n) => { this.unindex(n) })
   private readonly _books = Quarx.observable.box<Opt<I.Set<WithRange<BookNode>>>>(undefined)
   private readonly _booksXMLBooks = Quarx.observable.box<Opt<I.Set<WithRange<BooksXMLBook>>>>(undefined)
-  private readonly _duplicateFilePaths = Quarx.observable.box<I.Set<string>>(I.Set<string>())
-  private readonly _duplicateUUIDs = Quarx.observable.box<I.Set<string>>(I.Set<string>())
+  // Lowercased paths of the nodes that exist and uuids of the pages that exist
+  private readonly _filePaths = new DuplicateIndex<string, Fileish>()
+  private readonly _uuids = new DuplicateIndex<string, Fileish>()
+  private readonly _indexed = new Map<Fileish, { path: Opt<string>, uuid: Opt<string> }>()
+  // Fileish.dependencies of every loaded node, and the reverse
+  private readonly _dependencies = new Map<Fileish, I.Set<Fileish>>()
+  private readonly _referrers = new Map<Fileish, Set<Fileish>>()
+  private readonly _changeListeners: Array<(affected: I.Set<Fileish>) => void> = []
+  private readonly _orphans = new OrphanIndex(this, n => this.keepsFromBeingOrphans(n))
   // TODO: parse these from META-INF/books.xml
   public readonly paths = {
     publicRoot: 'interactives',
@@ -29,26 +38,86 @@ export class Bundle extends Fileish implements Bundleish {
   constructor(pathHelper: PathHelper<string>, public readonly workspaceRootUri: string) {
     super(undefined, pathHelper, pathHelper.join(workspaceRootUri, 'META-INF/books.xml'))
     super.setBundle(this)
-    Quarx.autorun(() => {
-      this._duplicateFilePaths.set(
-        I.Set(
-          findDuplicates(
-            I.List(this.allNodes)
-              .filter(n => n.exists)
-              .map(n => n.absPath.toLowerCase())
-          )
-        )
-      )
+  }
+
+  // Keeps the indexes up to date, one node at a time, and tells the
+  // listeners which nodes may now have different validation errors
+  public onNodeLoaded(node: Fileish) {
+    const before = this._indexed.get(node)
+    const path = node.exists ? node.absPath.toLowerCase() : undefined
+    const uuid = node.exists && node instanceof PageNode ? node.uuid() : undefined
+    Quarx.batch(() => {
+      replaceKey(this._filePaths, node, before?.path, path)
+      replaceKey(this._uuids, node, before?.uuid, uuid)
     })
-    Quarx.autorun(() => {
-      this._duplicateUUIDs.set(
-        I.Set(
-          findDuplicates(
-            I.List(this.allPages.all).filter(n => n.exists).map(n => n.uuid())
-          )
-        )
-      )
+    if (path === undefined && uuid === undefined) {
+      this._indexed.delete(node)
+    } else {
+      this._indexed.set(node, { path, uuid })
+    }
+    this.setDependencies(node, node.dependencies)
+    this._orphans.update(node)
+
+    if (this._changeListeners.length > 0) {
+      const lowerPath = node.absPath.toLowerCase()
+      const affected = I.Set<Fileish>().withMutations(s => {
+        s.add(node)
+        this.referrersOf(node).forEach(n => s.add(n))
+        for (const n of this._filePaths.itemsWith(lowerPath)) s.add(n)
+        const uuids = [before?.uuid, uuid].filter((u): u is string => u !== undefined)
+        uuids.forEach(u => { for (const n of this._uuids.itemsWith(u)) s.add(n) })
+      })
+      this._changeListeners.forEach(l => { l(affected) })
+    }
+  }
+
+  // Called with the nodes whose validation errors may have changed after a node was loaded
+  public onChange(listener: (affected: I.Set<Fileish>) => void) {
+    this._changeListeners.push(listener)
+  }
+
+  // Called whenever a node becomes an orphan or stops being one
+  public onOrphanChange(listener: (node: Fileish, isOrphan: boolean) => void) {
+    this._orphans.onChange(listener)
+  }
+
+  // The nodes whose validation checks depend on this node (the reverse of Fileish.dependencies)
+  public referrersOf(node: Fileish) {
+    return I.Set(this._referrers.get(node) ?? [])
+  }
+
+  private setDependencies(node: Fileish, dependencies: I.Set<Fileish>) {
+    const old = this._dependencies.get(node) ?? I.Set<Fileish>()
+    old.subtract(dependencies).forEach(d => {
+      const referrers = this._referrers.get(d)
+      referrers?.delete(node)
+      if (referrers?.size === 0) this._referrers.delete(d)
     })
+    dependencies.subtract(old).forEach(d => {
+      let referrers = this._referrers.get(d)
+      if (referrers === undefined) {
+        referrers = new Set()
+        this._referrers.set(d, referrers)
+      }
+      referrers.add(node)
+    })
+    if (dependencies.isEmpty()) {
+      this._dependencies.delete(node)
+    } else {
+      this._dependencies.set(node, dependencies)
+    }
+  }
+
+  private unindex(node: Fileish) {
+    this.setDependencies(node, I.Set())
+    this._orphans.remove(node)
+    const before = this._indexed.get(node)
+    if (before === undefined) return
+    Quarx.batch(() => {
+      replaceKey(this._filePaths, node, before.path, undefined)
+      replaceKey(this._uuids, node, before.uuid, undefined)
+    })
+    this._indexed.delete(node)
   }
 
   protected parseXML = (doc: Document) => {
@@ -81,12 +150,34 @@ export class Bundle extends Fileish implements Bundleish {
       .union(this.allResources.all)
   }
 
+  // Loaded nodes that are not in a book (pages) or in a page of a book (resources and H5P)
+  public get orphanedBooks(): I.Set<BookNode> {
+    return this.exists ? this._orphans.orphansOf(BookNode) : this.allBooks.all.filter(n => n.isLoaded)
+  }
+
+  public get orphanedPages() { return this._orphans.orphansOf(PageNode) }
+  public get orphanedResources() { return this._orphans.orphansOf(ResourceNode) }
+  public get orphanedH5P() { return this._orphans.orphansOf(H5PExercise) }
+
+  private keepsFromBeingOrphans(node: Fileish): I.Set<Fileish> {
+    if (node === this) {
+      return this._books.get()?.map(b => b.v) ?? I.Set()
+    } else if (!node.isLoaded || !node.exists) {
+      return I.Set()
+    } else if (node instanceof BookNode) {
+      return I.Set(node.pages)
+    } else if (node instanceof PageNode) {
+      return I.Set<Fileish>(node.resources).union(node.h5p)
+    }
+    return I.Set()
+  }
+
   public get books() {
     return this.__books().map(b => b.v)
   }
 
   public isDuplicateFilePath(path: string): boolean {
-    return this._duplicateFilePaths.get().has(path.toLowerCase())
+    return this._filePaths.isDuplicate(path.toLowerCase())
   }
 
   private __books() {
@@ -94,7 +185,7 @@ export class Bundle extends Fileish implements Bundleish {
   }
 
   public isDuplicateUuid(uuid: string) {
-    return this._duplicateUUIDs.get().has(uuid)
+    return this._uuids.isDuplicate(uuid)
   }
 
   protected getValidationChecks(): ValidationCheck[] {
@@ -142,6 +233,12 @@ export class BundleValidationKind extends ValidationKind {
   static NO_BOOKS = new BundleValidationKind('No books defined')
 }
 
+function replaceKey(index: DuplicateIndex<string, Fileish>, node: Fileish, before: Opt<string>, after: Opt<string>) {
+  if (before === after) return
+  if (before !== undefined) index.delete(before, node)
+  if (after !== undefined) index.add(after, node)
+}
+
 interface BooksXMLBook {
   slug: string
   href: string
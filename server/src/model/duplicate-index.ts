@@ -0,0 +1,40 @@
+import * as Quarx from 'quarx'
+
+// Remembers which items have each key. Checking whether a key is a
+// duplicate is O(1) and each key has its own observable, so only the
+// observers of a key rerun when it starts or stops being a duplicate.
+export class DuplicateIndex<K, V> {
+  private readonly items = new Map<K, Set<V>>()
+  private readonly duplicates = new Map<K, Quarx.Box<boolean>>()
+
+  public add(key: K, item: V) {
+    let items = this.items.get(key)
+    if (items === undefined) {
+      items = new Set()
+      this.items.set(key, items)
+    }
+    items.add(item)
+    this.duplicates.get(key)?.set(items.size > 1)
+  }
+
+  public delete(key: K, item: V) {
+    const items = this.items.get(key)
+    if (items === undefined) return
+    items.delete(item)
+    if (items.size === 0) this.items.delete(key)
+    this.duplicates.get(key)?.set(items.size > 1)
+  }
+
+  public itemsWith(key: K): Iterable<V> {
+    return this.items.get(key) ?? []
+  }
+
+  public isDuplicate(key: K) {
+    let box = this.duplicates.get(key)
+    if (box === undefined) {
+      box = Quarx.observable.box((this.items.get(key)?.size ?? 0) > 1)
+      this.duplicates.set(key, box)
+    }
+    return box.get()
+  }
+}
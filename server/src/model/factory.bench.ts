@@ -0,0 +1,35 @@
+import { expect } from '@jest/globals'
+import I from 'immutable'
+import { Factory } from './factory'
+import { bench, report } from '../bench-helpers.bench'
+
+// What findByKeyPrefix and all used to do
+const scanByKeyPrefix = <T>(m: I.Map<string, T>, prefix: string) => I.Set(m.filter((_, key) => key.startsWith(prefix)).values())
+
+function makeFactory(size: number) {
+  const f = new Factory((x) => ({ absPath: x }), (x) => x)
+  const pages = Math.floor(size / 10)
+  for (let i = 0; i < pages; i++) f.getOrAdd(`/repo/modules/m${i}/index.cnxml`)
+  for (let i = pages; i < size; i++) f.getOrAdd(`/repo/media/image-${i}.png`)
+  return f
+}
+
+describe('Factory', () => {
+  it('finds keys by prefix and lists all items without scanning every key', () => {
+    for (const size of [10_000, 50_000, 100_000]) {
+      const f = makeFactory(size)
+      const m = I.Map(f.all.toArray().map(o => [o.absPath, o] as [string, { absPath: string }]))
+      const prefix = '/repo/modules/m42/'
+      expect(f.findByKeyPrefix(prefix)).toEqual(scanByKeyPrefix(m, prefix))
+      const results = [
+        bench('findByKeyPrefix: filter every key', 20, () => scanByKeyPrefix(m, prefix)),
+        bench('findByKeyPrefix: path trie', 20, () => f.findByKeyPrefix(prefix)),
+        bench('all: new Set every read', 20, () => I.Set(m.values())),
+        bench('all: cached until the next change', 20, () => f.all)
+      ]
+      report(`Factory with ${size} items`, results)
+      expect(results[1].msPerOp).toBeLessThan(results[0].msPerOp)
+      expect(results[3].msPerOp).toBeLessThan(results[2].msPerOp)
+    }
+  })
+})
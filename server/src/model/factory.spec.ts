@@ -26,4 +26,33 @@ describe('Factory', () => {
     expect(found.size).toEqual(2)
     expect(f.size).toEqual(4)
   })
+  it('findByKeyPrefix matches partial path segments and forgets removed keys', () => {
+    const f = new Factory((x) => ({ foo: x }), (x) => x)
+    const keys = ['/repo/modules/m1/index.cnxml', '/repo/modules/m12/index.cnxml', '/repo/modules/m2/index.cnxml', '/repo/media/m1.png', '/repo/modules']
+    keys.forEach(k => f.getOrAdd(k))
+    const found = (prefix: string) => f.findByKeyPrefix(prefix).map(o => o.foo).toArray().sort()
+    expect(found('/repo/modules/m1')).toEqual(['/repo/modules/m1/index.cnxml', '/repo/modules/m12/index.cnxml'])
+    expect(found('/repo/modules/m1/')).toEqual(['/repo/modules/m1/index.cnxml'])
+    expect(found('/repo/modules')).toEqual(['/repo/modules', '/repo/modules/m1/index.cnxml', '/repo/modules/m12/index.cnxml', '/repo/modules/m2/index.cnxml'])
+    expect(found('/repo/m')).toEqual([...keys].sort())
+    expect(found('')).toEqual([...keys].sort())
+    expect(found('/other')).toEqual([])
+
+    f.remove('/repo/modules/m12/index.cnxml')
+    f.remove('/repo/modules')
+    f.remove('/not/there')
+    expect(found('/repo/modules')).toEqual(['/repo/modules/m1/index.cnxml', '/repo/modules/m2/index.cnxml'])
+    expect(f.size).toEqual(3)
+  })
+  it('reuses the same all set until something is added or removed', () => {
+    const f = new Factory((x) => ({ foo: x }), (x) => x)
+    f.getOrAdd('a')
+    const all = f.all
+    expect(f.all).toBe(all)
+    f.getOrAdd('a')
+    expect(f.all).toBe(all)
+    f.getOrAdd('b')
+    expect(f.all).not.toBe(all)
+    expect(f.all.size).toBe(2)
+  })
 })
@@ -1,9 +1,18 @@
 import * as Quarx from 'quarx'
 import I from 'immutable'
 import { type Opt } from './utils'
+
+// One path segment of the keys. Lets findByKeyPrefix visit only the keys that
+// share the prefix instead of every key.
+interface TrieNode<T> { children: Map<string, TrieNode<T>>, item: Opt<T>, hasItem: boolean }
+const newTrieNode = <T>(): TrieNode<T> => ({ children: new Map(), item: undefined, hasItem: false })
+const SEPARATOR = '/'
+
 export class Factory<T> {
   private readonly _map = Quarx.observable.box(I.Map<string, T>())
-  constructor(private readonly builder: (filePath: string) => T, private readonly canonicalizer: (filePath: string) => string) { }
+  private readonly _trie = newTrieNode<T>()
+  private _allCache: Opt<{ map: I.Map<string, T>, all: I.Set<T> }>
+  constructor(private readonly builder: (filePath: string) => T, private readonly canonicalizer: (filePath: string) => string, private readonly onRemove?: (item: T) => void) { }
   get(absPath: string): Opt<T> {
     const m = this._map.get()
     return m.get(absPath)
@@ -17,6 +26,7 @@ export class Factory<T> {
       return v
     } else {
       const n = this.builder(absPath)
+      this.trieAdd(absPath, n)
       this._map.set(m.set(absPath, n))
       return n
     }
@@ -26,17 +36,76 @@ export class Factory<T> {
     absPath = this.canonicalizer(absPath)
     const m = this._map.get()
     const item = m.get(absPath)
+    if (item !== undefined) this.trieRemove(absPath)
     this._map.set(m.delete(absPath))
+    if (item !== undefined) this.onRemove?.(item)
     return item
   }
 
   public findByKeyPrefix(pathPrefix: string) {
     pathPrefix = this.canonicalizer(pathPrefix)
-    const m = this._map.get()
-    const matchingItems = m.filter((_, key) => key.startsWith(pathPrefix))
-    return I.Set(matchingItems.values())
+    this._map.get() // So observers of this query rerun when items are added or removed
+    const segments = pathPrefix.split(SEPARATOR)
+    const last = segments.pop() as string
+    let node: Opt<TrieNode<T>> = this._trie
+    for (const s of segments) {
+      node = node.children.get(s)
+      if (node === undefined) return I.Set<T>()
+    }
+    const found: T[] = []
+    node.children.forEach((child, name) => {
+      if (name.startsWith(last)) collectItems(child, found)
+    })
+    return I.Set(found)
   }
 
   public get size() { return this._map.get().size }
-  public get all() { return I.Set(this._map.get().values()) }
+  // Reading this is free until the next add or remove
+  public get all() {
+    const map = this._map.get()
+    let cache = this._allCache
+    if (cache === undefined || cache.map !== map) {
+      cache = { map, all: I.Set(map.values()) }
+      this._allCache = cache
+    }
+    return cache.all
+  }
+
+  private trieAdd(absPath: string, item: T) {
+    let node = this._trie
+    for (const s of absPath.split(SEPARATOR)) {
+      let child = node.children.get(s)
+      if (child === undefined) {
+        child = newTrieNode()
+        node.children.set(s, child)
+      }
+      node = child
+    }
+    node.item = item
+    node.hasItem = true
+  }
+
+  private trieRemove(absPath: string) {
+    // Remember the path down so empty branches can be pruned on the way back up
+    const path: Array<[TrieNode<T>, string]> = []
+    let node = this._trie
+    for (const s of absPath.split(SEPARATOR)) {
+      const child = node.children.get(s)
+      if (child === undefined) return
+      path.push([node, s])
+      node = child
+    }
+    node.item = undefined
+    node.hasItem = false
+    for (let i = path.length - 1; i >= 0 && !node.hasItem && node.children.size === 0; i--) {
+      const [parent, s] = path[i]
+      parent.children.delete(s)
+      node = parent
+    }
+  }
+}
+
+function collectItems<T>(node: TrieNode<T>, acc: T[]) {
+  if (node.hasItem) acc.push(node.item as T)
+  node.children.forEach(child => { collectItems(child, acc) })
 }
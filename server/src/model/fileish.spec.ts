@@ -13,6 +13,11 @@ describe('The abstract ancestor class', () => {
       throw new Error('I-always-throw-an-error')
     }
   }
+  class MyFactsNode extends MyNode {
+    protected installFacts = (facts: unknown) => {
+      throw new Error('I-always-throw-an-error')
+    }
+  }
   beforeEach(() => { previousNodeEnv = process.env.NODE_ENV })
   afterEach(() => { process.env.NODE_ENV = previousNodeEnv })
   it('marks a missing file as loaded but not existing', () => {
@@ -50,4 +55,14 @@ describe('The abstract ancestor class', () => {
     const err = first(f.validationErrors.errors)
     expect(err.title).toBe('I-always-throw-an-error')
   })
+  it('sends errors while installing facts as a diagnostic message in production (instead of throwing them)', () => {
+    process.env.NODE_ENV = 'production'
+    const f = new MyFactsNode(makeBundle(), FS_PATH_HELPER, '/to/nowhere/filename')
+    f.loadFacts({ facts: {} })
+    expect(f.isLoaded).toBe(false)
+    expect(f.validationErrors.errors.size).toBe(1)
+    expect(first(f.validationErrors.errors).title).toBe('I-always-throw-an-error')
+    process.env.NODE_ENV = 'development'
+    expect(() => { f.loadFacts({ facts: {} }) }).toThrow('I-always-throw-an-error')
+  })
 })
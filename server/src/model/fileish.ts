@@ -48,12 +48,53 @@ function toValidationErrors(node: Fileish, message: ValidationKind, sources: I.S
   return sources.map(s => new ModelError(node, message.title, message.severity, s))
 }
 
+export enum FactsKind {
+  PAGE = 'page',
+  BOOK = 'book'
+}
+
+// A serializable version of a ParseError
+export interface ParseErrorFact extends HasRange {
+  message: string
+}
+export type FactsResult<T> = { facts: T, error?: undefined } | { error: ParseErrorFact }
+
+export function readXML(fileContent: string): { doc: Document, error: Opt<ParseErrorFact> } {
+  const locator = { lineNumber: 0, columnNumber: 0 }
+  const errors: ParseErrorFact[] = []
+  const cb = (msg: string) => {
+    const pos = {
+      line: locator.lineNumber - 1,
+      character: locator.columnNumber - 1
+    }
+    errors.push({ message: msg, range: { start: pos, end: pos } })
+  }
+  const p = new DOMParser({
+    locator,
+    errorHandler: {
+      warning: console.warn,
+      error: cb,
+      fatalError: cb
+    }
+  })
+  const doc = p.parseFromString(fileContent)
+  // Only the last error is reported
+  return { doc, error: errors[errors.length - 1] }
+}
+
 export abstract class Fileish {
   private readonly _isLoaded = Quarx.observable.box(false)
   private readonly _exists = Quarx.observable.box(false)
   private readonly _parseError = Quarx.observable.box<Opt<ParseError>>(undefined)
   public readonly absPath
   protected parseXML: Opt<(doc: Document) => void> // Subclasses define this
+  // Subclasses whose parseXML can be split into a pure extraction step (that
+  // can run off the main thread) and an install step also define these
+  public readonly factsKind: Opt<FactsKind>
+  protected installFacts: Opt<(facts: any) => void>
+  // Optional fast path that pulls the facts straight out of the text. It
+  // returns undefined when it cannot, in which case the XML is parsed normally
+  protected scanFacts: Opt<(fileContent: string) => Opt<unknown>>
 
   constructor(private _bundle: Opt<Bundleish>, public pathHelper: PathHelper<string>, absPath: string) {
     this.absPath = this.pathHelper.canonicalize(absPath)
@@ -70,6 +111,9 @@ export abstract class Fileish {
   }
 
   public get exists() { return this._exists.get() }
+  // Whether load() needs the contents of the file. The rest (images, H5P
+  // manifests) only need to know whether it is there
+  public get readsContent() { return this.parseXML !== undefined }
   // Update this Node, and collect all Parse errors
   public load(fileContent: Opt<string>): void {
     Fileish.debug(this.workspacePath, 'update() started')
@@ -86,9 +130,17 @@ export abstract class Fileish {
         // Development version throws errors instead of turning them into messages
         const parseXML = this.parseXML
         const fn = () => {
-          const doc = this.readXML(fileContent)
-          if (!this.isValidXML) return
-          parseXML(doc)
+          const facts = this.scanFacts?.(fileContent)
+          if (facts !== undefined) {
+            expectValue(this.installFacts, 'BUG: Nodes that scan facts must be able to install them')(facts)
+          } else {
+            const { doc, error } = readXML(fileContent)
+            if (error !== undefined) {
+              this._parseError.set(new ParseError(this, error.message, ValidationSeverity.ERROR, error.range))
+              return
+            }
+            parseXML(doc)
+          }
           this._isLoaded.set(true)
           this._exists.set(true)
         }
@@ -107,6 +159,7 @@ export abstract class Fileish {
         this._isLoaded.set(true)
       }
     })
+    this._bundle?.onNodeLoaded(this)
     Fileish.debug(this.workspacePath, 'update done')
   }
 
@@ -114,25 +167,41 @@ export abstract class Fileish {
     return this._parseError.get() === undefined
   }
 
-  private readXML(fileContent: string) {
-    const locator = { lineNumber: 0, columnNumber: 0 }
-    const cb = (msg: string) => {
-      const pos = {
-        line: locator.lineNumber - 1,
-        character: locator.columnNumber - 1
+  // Every node that one of the validation checks needs. Only known once this
+  // node is loaded. The unloaded ones are the same as validationErrors.nodesToLoad
+  // but this does not run the checks.
+  public get dependencies(): I.Set<Fileish> {
+    if (!this.isLoaded || !this.exists || !this.isValidXML) return I.Set()
+    return I.Set(this.getValidationChecks()).flatMap(c => c.nodesToLoad)
+  }
+
+  // Install facts that were extracted somewhere else (e.g. in a worker thread)
+  // from this file's contents. See ../parse-worker.ts
+  public loadFacts(result: FactsResult<unknown>): void {
+    const installFacts = expectValue(this.installFacts, `BUG: This node does not support loading facts [${this.absPath}]`)
+    Fileish.debug(this.workspacePath, 'loadFacts() started')
+    Quarx.batch(() => {
+      if (result.error !== undefined) {
+        const { message, range } = result.error
+        this._parseError.set(new ParseError(this, message, ValidationSeverity.ERROR, range))
+        return
       }
-      this._parseError.set(new ParseError(this, msg, ValidationSeverity.ERROR, { start: pos, end: pos }))
-    }
-    const p = new DOMParser({
-      locator,
-      errorHandler: {
-        warning: console.warn,
-        error: cb,
-        fatalError: cb
+      this._parseError.set(undefined)
+      try {
+        installFacts(result.facts)
+        this._isLoaded.set(true)
+        this._exists.set(true)
+      } catch (err) {
+        // Same as load()
+        const e = err as Error
+        this._parseError.set(new WrappedParseError(this, e))
+        if (process.env.NODE_ENV !== 'production') {
+          throw e
+        }
       }
     })
-    const doc = p.parseFromString(fileContent)
-    return doc
+    this._bundle?.onNodeLoaded(this)
+    Fileish.debug(this.workspacePath, 'loadFacts done')
   }
 
   public get validationErrors(): ValidationResponse {
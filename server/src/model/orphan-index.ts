@@ -0,0 +1,117 @@
+import I from 'immutable'
+import * as Quarx from 'quarx'
+import { type Fileish } from './fileish'
+
+type NodeType<T> = abstract new (...args: any[]) => T
+const typeOf = (node: Fileish) => node.constructor as NodeType<Fileish>
+
+// Keeps track of which loaded nodes cannot be reached from the root (the
+// Bundle) so the orphans do not have to be recomputed from every book and
+// page each time something changes.
+//
+// `childrenOf` returns the nodes that a node keeps from being orphans while
+// it is reachable. Each node counts how many reachable nodes list it. Only the
+// nodes whose count goes to or from zero (and their children) are revisited.
+export class OrphanIndex {
+  private readonly refCounts = new Map<Fileish, number>()
+  // What each reachable node currently contributes to the counts
+  private readonly children = new Map<Fileish, I.Set<Fileish>>()
+  private readonly orphansByType = new Map<NodeType<Fileish>, Quarx.Box<I.Set<Fileish>>>()
+  private readonly listeners: Array<(node: Fileish, isOrphan: boolean) => void> = []
+
+  constructor(private readonly root: Fileish, private readonly childrenOf: (n: Fileish) => I.Set<Fileish>) { }
+
+  // Call this after a node was (re)loaded
+  public update(node: Fileish) {
+    Quarx.batch(() => {
+      if (this.isReachable(node)) {
+        this.setChildren(node, this.childrenOf(node))
+      }
+      this.refresh(node)
+    })
+  }
+
+  // Call this when a node is dropped from the Bundle
+  public remove(node: Fileish) {
+    Quarx.batch(() => {
+      this.setChildren(node, I.Set())
+      const box = this.box(typeOf(node))
+      const orphans = box.get()
+      if (orphans.has(node)) {
+        box.set(orphans.delete(node))
+        this.notify(node, false)
+      }
+    })
+  }
+
+  // Called whenever a node becomes an orphan or stops being one
+  public onChange(listener: (node: Fileish, isOrphan: boolean) => void) {
+    this.listeners.push(listener)
+  }
+
+  public orphansOf<T extends Fileish>(type: NodeType<T>): I.Set<T> {
+    return this.box(type).get() as I.Set<T>
+  }
+
+  private isReachable(node: Fileish) {
+    return node === this.root || (this.refCounts.get(node) ?? 0) > 0
+  }
+
+  private setChildren(node: Fileish, children: I.Set<Fileish>) {
+    const old = this.children.get(node) ?? I.Set<Fileish>()
+    if (children.isEmpty()) {
+      this.children.delete(node)
+    } else {
+      this.children.set(node, children)
+    }
+    children.subtract(old).forEach(c => { this.addRef(c) })
+    old.subtract(children).forEach(c => { this.removeRef(c) })
+  }
+
+  private addRef(node: Fileish) {
+    const count = (this.refCounts.get(node) ?? 0) + 1
+    this.refCounts.set(node, count)
+    if (count === 1) {
+      // Just became reachable so its children are too
+      this.setChildren(node, this.childrenOf(node))
+      this.refresh(node)
+    }
+  }
+
+  private removeRef(node: Fileish) {
+    const count = (this.refCounts.get(node) ?? 0) - 1
+    if (count > 0) {
+      this.refCounts.set(node, count)
+      return
+    }
+    this.refCounts.delete(node)
+    if (node !== this.root) {
+      this.setChildren(node, I.Set())
+      this.refresh(node)
+    }
+  }
+
+  private refresh(node: Fileish) {
+    if (node === this.root) return
+    const box = this.box(typeOf(node))
+    const orphans = box.get()
+    const isOrphan = node.isLoaded && !this.isReachable(node)
+    if (isOrphan !== orphans.has(node)) {
+      box.set(isOrphan ? orphans.add(node) : orphans.delete(node))
+      this.notify(node, isOrphan)
+    }
+  }
+
+  private notify(node: Fileish, isOrphan: boolean) {
+    this.listeners.forEach(l => { l(node, isOrphan) })
+  }
+
+  private box(type: NodeType<Fileish>) {
+    let box = this.orphansByType.get(type)
+    if (box === undefined) {
+      box = Quarx.observable.box(I.Set<Fileish>())
+      this.orphansByType.set(type, box)
+    }
+    return box
+  }
+}
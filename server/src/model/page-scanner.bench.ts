@@ -0,0 +1,45 @@
+import { expect } from '@jest/globals'
+import { readXML } from './fileish'
+import { extractPageFacts } from './page'
+import { rescanPage, scanPage, scanPageFacts } from './page-scanner'
+import { pageMaker } from './spec-helpers.spec'
+import { expectValue } from './utils'
+import { bench, report } from '../bench-helpers.bench'
+
+// Roughly the size of a long textbook section
+function bigPage(paras: number) {
+  const extraCnxml = Array.from({ length: paras }, (_, i) => `<section id="s${i}"><title>Section ${i}</title>
+  <para id="p${i}">Some <emphasis>text</emphasis> with a <link document="m${i}" target-id="p${i}"/> and a <term>term</term>.</para>
+  <figure id="f${i}"><media alt="x"><image src="../../media/img${i}.png" mime-type="image/png"/></media></figure>
+  <para>A paragraph without an id, <link url="https://openstax.org/${i}">link</link>.</para>
+</section>`).join('\n')
+  return pageMaker({ title: 'Big page', extraCnxml })
+}
+
+describe('PageNode parsing', () => {
+  it('scans a page faster and with less memory than xmldom + XPath', () => {
+    const content = bigPage(500)
+    expect(scanPageFacts(content)).toEqual(extractPageFacts(readXML(content).doc))
+    const results = [
+      bench('xmldom + XPath (extractPageFacts)', 20, () => extractPageFacts(readXML(content).doc)),
+      bench('single pass (scanPageFacts)', 20, () => scanPageFacts(content))
+    ]
+    report(`Parsing a ${Math.round(content.length / 1024)} KB page`, results)
+    expect(results[1].msPerOp).toBeLessThan(results[0].msPerOp)
+  })
+  it('rescans an edit inside one paragraph faster than scanning the whole page', () => {
+    const content = bigPage(2000)
+    const prev = expectValue(scanPage(content), 'The scanner should handle the bench page')
+    // Typing in the middle of the page
+    const at = content.indexOf('Some', content.length / 2) + 2
+    const edits = Array.from({ length: 20 }, (_, i) => content.slice(0, at) + 'x'.repeat(i + 1) + content.slice(at))
+    expect(rescanPage(prev, edits[0])?.facts).toEqual(scanPageFacts(edits[0]))
+    let i = 0
+    const results = [
+      bench('whole page (scanPageFacts)', 20, () => scanPageFacts(edits[i++ % edits.length])),
+      bench('only the edited element (rescanPage)', 20, () => rescanPage(prev, edits[i++ % edits.length]))
+    ]
+    report(`Scanning an edit to a ${Math.round(content.length / 1024)} KB page (${content.split('\n').length} lines)`, results)
+    expect(results[1].msPerOp).toBeLessThan(results[0].msPerOp / 10)
+  })
+})
@@ -0,0 +1,107 @@
+import { expect } from '@jest/globals'
+import { readdirSync } from 'fs'
+import * as path from 'path'
+import { readXML } from './fileish'
+import { extractPageFacts } from './page'
+import { rescanPage, scanPage, type ScannedPage, scanPageFacts } from './page-scanner'
+import { pageMaker, read, REPO_ROOT } from './spec-helpers.spec'
+import { expectValue } from './utils'
+
+function expectSameFacts(content: string) {
+  const expected = extractPageFacts(readXML(content).doc)
+  const actual = scanPageFacts(content)
+  expect(actual).toEqual(expected)
+}
+
+describe('scanPageFacts', () => {
+  it('matches xmldom on the pages in this repo', () => {
+    const modulesDir = path.join(REPO_ROOT, 'modules')
+    readdirSync(modulesDir).forEach(m => { expectSameFacts(read(path.join(modulesDir, m, 'index.cnxml'))) })
+  })
+  it('matches xmldom on generated pages', () => {
+    expectSameFacts(pageMaker({}))
+    expectSameFacts(pageMaker({ title: null, documentClass: 'super', super: { subjectName: 'Math', tags: [{ type: 'a', value: 'b' }] } }))
+    expectSameFacts(pageMaker({
+      title: 'Some <emphasis>text</emphasis> &amp; more',
+      elementIds: ['p1', 'p2'],
+      imageHrefs: ['../../media/a.png', ''],
+      pageLinks: [{ url: 'https://openstax.org' }, { targetPage: 'm2' }, { targetId: 'p1' }, {}]
+    }))
+  })
+  it('matches xmldom on element ranges', () => {
+    // Siblings that are text, comments, CDATA and processing instructions; elements with and without attributes
+    expectSameFacts(`<?xml version="1.0"?>
+<document xmlns="http://cnx.rice.edu/cnxml" xmlns:m="http://cnx.rice.edu/mdml"><metadata><m:uuid>u<!-- c -->u<![CDATA[<id>]]></m:uuid></metadata>
+  <content><para/><para></para><para>x</para><!-- c --><note class="a"
+    title='x &lt; y'/><?pi data?><figure id="f1"><![CDATA[y]]></figure><term/>
+    <definition><term/><term id="t1"/></definition><iframe src="http://x"/><iframe src="local.html"/><link
+      document="m1" target-id="&#x41;&#66;" url=""/><cite/></content>
+</document>
+`)
+  })
+  it('treats \\r\\n and \\r as line breaks like xmldom', () => {
+    expectSameFacts(pageMaker({ elementIds: ['a', 'b'] }).replace(/\n/g, '\r\n'))
+    expectSameFacts(pageMaker({ elementIds: ['a', 'b'] }).replace(/\n/g, '\r'))
+  })
+  it('falls back to xmldom when it cannot produce the same result', () => {
+    expect(scanPageFacts(pageMaker({ uuid: 'a</md:uuid><md:uuid>b' }))).toBeUndefined()
+    expect(scanPageFacts(pageMaker({ extraCnxml: '<para>&nbsp;</para>' }))).toBeUndefined()
+    expect(scanPageFacts(pageMaker({ extraCnxml: '<para></note>' }))).toBeUndefined()
+    expect(scanPageFacts(pageMaker({ extraCnxml: '<para id=unquoted/>' }))).toBeUndefined()
+    expect(scanPageFacts(`<!DOCTYPE document>${pageMaker({})}`)).toBeUndefined()
+    expect(scanPageFacts('<notcnxml><md:uuid xmlns:md="http://cnx.rice.edu/mdml"/></notcnxml>')).toBeUndefined()
+  })
+})
+
+describe('rescanPage', () => {
+  const page = pageMaker({
+    title: 'Some <emphasis>title</emphasis>',
+    extraCnxml: `<section id="s1"><title>One</title>
+  <para id="p1">Some <emphasis>text</emphasis> with a <link document="m1" target-id="p2"/> and a <term>term</term>.</para>
+  <figure><media alt="x"><image src="../../media/a.png" mime-type="image/png"/></media></figure>
+</section>
+<section><para id="p2">More <iframe src="b.html"/></para><definition><term>t</term></definition></section>
+<para id="p3"/>`
+  })
+  const edit = (content: string, find: string, replace: string) => {
+    expect(content).toContain(find)
+    return content.replace(find, replace)
+  }
+  function expectSameAsScan(prev: ScannedPage, content: string) {
+    const next = expectValue(rescanPage(prev, content), 'The edit should be rescanned')
+    expect(next.facts).toEqual(scanPageFacts(content))
+    expect(next.outline).toEqual(expectValue(scanPage(content), 'The page scans').outline)
+    return next
+  }
+
+  it('matches scanning the whole page after edits inside one element', () => {
+    let prev = expectValue(scanPage(page), 'The page scans')
+    const edits: Array<[string, string]> = [
+      ['Some <emphasis>text', 'Some <emphasis>more text'], // The line gets longer
+      ['with a', 'with\r\na\nnew <link url="https://openstax.org"/> and'], // New lines and a new link
+      ['<term>term</term>', '<term>term</term><para>No id</para>'],
+      ['<media alt="x">', '<media alt="x"><image src="c.png"/>'],
+      ['More <iframe src="b.html"/>', 'Less'], // Gone
+      ['<definition><term>t</term></definition>', ''],
+      ['</section>\n<section>', '</section>\n\n<section id="s2">'], // Across elements, inside content
+      ['<para id="p3"/>', '<para id="p3">&amp;<![CDATA[x]]><!-- c --><?pi?></para>']
+    ]
+    for (const [find, replace] of edits) {
+      prev = expectSameAsScan(prev, edit(prev.content, find, replace))
+    }
+    expect(rescanPage(prev, prev.content)).toBe(prev)
+  })
+  it('scans the whole page again when an edit is not inside one element of the content', () => {
+    const prev = expectValue(scanPage(page), 'The page scans')
+    // Outside the content
+    expect(rescanPage(prev, edit(page, '<title>Some', '<title>A'))).toBeUndefined()
+    expect(rescanPage(prev, edit(page, '<content>', '<content class="x">'))).toBeUndefined()
+    // The fragment is not well-formed
+    expect(rescanPage(prev, edit(page, '<para id="p3"/>', '<para id="p3">'))).toBeUndefined()
+    expect(rescanPage(prev, edit(page, 'Some <emphasis>', 'Some </para><emphasis>'))).toBeUndefined()
+    expect(rescanPage(prev, edit(page, 'More', '&nbsp;'))).toBeUndefined()
+    expect(rescanPage(prev, edit(page, 'More', '\u2028'))).toBeUndefined()
+    // The uuid has to be found once in the whole page
+    expect(rescanPage(prev, edit(page, 'More', '<md:uuid xmlns:md="http://cnx.rice.edu/mdml">x</md:uuid>'))).toBeUndefined()
+  })
+})
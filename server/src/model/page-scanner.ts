@@ -0,0 +1,627 @@
+import { type Opt, type Position, type Range, NS_METADATA } from './utils'
+import { ELEMENT_TO_PREFIX, type PageFacts, ResourceLinkKind } from './page'
+
+// A single pass over CNXML that collects the same PageFacts as
+// `extractPageFacts(readXML(content).doc)` but never builds a DOM and never
+// runs an XPath query.
+//
+// Ranges have to match what xmldom + calculateElementPositions report, so this
+// mimics how xmldom assigns source locations: an element ends where its next
+// sibling (text, element, comment, CDATA or processing instruction) starts.
+// If there is no sibling it ends just past the value of its last attribute,
+// or past its tag name.
+//
+// Anything that is not plain, well-formed XML (DOCTYPEs, unknown entities,
+// mismatched tags, unquoted attributes, ...) returns undefined so the caller
+// can fall back to xmldom, which reports the same errors and warnings it
+// always did. The same goes for the documents where a `selectOne` would throw.
+//
+// Open pages also keep an outline of where their elements are (scanPage) so
+// an edit inside one element only scans that element again (rescanPage).
+
+const NS_CNXML = 'http://cnx.rice.edu/cnxml'
+
+const NAME_RE = /^[A-Za-z_][\w.-]*(?::[A-Za-z_][\w.-]*)?$/
+const ENTITY_RE = /&#?\w+;/g
+const CHAR_REF_RE = /^#(?:\d+|x[0-9a-fA-F]+)$/
+const XML_ENTITIES = new Map([['lt', '<'], ['gt', '>'], ['amp', '&'], ['quot', '"'], ['apos', "'"]])
+// xmldom starts a new line on these too (they are not matched by `.` in its line regexp)
+const ODD_LINE_BREAKS_RE = /[\u2028\u2029]/
+
+class Unsupported extends Error {}
+
+interface Attribute { qName: string, value: string, offset: number /* of the opening quote */ }
+
+// An element whose range is needed
+interface Scanned {
+  tagStart: number
+  qName: string
+  lastAttr: Opt<Attribute>
+  nextSibling: Opt<number>
+  text: Opt<string[]> // textContent, when it is needed
+}
+
+interface Frame {
+  qName: string
+  ns: Opt<string>
+  localName: string
+  nsMap: Map<string, string>
+  scanned: Opt<Scanned>
+  index: number // In the outline, when there is one
+  // The previous child, waiting for its next sibling to start
+  pending: Opt<Scanned>
+}
+
+function isCnxml(frame: Opt<Frame>, localName: string) {
+  return frame !== undefined && frame.ns === NS_CNXML && frame.localName === localName
+}
+
+function isSpace(c: number) {
+  return c === 0x20 || c === 0x09 || c === 0x0a || c === 0x0d
+}
+
+function decode(s: string) {
+  if (!s.includes('&')) return s
+  return s.replace(ENTITY_RE, e => {
+    const k = e.slice(1, -1)
+    const named = XML_ENTITIES.get(k)
+    if (named !== undefined) return named
+    if (!CHAR_REF_RE.test(k)) throw new Unsupported() // xmldom reports 'entity not found'
+    const code = parseInt(k.slice(1).replace('x', '0x'))
+    if (code > 0x10ffff) throw new Unsupported()
+    return String.fromCodePoint(code)
+  })
+}
+
+function lineStarts(s: string) {
+  const starts = [0]
+  const re = /\r\n?|\n/g
+  let m
+  while ((m = re.exec(s)) !== null) starts.push(m.index + m[0].length)
+  return starts
+}
+
+function positionIn(lines: ArrayLike<number>) {
+  return (offset: number): Position => {
+    const line = lastAtMost(lines, offset)
+    return { line, character: offset - lines[line] }
+  }
+}
+
+// The last index whose value is <= `n` (-1 when there is none). `sorted` is ascending
+function lastAtMost(sorted: ArrayLike<number>, n: number) {
+  let lo = -1
+  let hi = sorted.length - 1
+  while (lo < hi) {
+    const mid = (lo + hi + 1) >> 1
+    if (sorted[mid] <= n) {
+      lo = mid
+    } else {
+      hi = mid - 1
+    }
+  }
+  return lo
+}
+
+function comparePositions(a: Position, b: Position) {
+  return a.line !== b.line ? a.line - b.line : a.character - b.character
+}
+
+// The first index whose start is not before `p` (`items` are in document order)
+function firstFrom<T>(items: T[], startOf: (item: T) => Position, p: Position) {
+  let lo = 0
+  let hi = items.length
+  while (lo < hi) {
+    const mid = (lo + hi) >>> 1
+    if (comparePositions(startOf(items[mid]), p) < 0) {
+      lo = mid + 1
+    } else {
+      hi = mid
+    }
+  }
+  return lo
+}
+
+// `old` with old[keep, resume) replaced by `fresh`. `add` is added to the
+// rest of the values that are at least `min`
+function spliced(old: Int32Array, keep: number, fresh: number[], resume: number, add: number, min: number) {
+  const out = new Int32Array(keep + fresh.length + old.length - resume)
+  out.set(old.subarray(0, keep))
+  out.set(fresh, keep)
+  for (let i = resume, j = keep + fresh.length; i < old.length; i++, j++) {
+    const v = old[i]
+    out[j] = v >= min ? v + add : v
+  }
+  return out
+}
+
+// Where the lines and elements of a scanned page are, so an edit can be
+// scanned again from the smallest element that has all of it (see
+// `rescanPage`). Elements are in document order and the offsets of the
+// ones without content (`<x/>`) are -1.
+export interface PageOutline {
+  lineStarts: Int32Array
+  tagStart: Int32Array
+  contentStart: Int32Array // Just past the start tag
+  contentEnd: Int32Array // Where the end tag starts
+  parent: Int32Array // -1 for the root element
+}
+
+// The elements `scan` finds, numbered from `first`
+interface OutlineBuilder {
+  first: number
+  tagStart: number[]
+  contentStart: number[]
+  contentEnd: number[]
+  parent: number[]
+}
+
+const outlineBuilder = (first: number): OutlineBuilder => ({ first, tagStart: [], contentStart: [], contentEnd: [], parent: [] })
+
+// What is kept for an open page between edits
+export interface ScannedPage {
+  content: string
+  facts: PageFacts
+  outline: PageOutline
+}
+
+export function scanPageFacts(content: string): Opt<PageFacts> {
+  return scanWhole(content, undefined)?.facts
+}
+
+// Like scanPageFacts but also returns what `rescanPage` needs
+export function scanPage(content: string): Opt<ScannedPage> {
+  const b = outlineBuilder(0)
+  const scanned = scanWhole(content, b)
+  if (scanned === undefined) return undefined
+  const outline: PageOutline = {
+    lineStarts: Int32Array.from(scanned.lines),
+    tagStart: Int32Array.from(b.tagStart),
+    contentStart: Int32Array.from(b.contentStart),
+    contentEnd: Int32Array.from(b.contentEnd),
+    parent: Int32Array.from(b.parent)
+  }
+  return { content, facts: scanned.facts, outline }
+}
+
+function scanWhole(content: string, outline: Opt<OutlineBuilder>): Opt<{ facts: PageFacts, lines: number[] }> {
+  if (ODD_LINE_BREAKS_RE.test(content)) return undefined
+  return unlessUnsupported(() => {
+    const c = scan(content, 0, content.length, [], outline)
+    if (c.uuids.length !== 1 || c.root === undefined || !isCnxml(c.root, 'document')) return undefined
+    const lines = lineStarts(content)
+    const range = rangeOf(positionIn(lines))
+    const { images, iframes, ...lists } = factLists(c, range)
+    const facts: PageFacts = {
+      uuid: textWithRange(range, c.uuids[0]),
+      title: c.title !== undefined ? textWithRange(range, c.title) : undefined,
+      ...lists,
+      resourceLinks: [...images, ...iframes],
+      hasSuperNode: c.superNode !== undefined ? range(c.superNode) : undefined,
+      documentClass: { range: range(c.root.scanned as Scanned), v: c.rootClass }
+    }
+    return { facts, lines }
+  })
+}
+
+// Scans only the element around what changed since `prev` and moves the
+// facts after it. Returns undefined when the edit is not inside one element
+// of the content (or glossary) or when the element no longer scans, so the
+// caller scans the whole page instead.
+export function rescanPage(prev: ScannedPage, content: string): Opt<ScannedPage> {
+  const old = prev.content
+  const { outline } = prev
+  // The edit replaced old[start, oldEnd) with content[start, oldEnd + delta)
+  const max = Math.min(old.length, content.length)
+  const start = commonLength(old, content, max, false)
+  const oldEnd = old.length - commonLength(old, content, max - start, true)
+  const delta = content.length - old.length
+  if (start === oldEnd && delta === 0) return prev
+  if (ODD_LINE_BREAKS_RE.test(content.slice(start, oldEnd + delta))) return undefined
+
+  // The last element that starts before the edit is inside the one we want (or is it)
+  let e = lastAtMost(outline.tagStart, start - 1)
+  while (e >= 0 && !(outline.contentStart[e] >= 0 && outline.contentStart[e] <= start && oldEnd <= outline.contentEnd[e])) {
+    e = outline.parent[e]
+  }
+  const chain: number[] = []
+  for (let i = e; i >= 0; i = outline.parent[i]) chain.unshift(i)
+  if (chain.length < 2) return undefined
+  const from = outline.contentStart[e]
+  const oldTo = outline.contentEnd[e]
+  const to = oldTo + delta
+
+  return unlessUnsupported(() => {
+    const frames: Frame[] = []
+    for (const i of chain) {
+      parseStartTag(content, outline.tagStart[i], (_, qName, attrs) => { frames.push(newFrame(qName, attrs, frames[frames.length - 1], i)) }, () => {})
+    }
+    // Above these are the title, the uuid and the metadata. Text inside the uuid is collected too
+    if (!(isCnxml(frames[1], 'content') || isCnxml(frames[1], 'glossary'))) return undefined
+    if (frames.some(f => f.ns === NS_METADATA && f.localName === 'uuid')) return undefined
+
+    const b = outlineBuilder(e + 1)
+    const c = scan(content, from, to, frames, b)
+    if (c.uuids.length > 0) return undefined
+
+    const oldLines = outline.lineStarts
+    const freshLines: number[] = []
+    const re = /\r\n?|\n/g
+    re.lastIndex = from
+    let m
+    while ((m = re.exec(content)) !== null && m.index < to) freshLines.push(m.index + m[0].length)
+    const lines = spliced(oldLines, lastAtMost(oldLines, from) + 1, freshLines, lastAtMost(oldLines, oldTo) + 1, delta, 0)
+
+    const last = lastAtMost(outline.tagStart, oldTo - 1) // The last of the old descendants
+    const moveIndex = e + 1 + b.tagStart.length - (last + 1)
+    const next: PageOutline = {
+      lineStarts: lines,
+      tagStart: spliced(outline.tagStart, e + 1, b.tagStart, last + 1, delta, 0),
+      contentStart: spliced(outline.contentStart, e + 1, b.contentStart, last + 1, delta, 0),
+      contentEnd: spliced(outline.contentEnd, e + 1, b.contentEnd, last + 1, delta, 0),
+      parent: spliced(outline.parent, e + 1, b.parent, last + 1, moveIndex, last + 1)
+    }
+    chain.forEach(i => { next.contentEnd[i] += delta }) // The element and its ancestors end later
+
+    const position = positionIn(lines)
+    const fromPos = position(from)
+    const oldToPos = positionIn(oldLines)(oldTo)
+    const toPos = position(to)
+    const lineDelta = toPos.line - oldToPos.line
+    // Only what is on the line where the element ended moves sideways
+    const move = (p: Position): Position => comparePositions(p, oldToPos) < 0 || (lineDelta === 0 && p.line !== oldToPos.line)
+      ? p
+      : p.line === oldToPos.line
+        ? { line: toPos.line, character: p.character - oldToPos.character + toPos.character }
+        : { line: p.line + lineDelta, character: p.character }
+    const moveRange = (r: Range): Range => {
+      const start = move(r.start)
+      const end = move(r.end)
+      return start === r.start && end === r.end ? r : { start, end }
+    }
+    const moveFact = <T extends { range: Range }>(f: T): T => {
+      const range = moveRange(f.range)
+      return range === f.range ? f : { ...f, range }
+    }
+    const ancestorStarts = chain.map(i => position(outline.tagStart[i]))
+    const nextLine = { line: oldToPos.line + 1, character: 0 }
+    // Facts are in document order. The ones inside the element are replaced
+    const splice = <T>(facts: T[], fresh: T[], rangeOf: (f: T) => Range, moveF: (f: T) => T) => {
+      const startOf = (f: T) => rangeOf(f).start
+      const before = facts.slice(0, firstFrom(facts, startOf, fromPos))
+      // Of the ones before, only the element and its ancestors end after it
+      for (const p of ancestorStarts) {
+        const i = firstFrom(before, startOf, p)
+        if (i < before.length && comparePositions(startOf(before[i]), p) === 0) before[i] = moveF(before[i])
+      }
+      const after = firstFrom(facts, startOf, oldToPos)
+      const moved = lineDelta === 0 ? firstFrom(facts, startOf, nextLine) : facts.length
+      return [...before, ...fresh, ...facts.slice(after, moved).map(moveF), ...facts.slice(moved)]
+    }
+    const withRange = (f: { range: Range }) => f.range
+    const facts = prev.facts
+    const uuidStart = facts.uuid.range.start
+    if (comparePositions(uuidStart, fromPos) >= 0 && comparePositions(uuidStart, oldToPos) < 0) return undefined
+
+    const fresh = factLists(c, rangeOf(position))
+    const oldImages = facts.resourceLinks.filter(l => l.type === ResourceLinkKind.Image)
+    const oldIFrames = facts.resourceLinks.filter(l => l.type === ResourceLinkKind.IFrame)
+    const nextFacts: PageFacts = {
+      uuid: moveFact(facts.uuid),
+      title: facts.title !== undefined ? moveFact(facts.title) : undefined,
+      elementIds: splice(facts.elementIds, fresh.elementIds, withRange, moveFact),
+      elementsMissingIds: splice(facts.elementsMissingIds, fresh.elementsMissingIds, r => r, moveRange),
+      resourceLinks: [
+        ...splice(oldImages, fresh.images, withRange, moveFact),
+        ...splice(oldIFrames, fresh.iframes, withRange, moveFact)
+      ],
+      pageLinks: splice(facts.pageLinks, fresh.pageLinks, withRange, moveFact),
+      hasSuperNode: facts.hasSuperNode !== undefined ? moveRange(facts.hasSuperNode) : undefined,
+      documentClass: moveFact(facts.documentClass)
+    }
+    return { content, facts: nextFacts, outline: next }
+  })
+}
+
+// How many characters `a` and `b` have in common at their start (or end), up
+// to `max`. Comparing slices is a lot faster than comparing one character at a time
+function commonLength(a: string, b: string, max: number, atEnd: boolean) {
+  const same = atEnd
+    ? (n: number, step: number) => a.slice(a.length - n - step, a.length - n) === b.slice(b.length - n - step, b.length - n)
+    : (n: number, step: number) => a.slice(n, n + step) === b.slice(n, n + step)
+  let n = 0
+  for (const step of [4096, 64, 1]) {
+    while (n + step <= max && same(n, step)) n += step
+  }
+  return n
+}
+
+function unlessUnsupported<T>(fn: () => Opt<T>): Opt<T> {
+  try {
+    return fn()
+  } catch (err) {
+    if (err instanceof Unsupported) return undefined
+    throw err
+  }
+}
+
+function newFrame(qName: string, attrs: Attribute[], parent: Opt<Frame>, index: number): Frame {
+  let nsMap = parent?.nsMap ?? new Map<string, string>()
+  for (const a of attrs) {
+    const prefix = a.qName === 'xmlns' ? '' : a.qName.startsWith('xmlns:') ? a.qName.slice('xmlns:'.length) : undefined
+    if (prefix !== undefined) {
+      if (nsMap === parent?.nsMap) nsMap = new Map(nsMap)
+      nsMap.set(prefix, a.value)
+    }
+  }
+  const colon = qName.indexOf(':')
+  const prefix = colon > 0 ? qName.slice(0, colon) : ''
+  const localName = colon > 0 ? qName.slice(colon + 1) : qName
+  return { qName, ns: nsMap.get(prefix), localName, nsMap, scanned: undefined, pending: undefined, index }
+}
+
+interface Scan {
+  root: Opt<Frame>
+  rootClass: string
+  uuids: Scanned[]
+  elementIds: Array<{ v: string, el: Scanned }>
+  missingIds: Scanned[]
+  images: Array<{ src: string, el: Scanned }>
+  iframes: Array<{ src: string, el: Scanned }>
+  links: Array<{ el: Scanned, document: Opt<string>, targetId: Opt<string>, url: Opt<string> }>
+  title: Opt<Scanned>
+  superNode: Opt<Scanned>
+}
+
+// Scans content[from, to). `frames` are the elements that are open at
+// `from`: none for the whole page, the element and its ancestors for the
+// content of an element. When there is an `outline` the elements are
+// appended to it.
+function scan(content: string, from: number, to: number, frames: Frame[], outline: Opt<OutlineBuilder>): Scan {
+  const depthAtStart = frames.length
+  const collectors: string[][] = []
+  // These are assigned inside the callbacks below (so TypeScript must not narrow them to undefined)
+  let root = frames[0] as Opt<Frame>
+  let rootClass = ''
+  let rootPending = undefined as Opt<Scanned>
+
+  const uuids: Scanned[] = []
+  const elementIds: Array<{ v: string, el: Scanned }> = []
+  const missingIds: Scanned[] = []
+  const images: Array<{ src: string, el: Scanned }> = []
+  const iframes: Array<{ src: string, el: Scanned }> = []
+  const links: Array<{ el: Scanned, document: Opt<string>, targetId: Opt<string>, url: Opt<string> }> = []
+  let title = undefined as Opt<Scanned>
+  let superNode = undefined as Opt<Scanned>
+
+  // A node started at `offset` so it is the next sibling of the previous child
+  const startNode = (offset: number) => {
+    const top: Opt<Frame> = frames[frames.length - 1]
+    if (top !== undefined) {
+      if (top.pending !== undefined) top.pending.nextSibling = offset
+      top.pending = undefined
+    } else if (rootPending !== undefined) {
+      rootPending.nextSibling = offset
+      rootPending = undefined
+    }
+  }
+
+  const onText = (start: number, end: number) => {
+    const text = decode(content.slice(start, end))
+    if (frames.length === 0) {
+      // xmldom drops text before the root element but keeps it after
+      if (root !== undefined) startNode(start)
+      return
+    }
+    startNode(start)
+    collectors.forEach(col => col.push(text))
+  }
+
+  const closeElement = (contentEnd: number) => {
+    const frame = frames.pop() as Frame
+    if (frame.scanned?.text !== undefined) collectors.pop()
+    if (outline !== undefined) outline.contentEnd[frame.index - outline.first] = contentEnd
+    const parent: Opt<Frame> = frames[frames.length - 1]
+    if (parent !== undefined) {
+      parent.pending = frame.scanned
+    } else {
+      rootPending = frame.scanned
+    }
+  }
+
+  const openElement = (tagStart: number, qName: string, attrs: Attribute[], contentStart: number) => {
+    if (frames.length === 0 && root !== undefined) throw new Unsupported() // Only one root element
+    startNode(tagStart)
+    const parent: Opt<Frame> = frames[frames.length - 1]
+    let index = -1
+    if (outline !== undefined) {
+      index = outline.first + outline.tagStart.push(tagStart) - 1
+      outline.contentStart.push(contentStart)
+      outline.contentEnd.push(-1)
+      outline.parent.push(parent?.index ?? -1)
+    }
+    const frame = newFrame(qName, attrs, parent, index)
+    const { ns, localName } = frame
+    const getAttr = (name: string) => attrs.find(a => a.qName === name)?.value
+    const el = () => {
+      if (frame.scanned === undefined) {
+        frame.scanned = { tagStart, qName, lastAttr: attrs[attrs.length - 1], nextSibling: undefined, text: undefined }
+      }
+      return frame.scanned
+    }
+    const withText = () => {
+      const s = el()
+      if (s.text === undefined) {
+        s.text = []
+        collectors.push(s.text)
+      }
+      return s
+    }
+    const depth = frames.length
+    if (depth === 0) {
+      root = frame
+      rootClass = getAttr('class') ?? ''
+      el()
+    }
+    if (ns === NS_CNXML) {
+      const id = getAttr('id')
+      if (id !== undefined) {
+        elementIds.push({ v: id, el: el() })
+      } else if (ELEMENT_TO_PREFIX.has(localName) && !(localName === 'term' && parent?.ns === NS_CNXML && parent.localName === 'definition')) {
+        missingIds.push(el())
+      }
+      const src = getAttr('src')
+      if (localName === 'image' && src !== undefined) {
+        images.push({ src, el: el() })
+      } else if (localName === 'iframe' && src !== undefined && !(src.startsWith('https://') || src.startsWith('http://'))) {
+        iframes.push({ src, el: el() })
+      } else if (localName === 'link') {
+        // xmldom never returns null, it returns ''
+        const changeEmptyToNull = (str: Opt<string>): Opt<string> => str === '' ? undefined : str
+        links.push({
+          el: el(),
+          document: changeEmptyToNull(getAttr('document')),
+          targetId: changeEmptyToNull(getAttr('target-id')),
+          url: changeEmptyToNull(getAttr('url'))
+        })
+      } else if (localName === 'title' && depth === 1 && title === undefined && isCnxml(root, 'document')) {
+        title = withText()
+      }
+    } else if (ns === NS_METADATA) {
+      if (localName === 'uuid') {
+        uuids.push(withText())
+      } else if (localName === 'super' && depth === 2 && superNode === undefined && isCnxml(root, 'document') && isCnxml(frames[1], 'metadata')) {
+        superNode = el()
+      }
+    }
+    frames.push(frame)
+  }
+
+  let pos = from
+  while (true) {
+    if (pos > to) throw new Unsupported() // Something did not end inside the element
+    let lt = content.indexOf('<', pos)
+    if (lt >= to) lt = -1
+    if (lt < 0) {
+      if (depthAtStart > 0) {
+        if (frames.length > depthAtStart) throw new Unsupported()
+        if (to > pos) onText(pos, to)
+      } else if (frames.length > 0 || content.slice(pos).trim() !== '') {
+        throw new Unsupported()
+      }
+      break
+    }
+    if (lt > pos) onText(pos, lt)
+    const c = content.charAt(lt + 1)
+    if (c === '/') {
+      const end = content.indexOf('>', lt + 3)
+      if (end < 0) throw new Unsupported()
+      const qName = content.slice(lt + 2, end).replace(/[ \t\n\r]+$/g, '')
+      if (frames.length === depthAtStart || frames[frames.length - 1].qName !== qName) throw new Unsupported()
+      closeElement(lt)
+      pos = end + 1
+    } else if (c === '?') {
+      const end = content.indexOf('?>', lt)
+      if (end < 0) throw new Unsupported()
+      startNode(lt)
+      pos = end + 2
+    } else if (content.startsWith('<!--', lt)) {
+      const end = content.indexOf('-->', lt + 4)
+      if (end < 0) throw new Unsupported()
+      startNode(lt)
+      pos = end + 3
+    } else if (content.startsWith('<![CDATA[', lt)) {
+      const end = content.indexOf(']]>', lt + 9)
+      if (end < 0 || frames.length === 0) throw new Unsupported()
+      startNode(lt)
+      const text = content.slice(lt + 9, end)
+      collectors.forEach(col => col.push(text))
+      pos = end + 3
+    } else if (c === '!') {
+      throw new Unsupported() // DOCTYPE and friends
+    } else {
+      pos = parseStartTag(content, lt, openElement, closeElement)
+    }
+  }
+  return { root, rootClass, uuids, elementIds, missingIds, images, iframes, links, title, superNode }
+}
+
+function rangeOf(position: (offset: number) => Position) {
+  return (s: Scanned): Range => {
+    const start = position(s.tagStart)
+    let end: Position
+    if (s.nextSibling !== undefined) {
+      end = position(s.nextSibling)
+    } else if (s.lastAttr !== undefined) {
+      const quote = position(s.lastAttr.offset)
+      end = { line: quote.line, character: quote.character + s.lastAttr.value.length + 2 }
+    } else {
+      end = { line: start.line, character: start.character + 1 + s.qName.length }
+    }
+    return { start, end }
+  }
+}
+
+function textWithRange(range: (s: Scanned) => Range, s: Scanned) {
+  return { v: (s.text as string[]).join(''), range: range(s) }
+}
+
+// The facts that can be anywhere in a page
+function factLists(c: Scan, range: (s: Scanned) => Range) {
+  return {
+    elementIds: c.elementIds.map(({ v, el }) => ({ v, range: range(el) })),
+    elementsMissingIds: c.missingIds.map(range),
+    images: c.images.map(({ src, el }) => ({ type: ResourceLinkKind.Image, src, range: range(el) })),
+    iframes: c.iframes.map(({ src, el }) => ({ type: ResourceLinkKind.IFrame, src, range: range(el) })),
+    pageLinks: c.links.map(({ el, document, targetId, url }) => ({ range: range(el), document, targetId, url }))
+  }
+}
+
+// Parses `<name attr="value" ...>` (or `/>`) starting at `lt` and returns the
+// offset just past it
+function parseStartTag(content: string, lt: number, open: (tagStart: number, qName: string, attrs: Attribute[], contentStart: number) => void, close: (contentEnd: number) => void) {
+  const n = content.length
+  const isNameEnd = (p: number, extra: string) => {
+    const ch = content.charAt(p)
+    return p >= n || isSpace(content.charCodeAt(p)) || ch === '/' || ch === '>' || ch === extra
+  }
+  const skipSpaces = (p: number) => {
+    while (p < n && isSpace(content.charCodeAt(p))) p++
+    return p
+  }
+  let p = lt + 1
+  while (!isNameEnd(p, '/')) p++
+  const qName = content.slice(lt + 1, p)
+  if (!NAME_RE.test(qName)) throw new Unsupported()
+  const attrs: Attribute[] = []
+  while (true) {
+    const spaceStart = p
+    p = skipSpaces(p)
+    const ch = content.charAt(p)
+    if (ch === '>') {
+      open(lt, qName, attrs, p + 1)
+      return p + 1
+    }
+    if (ch === '/') {
+      if (content.charAt(p + 1) !== '>') throw new Unsupported()
+      open(lt, qName, attrs, -1)
+      close(-1)
+      return p + 2
+    }
+    // xmldom warns when attributes are not separated by a space
+    if (p >= n || p === spaceStart) throw new Unsupported()
+    const nameStart = p
+    while (!isNameEnd(p, '=')) p++
+    const name = content.slice(nameStart, p)
+    if (!NAME_RE.test(name) || attrs.some(a => a.qName === name)) throw new Unsupported()
+    p = skipSpaces(p)
+    if (content.charAt(p) !== '=') throw new Unsupported()
+    p = skipSpaces(p + 1)
+    const quote = content.charAt(p)
+    if (quote !== '"' && quote !== "'") throw new Unsupported()
+    const valueEnd = content.indexOf(quote, p + 1)
+    if (valueEnd < 0) throw new Unsupported()
+    attrs.push({ qName: name, value: decode(content.slice(p + 1, valueEnd)), offset: p })
+    p = valueEnd + 1
+  }
+}
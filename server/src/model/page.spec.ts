@@ -143,6 +143,17 @@ describe('Page validations', () => {
     expectErrors(page1, [PageValidationKind.DUPLICATE_UUID])
     expectErrors(page2, [PageValidationKind.DUPLICATE_UUID])
   })
+  it('updates duplicate uuids when a page changes', () => {
+    const bundle = makeBundle()
+    const page1 = bundle.allPages.getOrAdd('somepage/filename')
+    const page2 = bundle.allPages.getOrAdd('somepage2/filename2')
+    page1.load(pageMaker({}))
+    page2.load(pageMaker({}))
+    expectErrors(page1, [PageValidationKind.DUPLICATE_UUID])
+    page2.load(pageMaker({ uuid: '11111111-1111-4111-8111-111111111111' }))
+    expectErrors(page1, [])
+    expectErrors(page2, [])
+  })
   it('Reports multiple validation errors', () => {
     const bundle = makeBundle()
     const page = bundle.allPages.getOrAdd('somepage')
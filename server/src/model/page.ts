@@ -1,11 +1,13 @@
 import I from 'immutable'
 import * as Quarx from 'quarx'
 import { type Opt, PathKind, type WithRange, textWithRange, select, selectOne, calculateElementPositions, expectValue, type HasRange, NOWHERE, join, equalsOpt, equalsWithRange, tripleEq, type Range } from './utils'
-import { Fileish, type ValidationCheck, ValidationKind, ValidationSeverity } from './fileish'
+import { Fileish, FactsKind, type ValidationCheck, ValidationKind, ValidationSeverity } from './fileish'
 import { type ResourceNode } from './resource'
 import { H5PExercise } from './h5p-exercise'
+import { scanPageFacts } from './page-scanner'
+import { RangeInterner } from './ranges'
 
-enum ResourceLinkKind {
+export enum ResourceLinkKind {
   Image,
   IFrame
 }
@@ -101,6 +103,72 @@ const DEFAULT_TITLE = {
 }
 
 export const ELEMENTS_MISSING_IDS_SEL = Array.from(ELEMENT_TO_PREFIX.keys()).map(e => `//cnxml:${e}[not(@id)]${termSpecificSelector(e)}`).join('|')
+// Everything a PageNode needs from its XML, as plain data. It does not
+// reference any other nodes so it can be extracted in a worker thread and
+// sent back with postMessage (see ../parser-pool.ts)
+export interface PageFacts {
+  uuid: WithRange<string>
+  title: Opt<WithRange<string>>
+  elementIds: Array<WithRange<string>>
+  elementsMissingIds: Range[]
+  resourceLinks: Array<HasRange & { type: ResourceLinkKind, src: string }>
+  pageLinks: Array<HasRange & { document: Opt<string>, targetId: Opt<string>, url: Opt<string> }>
+  hasSuperNode: Opt<Range>
+  documentClass: WithRange<string>
+}
+
+export function extractPageFacts(doc: Document): PageFacts {
+  const uuid = textWithRange(selectOne('//md:uuid', doc))
+
+  const elementIds = (select('//cnxml:*[@id]', doc) as Element[]).map(el => textWithRange(el, 'id'))
+  const missing = select(ELEMENTS_MISSING_IDS_SEL, doc) as Element[]
+  const elementsMissingIds = missing.map(el => calculateElementPositions(el))
+
+  const toResourceLink = (type: ResourceLinkKind, attr: Attr) => {
+    const src = expectValue(attr.nodeValue, 'BUG: Attribute does not have a value')
+    // Get the line/col position of the <image> tag
+    const imageNode = expectValue(attr.ownerElement, 'BUG: attributes always have a parent element')
+    const range = calculateElementPositions(imageNode)
+    return { type, src, range }
+  }
+
+  const imageNodes = select('//cnxml:image/@src', doc) as Attr[]
+  const iframeNodes = select('//cnxml:iframe/@src[not(starts-with(., "https://") or starts-with(., "http://"))]', doc) as Attr[]
+  const imageLinks = imageNodes.map(n => toResourceLink(ResourceLinkKind.Image, n))
+  const iframeLinks = iframeNodes.map(n => toResourceLink(ResourceLinkKind.IFrame, n))
+
+  const superNodeSearch = select('/cnxml:document/cnxml:metadata/md:super', doc) as Element[]
+  const document = selectOne('/cnxml:document', doc)
+  const documentClass = document.getAttribute('class')
+
+  const linkNodes = select('//cnxml:link', doc) as Element[]
+  const changeEmptyToNull = (str: string | null): Opt<string> => (str === '' || str === null) ? undefined : str
+  const pageLinks = linkNodes.map(linkNode => ({
+    range: calculateElementPositions(linkNode),
+    // xmldom never returns null, it returns ''
+    document: changeEmptyToNull(linkNode.getAttribute('document')),
+    targetId: changeEmptyToNull(linkNode.getAttribute('target-id')),
+    url: changeEmptyToNull(linkNode.getAttribute('url'))
+  }))
+
+  const titleNode = select('/cnxml:document/cnxml:title', doc) as Element[]
+
+  return {
+    uuid,
+    title: titleNode.length > 0 ? textWithRange(titleNode[0]) : undefined,
+    elementIds,
+    elementsMissingIds,
+    resourceLinks: [...imageLinks, ...iframeLinks],
+    pageLinks,
+    hasSuperNode: superNodeSearch.length > 0 ? calculateElementPositions(superNodeSearch[0]) : undefined,
+    // Could not find a way to make `documentClass` null/undefined during testing
+    documentClass: {
+      range: calculateElementPositions(document),
+      v: expectValue(documentClass, 'BUG: documentClass was unexpectedly null or undefined')
+    }
+  }
+}
+
 export class PageNode extends Fileish {
   private readonly _uuid = Quarx.observable.box<Opt<WithRange<string>>>(undefined, { equals: equalsOptWithRange })
   private readonly _title = Quarx.observable.box<WithRange<string>>(DEFAULT_TITLE, { equals: equalsOptWithRange })
@@ -139,71 +207,55 @@ export class PageNode extends Fileish {
     return I.Map(this.ensureLoaded(this._elementIds).map(v => [v.v, v]))
   }
 
+  public get elementsMissingIds() {
+    return this.ensureLoaded(this._elementsMissingIds)
+  }
+
   public hasElementId(id: string) {
     return this.ensureLoaded(this._elementIds).toSeq().find(n => n.v === id) !== undefined
   }
 
-  protected parseXML = (doc: Document) => {
-    this._uuid.set(textWithRange(selectOne('//md:uuid', doc)))
-
-    this._elementIds.set(I.Set((select('//cnxml:*[@id]', doc) as Element[]).map(el => textWithRange(el, 'id'))))
-    const missing = select(ELEMENTS_MISSING_IDS_SEL, doc) as Element[]
-    this._elementsMissingIds.set(I.Set(missing.map(el => calculateElementPositions(el))))
-
-    const toResourceLink = (type: ResourceLinkKind, attr: Attr): ResourceLink => {
-      const src = expectValue(attr.nodeValue, 'BUG: Attribute does not have a value')
-      const target = super.bundle.allResources.getOrAdd(join(this.pathHelper, PathKind.ABS_TO_REL, this.absPath, src))
-      // Get the line/col position of the <image> tag
-      const imageNode = expectValue(attr.ownerElement, 'BUG: attributes always have a parent element')
-      const range = calculateElementPositions(imageNode)
-      return { type, target, range }
-    }
+  public readonly factsKind = FactsKind.PAGE
+  protected parseXML = (doc: Document) => { this.installFacts(extractPageFacts(doc)) }
+  protected scanFacts = scanPageFacts
 
-    const imageNodes = select('//cnxml:image/@src', doc) as Attr[]
-    const iframeNodes = select('//cnxml:iframe/@src[not(starts-with(., "https://") or starts-with(., "http://"))]', doc) as Attr[]
-    const imageLinks = imageNodes.map(n => toResourceLink(ResourceLinkKind.Image, n))
-    const iframeLinks = iframeNodes.map(n => toResourceLink(ResourceLinkKind.IFrame, n))
+  protected installFacts = (facts: PageFacts) => {
+    // The facts are dropped once they are installed. Only the compact ranges are kept
+    const compact = new RangeInterner()
+    this._uuid.set(compact.withRange(facts.uuid))
+    this._elementIds.set(I.Set(facts.elementIds.map(compact.withRange)))
+    this._elementsMissingIds.set(I.Set(facts.elementsMissingIds.map(compact.range)))
 
-    this._resourceLinks.set(I.Set([...imageLinks, ...iframeLinks]))
+    this._resourceLinks.set(I.Set(facts.resourceLinks.map(({ type, src, range }): ResourceLink => {
+      const target = this.bundle.allResources.getOrAdd(join(this.pathHelper, PathKind.ABS_TO_REL, this.absPath, src))
+      return { type, target, range: compact.range(range) }
+    })))
 
-    const superNodeSearch = select('/cnxml:document/cnxml:metadata/md:super', doc) as Element[]
-    const document = selectOne('/cnxml:document', doc)
-    const documentClass = document.getAttribute('class')
     this._hasSuperNode.set(
-      superNodeSearch.length > 0
-        ? { range: calculateElementPositions(superNodeSearch[0]), v: true }
+      facts.hasSuperNode !== undefined
+        ? { range: compact.range(facts.hasSuperNode), v: true }
         : undefined
     )
-    // Could not find a way to make `documentClass` null/undefined during testing
-    this._documentClass.set({
-      range: calculateElementPositions(document),
-      v: expectValue(documentClass, 'BUG: documentClass was unexpectedly null or undefined')
-    })
+    this._documentClass.set(compact.withRange(facts.documentClass))
 
-    const linkNodes = select('//cnxml:link', doc) as Element[]
-    const changeEmptyToNull = (str: string | null): Opt<string> => (str === '' || str === null) ? undefined : str
-    this._pageLinks.set(I.Set(linkNodes.map(linkNode => {
-      const range = calculateElementPositions(linkNode)
-      // xmldom never returns null, it returns ''
-      const toDocument = changeEmptyToNull(linkNode.getAttribute('document'))
-      const toTargetId = changeEmptyToNull(linkNode.getAttribute('target-id'))
-      const toUrl = changeEmptyToNull(linkNode.getAttribute('url'))
+    this._pageLinks.set(I.Set(facts.pageLinks.map(({ range: factRange, document: toDocument, targetId: toTargetId, url: toUrl }): PageLink => {
+      const range = compact.range(factRange)
       if (toUrl !== undefined) {
         if (isH5PPath(toUrl)) {
           const absPath = this.pathHelper.join(
-            super.bundle.workspaceRootUri,
-            toUrl.replace(H5PExercise.PLACEHOLDER, super.bundle.paths.publicRoot),
+            this.bundle.workspaceRootUri,
+            toUrl.replace(H5PExercise.PLACEHOLDER, this.bundle.paths.publicRoot),
             'h5p.json'
           )
-          const target = super.bundle.allH5P.getOrAdd(absPath)
+          const target = this.bundle.allH5P.getOrAdd(absPath)
           return { range, type: PageLinkKind.H5P, url: toUrl, h5p: target }
         }
         return { range, type: PageLinkKind.URL, url: toUrl }
       }
-      if (toDocument === undefined && toTargetId === undefined && toUrl === undefined) {
+      if (toDocument === undefined && toTargetId === undefined) {
         return { range, type: PageLinkKind.UNKNOWN }
       }
-      const toPage = toDocument !== undefined ? super.bundle.allPages.getOrAdd(join(this.pathHelper, PathKind.MODULE_TO_MODULEID, this.absPath, toDocument)) : this
+      const toPage = toDocument !== undefined ? this.bundle.allPages.getOrAdd(join(this.pathHelper, PathKind.MODULE_TO_MODULEID, this.absPath, toDocument)) : this
       if (toTargetId !== undefined) {
         return {
           range,
@@ -216,12 +268,7 @@ export class PageNode extends Fileish {
       }
     })))
 
-    const titleNode = select('/cnxml:document/cnxml:title', doc) as Element[]
-    if (titleNode.length > 0) {
-      this._title.set(textWithRange(titleNode[0]))
-    } else {
-      this._title.set(DEFAULT_TITLE)
-    }
+    this._title.set(facts.title !== undefined ? compact.withRange(facts.title) : DEFAULT_TITLE)
   }
 
   protected getValidationChecks(): ValidationCheck[] {
@@ -0,0 +1,51 @@
+import { expect } from '@jest/globals'
+import { type PageFacts } from './page'
+import { scanPageFacts } from './page-scanner'
+import { RangeInterner } from './ranges'
+import { pageMaker } from './spec-helpers.spec'
+import { expectValue, type Range } from './utils'
+import { retainedHeapMb } from '../bench-helpers.bench'
+
+// A page where most elements have an id and many of them are links
+function page(n: number, sections: number) {
+  const extraCnxml = Array.from({ length: sections }, (_, i) => `<section id="s${n}-${i}"><title>Section ${i}</title>
+  <para id="p${n}-${i}">Some <emphasis>text</emphasis> with a <link id="l${n}-${i}" document="m${i}" target-id="p${i}"/> and a <term>term</term>.</para>
+  <figure id="f${n}-${i}"><media alt="x"><image id="i${n}-${i}" src="../../media/img${i}.png" mime-type="image/png"/></media></figure>
+  <para>A paragraph without an id, <link url="https://openstax.org/${i}">link</link>.</para>
+</section>`).join('\n')
+  return pageMaker({ title: `Page ${n}`, extraCnxml })
+}
+
+// Every range a PageNode keeps once the facts are installed
+function rangesOf(facts: PageFacts): Range[] {
+  return [
+    facts.uuid.range,
+    facts.documentClass.range,
+    ...(facts.title !== undefined ? [facts.title.range] : []),
+    ...facts.elementIds.map(e => e.range),
+    ...facts.elementsMissingIds,
+    ...facts.resourceLinks.map(l => l.range),
+    ...facts.pageLinks.map(l => l.range)
+  ]
+}
+
+describe('Page ranges', () => {
+  it('keeps the ranges of a bundle in less memory than position objects', () => {
+    const pages = Array.from({ length: 100 }, (_, n) => page(n, 200))
+    const scan = (content: string) => expectValue(scanPageFacts(content), 'The scanner should handle the bench pages')
+    const plain = retainedHeapMb(() => pages.map(p => rangesOf(scan(p))))
+    const compact = retainedHeapMb(() => pages.map(p => rangesOf(scan(p)).map(new RangeInterner().range)))
+    const count = plain.kept.reduce((sum, r) => sum + r.length, 0)
+    const objects = new Set(compact.kept.flat()).size
+    console.log([
+      `Ranges kept by ${pages.length} pages (${count} ranges)`,
+      `  { start, end } objects (facts)            ${plain.mb.toFixed(1).padStart(8)} MB retained heap`,
+      `  CompactRange, interned (${objects} objects) ${compact.mb.toFixed(1).padStart(8)} MB retained heap`
+    ].join('\n'))
+    compact.kept.forEach((ranges, i) => {
+      expect(ranges.map(r => [r.start, r.end])).toEqual(plain.kept[i].map(r => [r.start, r.end]))
+    })
+    expect(objects).toBeLessThan(count)
+    expect(compact.mb).toBeLessThan(plain.mb / 1.5)
+  })
+})
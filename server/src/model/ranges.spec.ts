@@ -0,0 +1,45 @@
+import { expect } from '@jest/globals'
+import I from 'immutable'
+import { CompactRange, RangeInterner } from './ranges'
+import { PageNode } from './page'
+import { first, FS_PATH_HELPER, makeBundle, pageMaker } from './spec-helpers.spec'
+
+describe('CompactRange', () => {
+  const range = { start: { line: 3, character: 10 }, end: { line: 4, character: 2 } }
+  it('makes the positions when they are read', () => {
+    const r = new CompactRange(3, 10, 4, 2)
+    expect(r.start).toEqual(range.start)
+    expect(r.end).toEqual(range.end)
+    expect(r.start).not.toBe(r.start)
+  })
+  it('is sent as a plain range', () => {
+    expect(JSON.parse(JSON.stringify({ range: new CompactRange(3, 10, 4, 2) }))).toEqual({ range })
+  })
+  it('is only the same range in a Set when it is the same object', () => {
+    const r = new CompactRange(3, 10, 4, 2)
+    expect(I.Set([r, r, new CompactRange(3, 10, 4, 2)]).size).toBe(2)
+  })
+})
+
+describe('RangeInterner', () => {
+  it('shares one object between equal ranges', () => {
+    const compact = new RangeInterner()
+    const r = compact.range({ start: { line: 1, character: 2 }, end: { line: 1, character: 9 } })
+    expect(compact.range({ start: { line: 1, character: 2 }, end: { line: 1, character: 9 } })).toBe(r)
+    expect(compact.withRange({ v: 'id', range: { start: { line: 1, character: 2 }, end: { line: 1, character: 9 } } })).toEqual({ v: 'id', range: r })
+  })
+  it('keeps ranges that only start at the same place apart', () => {
+    const compact = new RangeInterner()
+    const r = compact.range({ start: { line: 1, character: 2 }, end: { line: 1, character: 9 } })
+    const other = compact.range({ start: { line: 1, character: 2 }, end: { line: 2, character: 0 } })
+    expect(other).not.toBe(r)
+    expect(other.end).toEqual({ line: 2, character: 0 })
+  })
+  it('is what a loaded page keeps', () => {
+    const page = new PageNode(makeBundle(), FS_PATH_HELPER, '/some/path/filename')
+    page.load(pageMaker({ extraCnxml: '<link id="l1" url="https://openstax.org"/>' }))
+    const link = first(page.pageLinks)
+    expect(link.range).toBeInstanceOf(CompactRange)
+    expect(page.elementIds.get('l1')?.range).toBe(link.range)
+  })
+})
@@ -0,0 +1,43 @@
+import { type Position, type Range, type WithRange } from './utils'
+
+// A Range as one object with four small-integer fields instead of three
+// objects. Pages and books keep one for every id, link and ToC entry, which
+// adds up to millions in a big bundle. `start` and `end` are made when they
+// are read (diagnostics, document links, completions) and are not kept.
+export class CompactRange implements Range {
+  constructor(
+    public readonly startLine: number,
+    public readonly startCharacter: number,
+    public readonly endLine: number,
+    public readonly endCharacter: number
+  ) { }
+
+  public get start(): Position { return { line: this.startLine, character: this.startCharacter } }
+  public get end(): Position { return { line: this.endLine, character: this.endCharacter } }
+
+  // What is sent to the client and written to reports
+  public toJSON(): Range { return { start: this.start, end: this.end } }
+
+  // Lets an I.Set hash it without remembering it in a WeakMap. Two ranges are
+  // still only the same when they are the same object
+  public hashCode() { return (this.startLine * 31 + this.startCharacter) | 0 }
+}
+
+// Turns the plain ranges of PageFacts/BookFacts into CompactRanges when a
+// node installs them. The facts that have the same range (an element with an
+// id that is also a link) share one object. Use one per installFacts call.
+export class RangeInterner {
+  private readonly byStart = new Map<number, CompactRange>()
+
+  public readonly range = (r: Range): CompactRange => {
+    const { start, end } = r
+    const key = start.line * 0x1000000 + start.character
+    const seen = this.byStart.get(key)
+    if (seen !== undefined && seen.startCharacter === start.character && seen.endLine === end.line && seen.endCharacter === end.character) return seen
+    const compact = new CompactRange(start.line, start.character, end.line, end.character)
+    if (seen === undefined) this.byStart.set(key, compact)
+    return compact
+  }
+
+  public readonly withRange = <T>({ v, range }: WithRange<T>): WithRange<T> => ({ v, range: this.range(range) })
+}
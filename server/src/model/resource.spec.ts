@@ -14,4 +14,21 @@ describe('Resource validations', () => {
     expectErrors(r1, [ResourceValidationKind.DUPLICATE_RESOURCES])
     expectErrors(r2, [ResourceValidationKind.DUPLICATE_RESOURCES])
   })
+  it('stops being a duplicate when the other file is deleted or dropped', () => {
+    const bundle = makeBundle()
+    bundle.load(bundleMaker({}))
+    const r1 = bundle.allResources.getOrAdd('media/foo.txt')
+    const r2 = bundle.allResources.getOrAdd('media/FOO.TXT')
+    r1.load('bits-dont-matter')
+    r2.load('bits-dont-matter')
+    expectErrors(r1, [ResourceValidationKind.DUPLICATE_RESOURCES])
+
+    r2.load(undefined)
+    expectErrors(r1, [])
+    r2.load('bits-dont-matter')
+    expectErrors(r1, [ResourceValidationKind.DUPLICATE_RESOURCES])
+
+    bundle.allResources.remove(r2.absPath)
+    expectErrors(r1, [])
+  })
 })
@@ -5,6 +5,7 @@ import { type PageNode } from './page'
 import { type Factory } from './factory'
 import { type ResourceNode } from './resource'
 import { type H5PExercise } from './h5p-exercise'
+import { type Fileish } from './fileish'
 
 export const NS_COLLECTION = 'http://cnx.rice.edu/collxml'
 const NS_CNXML = 'http://cnx.rice.edu/cnxml'
@@ -85,6 +86,7 @@ export interface Bundleish {
   workspaceRootUri: string
   isDuplicateUuid: (uuid: string) => boolean
   isDuplicateFilePath: (path: string) => boolean
+  onNodeLoaded: (node: Fileish) => void
   paths: Paths
 }
 
@@ -107,7 +109,12 @@ export function join(helper: PathHelper<string>, type: PathKind, parent: string,
 }
 
 export function findDuplicates<T>(list: I.List<T>) {
-  return list.filter((item, index) => index !== list.indexOf(item))
+  const seen = new Set<T>()
+  return list.filter(item => {
+    if (seen.has(item)) return true
+    seen.add(item)
+    return false
+  })
 }
 
 export function calculateElementPositions(element: any): Range {
@@ -168,6 +175,23 @@ export async function profileAsync<T>(fn: () => Promise<T>) {
   return [Date.now() - start, ret]
 }
 
+// Runs fn on every item with at most `limit` of them in flight. No more items
+// are started once one fails or `isStopped` returns true.
+export async function forEachLimit<T>(items: T[], limit: number, fn: (item: T) => Promise<void>, isStopped: () => boolean = () => false) {
+  let next = 0
+  let failed = false
+  await Promise.all(Array.from({ length: Math.min(limit, items.length) }, async () => {
+    while (next < items.length && !failed && !isStopped()) {
+      try {
+        await fn(items[next++])
+      } catch (err) {
+        failed = true
+        throw err
+      }
+    }
+  }))
+}
+
 function isAfter(a: Position, b: Position) {
   if (a.line === b.line) {
     return a.character > b.character
@@ -0,0 +1,54 @@
+import { isMainThread, parentPort } from 'worker_threads'
+import { NOWHERE } from './model/utils'
+import { FactsKind, type FactsResult, readXML } from './model/fileish'
+import { type PageFacts, extractPageFacts } from './model/page'
+import { scanPageFacts } from './model/page-scanner'
+import { type BookFacts, extractBookFacts } from './model/book'
+import { idFixer } from './fix-document-ids'
+
+export type Facts = PageFacts | BookFacts
+
+// With fixIds the missing ids are added first. The response then has the new
+// content and the facts are the ones of the new content.
+export interface ParseRequest { id: number, kind: FactsKind, content: string, fixIds?: boolean }
+export interface ParseResponse { id: number, result: FactsResult<Facts>, content?: string, error?: string }
+
+// Parse the XML and pull out everything the node needs. This runs without a
+// Bundle so it only depends on the file contents.
+export function extractFacts(kind: FactsKind, content: string): FactsResult<Facts> {
+  if (kind === FactsKind.PAGE) {
+    const facts = scanPageFacts(content)
+    if (facts !== undefined) return { facts }
+  }
+  const { doc, error } = readXML(content)
+  if (error !== undefined) return { error }
+  try {
+    switch (kind) {
+      case FactsKind.PAGE: return { facts: extractPageFacts(doc) }
+      case FactsKind.BOOK: return { facts: extractBookFacts(doc) }
+    }
+  } catch (err) {
+    // Same as a WrappedParseError
+    return { error: { message: (err as Error).message, range: NOWHERE } }
+  }
+}
+
+export function handleParseRequest(req: ParseRequest): ParseResponse {
+  if (req.fixIds === true) {
+    let content: string
+    try {
+      content = idFixer(req.content, `(parse request ${req.id})`)
+    } catch (err) {
+      // Throwing here would take down the worker and every request on it
+      return { id: req.id, result: { error: { message: (err as Error).message, range: NOWHERE } }, error: (err as Error).message }
+    }
+    return { id: req.id, result: extractFacts(req.kind, content), content }
+  }
+  return { id: req.id, result: extractFacts(req.kind, req.content) }
+}
+
+/* istanbul ignore next */
+if (!isMainThread && parentPort !== null) {
+  const port = parentPort
+  port.on('message', (req: ParseRequest) => { port.postMessage(handleParseRequest(req)) })
+}
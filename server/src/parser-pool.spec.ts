@@ -0,0 +1,118 @@
+import { expect } from '@jest/globals'
+import { FactsKind } from './model/fileish'
+import { PageLinkKind } from './model/page'
+import { bookMaker, makeBundle, pageMaker } from './model/spec-helpers.spec'
+import { handleParseRequest, type ParseRequest } from './parse-worker'
+import { ParserPool, type WorkerLike } from './parser-pool'
+
+// Runs the worker code in this thread but answers asynchronously like a real worker would
+class FakeWorker implements WorkerLike {
+  public readonly received: ParseRequest[] = []
+  private readonly listeners = new Map<string, (arg: any) => void>()
+  public terminated = false
+  postMessage(req: ParseRequest) {
+    this.received.push(req)
+    setImmediate(() => { this.listeners.get('message')?.(handleParseRequest(req)) })
+  }
+
+  on(event: 'message' | 'error', listener: (arg: any) => void) { this.listeners.set(event, listener) }
+  async terminate() { this.terminated = true; return 0 }
+  crash(err: Error) { this.listeners.get('error')?.(err) }
+}
+
+describe('ParserPool', () => {
+  let workers: FakeWorker[] = []
+  const factory = () => {
+    const w = new FakeWorker()
+    workers.push(w)
+    return w
+  }
+  beforeEach(() => {
+    workers = []
+  })
+
+  it('installs the same facts as parsing on the main thread', async () => {
+    const pool = new ParserPool(2, factory)
+    const contents = pageMaker({
+      title: 'Parsed off-thread',
+      elementIds: ['id1', 'id2'],
+      imageHrefs: ['../../media/img.png'],
+      pageLinks: [{ url: 'https://openstax.org' }, { targetPage: 'm2', targetId: 'id3' }, {}],
+      extraCnxml: '<para/>'
+    })
+    const expected = makeBundle().allPages.getOrAdd('/some/modules/m1/index.cnxml')
+    expected.load(contents)
+    const actual = makeBundle().allPages.getOrAdd('/some/modules/m1/index.cnxml')
+    actual.loadFacts(await pool.parse(FactsKind.PAGE, contents))
+
+    expect(actual.isLoaded).toBe(true)
+    expect(actual.exists).toBe(true)
+    expect(actual.title).toBe('Parsed off-thread')
+    expect(actual.uuid()).toBe(expected.uuid())
+    expect(actual.elementIds.toJS()).toEqual(expected.elementIds.toJS())
+    expect(actual.resources.map(r => r.absPath).toArray()).toEqual(expected.resources.map(r => r.absPath).toArray())
+    expect(actual.pageLinks.map(l => [l.type, l.range]).toArray()).toEqual(expected.pageLinks.map(l => [l.type, l.range]).toArray())
+    expect(actual.pageLinks.some(l => l.type === PageLinkKind.PAGE_ELEMENT)).toBe(true)
+    expect(actual.validationErrors.errors.map(e => [e.title, e.range]).toArray()).toEqual(expected.validationErrors.errors.map(e => [e.title, e.range]).toArray())
+    await pool.terminate()
+  })
+
+  it('parses books', async () => {
+    const pool = new ParserPool(1, factory)
+    const book = makeBundle().allBooks.getOrAdd('/some/collections/slug1.collection.xml')
+    book.loadFacts(await pool.parse(FactsKind.BOOK, bookMaker({ toc: [{ title: 'Chapter', children: ['m1'] }, 'm2'] })))
+    expect(book.title).toBe('test collection')
+    expect(book.pages.map(p => p.absPath).toArray()).toEqual(['/some/modules/m1/index.cnxml', '/some/modules/m2/index.cnxml'])
+    await pool.terminate()
+  })
+
+  it('reports XML and extraction errors as parse errors', async () => {
+    const pool = new ParserPool(1, factory)
+    const page = makeBundle().allPages.getOrAdd('/some/modules/m1/index.cnxml')
+    page.loadFacts(await pool.parse(FactsKind.PAGE, pageMaker({ uuid: 'a</md:uuid><md:uuid>b' })))
+    expect(page.isLoaded).toBe(false)
+    expect(page.isValidXML).toBe(false)
+    expect(page.validationErrors.errors.first()?.title).toBe("ERROR: Expected one but found 2 results that match '//md:uuid'")
+    await pool.terminate()
+  })
+
+  it('adds missing ids and sends back the facts of the fixed content', async () => {
+    const pool = new ParserPool(1, factory)
+    const { content, result } = await pool.fixIds(FactsKind.PAGE, pageMaker({ extraCnxml: '<para>needs an id</para>' }))
+    expect(content).toEqual(expect.stringContaining('<para id="para-00001">needs an id</para>'))
+    const page = makeBundle().allPages.getOrAdd('/some/modules/m1/index.cnxml')
+    page.loadFacts(result)
+    expect(page.elementsMissingIds.size).toBe(0)
+    expect(page.hasElementId('para-00001')).toBe(true)
+    // Nothing to fix is a bug but it only fails that one request
+    await expect(pool.fixIds(FactsKind.PAGE, content)).rejects.toThrow('BUG!')
+    expect(workers.length).toBe(1)
+    await pool.terminate()
+  })
+
+  it('starts workers lazily and spreads requests across them', async () => {
+    const pool = new ParserPool(3, factory)
+    expect(workers.length).toBe(0)
+    const contents = pageMaker({})
+    await Promise.all([1, 2, 3, 4, 5].map(async () => await pool.parse(FactsKind.PAGE, contents)))
+    expect(workers.length).toBe(3)
+    expect(workers.map(w => w.received.length).sort()).toEqual([1, 2, 2])
+    // Idle workers are reused
+    await pool.parse(FactsKind.PAGE, contents)
+    expect(workers.length).toBe(3)
+    await pool.terminate()
+    expect(workers.every(w => w.terminated)).toBe(true)
+  })
+
+  it('fails the requests of a crashed worker and replaces it', async () => {
+    const pool = new ParserPool(1, factory)
+    const p = pool.parse(FactsKind.PAGE, pageMaker({}))
+    workers[0].crash(new Error('boom'))
+    await expect(p).rejects.toThrow('boom')
+    const page = makeBundle().allPages.getOrAdd('/some/modules/m1/index.cnxml')
+    page.loadFacts(await pool.parse(FactsKind.PAGE, pageMaker({})))
+    expect(page.isLoaded).toBe(true)
+    expect(workers.length).toBe(2)
+    await pool.terminate()
+  })
+})
@@ -0,0 +1,109 @@
+import path from 'path'
+import { Worker } from 'worker_threads'
+import { type FactsKind, type FactsResult } from './model/fileish'
+import { expectValue } from './model/utils'
+import { type Facts, type ParseRequest, type ParseResponse } from './parse-worker'
+
+// The subset of worker_threads.Worker that the pool uses. Tests provide their own.
+export interface WorkerLike {
+  postMessage: (req: ParseRequest) => void
+  on: (event: 'message' | 'error', listener: (arg: any) => void) => unknown
+  terminate: () => Promise<number>
+}
+
+interface PoolWorker { worker: WorkerLike, inFlight: Set<number> }
+interface Callback { resolve: (res: ParseResponse) => void, reject: (err: Error) => void }
+
+const WORKER_MODULE = path.join(__dirname, 'parse-worker')
+
+/* istanbul ignore next */
+function defaultWorkerFactory(): WorkerLike {
+  // The CLI runs through ts-node so there is no compiled parse-worker.js to load
+  if (__filename.endsWith('.ts')) {
+    return new Worker(`require('ts-node/register'); require(${JSON.stringify(`${WORKER_MODULE}.ts`)})`, { eval: true })
+  }
+  return new Worker(`${WORKER_MODULE}.js`)
+}
+
+// Parses XML files and extracts their facts in worker threads so the main
+// thread only has to install the results (see Fileish.loadFacts).
+// Workers are started lazily and each request goes to the least busy one.
+export class ParserPool {
+  private readonly workers: PoolWorker[] = []
+  private readonly callbacks = new Map<number, Callback>()
+  private nextId = 0
+
+  constructor(public readonly size: number, private readonly workerFactory: () => WorkerLike = defaultWorkerFactory) {
+    /* istanbul ignore if */
+    if (size < 1) {
+      throw new Error(`BUG: ParserPool needs at least one thread but was given ${size}`)
+    }
+  }
+
+  public async parse(kind: FactsKind, content: string): Promise<FactsResult<Facts>> {
+    return (await this.send({ kind, content })).result
+  }
+
+  // Adds the missing ids (see idFixer) and parses the new content so neither
+  // happens on the main thread
+  public async fixIds(kind: FactsKind, content: string): Promise<{ content: string, result: FactsResult<Facts> }> {
+    const res = await this.send({ kind, content, fixIds: true })
+    return { content: expectValue(res.content, 'BUG: The parse worker did not send back the fixed content'), result: res.result }
+  }
+
+  public async terminate() {
+    const workers = this.workers.splice(0)
+    await Promise.all(workers.map(async w => {
+      this.fail(w, new Error('ParserPool was terminated'))
+      await w.worker.terminate()
+    }))
+  }
+
+  private async send(req: Omit<ParseRequest, 'id'>): Promise<ParseResponse> {
+    const id = this.nextId++
+    const w = this.pickWorker()
+    return await new Promise((resolve, reject) => {
+      this.callbacks.set(id, { resolve, reject })
+      w.inFlight.add(id)
+      w.worker.postMessage({ ...req, id })
+    })
+  }
+
+  private pickWorker() {
+    const idle = this.workers.find(w => w.inFlight.size === 0)
+    if (idle !== undefined) return idle
+    if (this.workers.length < this.size) return this.spawn()
+    return this.workers.reduce((a, b) => b.inFlight.size < a.inFlight.size ? b : a)
+  }
+
+  private spawn() {
+    const w: PoolWorker = { worker: this.workerFactory(), inFlight: new Set() }
+    w.worker.on('message', (res: ParseResponse) => {
+      w.inFlight.delete(res.id)
+      const cb = this.callbacks.get(res.id)
+      this.callbacks.delete(res.id)
+      if (res.error !== undefined) {
+        cb?.reject(new Error(res.error))
+      } else {
+        cb?.resolve(res)
+      }
+    })
+    w.worker.on('error', (err: Error) => {
+      // The worker is gone. Fail its requests and let a new one be spawned
+      const i = this.workers.indexOf(w)
+      if (i >= 0) this.workers.splice(i, 1)
+      this.fail(w, err)
+    })
+    this.workers.push(w)
+    return w
+  }
+
+  private fail(w: PoolWorker, err: Error) {
+    w.inFlight.forEach(id => {
+      const cb = this.callbacks.get(id)
+      this.callbacks.delete(id)
+      cb?.reject(err)
+    })
+    w.inFlight.clear()
+  }
+}
@@ -1,25 +1,17 @@
 import fs from 'node:fs'
 
-import type { BundleGenerateReadmeParams, BundleEnsureIdsParams, BundleGetSubmoduleConfigParams } from '../../common/src/requests'
-import { idFixer } from './fix-document-ids'
+import type { BundleGenerateReadmeParams, BundleEnsureIdsParams, EnsureIdsSummary, BundleGetSubmoduleConfigParams, BundleBookTocsParams, VersionedBooksAndOrphans } from '../../common/src/requests'
 import { bundleFactory } from './server'
-import { type ModelManager } from './model-manager'
-import { type CompletionItem, type CompletionParams } from 'vscode-languageserver/node'
-import { PageValidationKind } from './model/page'
+import { ModelManager } from './model-manager'
+import { type CancellationToken, CompletionList, type CompletionParams } from 'vscode-languageserver/node'
 import { generateReadmeForWorkspace } from './readme-generator'
 import { URI } from 'vscode-uri'
 import { parseGitConfig } from './git-config-parser'
 
-export function bundleEnsureIdsHandler(): (request: BundleEnsureIdsParams) => Promise<void> {
-  return async (request: BundleEnsureIdsParams) => {
+export function bundleEnsureIdsHandler(): (request: BundleEnsureIdsParams, token: CancellationToken) => Promise<EnsureIdsSummary> {
+  return async (request: BundleEnsureIdsParams, token: CancellationToken) => {
     const manager = bundleFactory.getOrAdd(request.workspaceUri)
-    // TODO: fix modules in parallel. Problem: Could be a memory hog.
-    const pages = manager.bundle.allPages.all.filter(p => p.exists && p.isLoaded)
-    const pagesWithMissingIds = pages.filter(p => {
-      const errorTypes = p.validationErrors.errors.map(e => e.title)
-      return errorTypes.has(PageValidationKind.MISSING_ID.title)
-    })
-    await Promise.all(pagesWithMissingIds.map(async p => await manager.modifyFileish(p, idFixer)))
+    return await manager.ensureIds(request.workDoneToken, token)
   }
 }
 
@@ -49,15 +41,22 @@ export function bundleGetSubmoduleConfig(): (request: BundleGetSubmoduleConfigPa
   }
 }
 
-export async function autocompleteHandler(documentPosition: CompletionParams, manager: ModelManager): Promise<CompletionItem[]> {
+export function bundleBookTocs(): (request: BundleBookTocsParams) => VersionedBooksAndOrphans {
+  return (request: BundleBookTocsParams) => bundleFactory.getOrAdd(request.workspaceUri).bookTocsSnapshot
+}
+
+export async function autocompleteHandler(documentPosition: CompletionParams, manager: ModelManager): Promise<CompletionList> {
   const cursor = documentPosition.position
   const page = manager.bundle.allPages.get(documentPosition.textDocument.uri)
 
   if (page !== undefined && page.exists) {
-    return (await Promise.all([
+    const results = await Promise.all([
       manager.autocompleteResources(page, cursor),
       manager.autocompleteUrls(page, cursor)
-    ])).flat()
+    ])
+    // When a list was cut short the client has to ask again as more is typed
+    const isIncomplete = results.some(r => r.length >= ModelManager.autocompleteLimit)
+    return CompletionList.create(results.flat(), isIncomplete)
   }
-  return []
+  return CompletionList.create([])
 }
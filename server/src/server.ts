@@ -6,23 +6,27 @@ import {
   TextDocumentSyncKind,
   type InitializeResult,
   type CompletionItem,
+  type CompletionList,
   type CancellationToken,
   type CompletionParams
 } from 'vscode-languageserver/node'
 
 import { TextDocument } from 'vscode-languageserver-textdocument'
 import { URI, Utils } from 'vscode-uri'
-import { expectValue } from './model/utils'
+import { expectValue, type Opt } from './model/utils'
 
 import { ExtensionServerRequest } from '../../common/src/requests'
-import { bundleEnsureIdsHandler, bundleGenerateReadme, bundleGetSubmoduleConfig, autocompleteHandler } from './server-handler'
+import { bundleEnsureIdsHandler, bundleGenerateReadme, bundleGetSubmoduleConfig, bundleBookTocs, autocompleteHandler } from './server-handler'
 
 import * as sourcemaps from 'source-map-support'
+import path from 'path'
 import { Bundle } from './model/bundle'
 import { Factory } from './model/factory'
 import { ModelManager } from './model-manager'
 import { JobRunner } from './job-runner'
-import { type TocModificationParams, TocNodeKind } from '../../common/src/toc'
+import { ParserPool } from './parser-pool'
+import { FactCache, hashContent } from './fact-cache'
+import { type TocModificationParams, type TocModificationBatchParams } from '../../common/src/toc'
 import { Fileish } from './model/fileish'
 sourcemaps.install()
 
@@ -47,10 +51,19 @@ const pathHelper = {
   }
 }
 
+// Set up in onInitialize when the client asks for them
+let parserPool: Opt<ParserPool>
+let cacheDir: Opt<string>
+
 export /* for server-handler.ts */ const bundleFactory = new Factory(workspaceUri => {
   const filePath = workspaceUri
   const b = new Bundle(pathHelper, filePath)
-  return new ModelManager(b, connection)
+  const manager = new ModelManager(b, connection)
+  manager.parserPool = parserPool
+  if (cacheDir !== undefined) {
+    manager.factCache = new FactCache(path.join(cacheDir, `${hashContent(workspaceUri)}.json`))
+  }
+  return manager
 }, (x) => pathHelper.canonicalize(x))
 
 const consoleDebug = (...args: any[]) => {
@@ -63,6 +76,11 @@ ModelManager.debug = consoleDebug
 JobRunner.debug = () => {}
 
 connection.onInitialize(async (params: InitializeParams) => {
+  const parserThreads: number = params.initializationOptions?.parserThreads ?? 0
+  if (parserThreads > 0) {
+    parserPool = new ParserPool(parserThreads)
+  }
+  cacheDir = params.initializationOptions?.cacheDir
   // https://microsoft.github.io/language-server-protocol/specification#workspace_workspaceFolders
   params.workspaceFolders?.forEach(w => bundleFactory.getOrAdd(w.uri)) // create bundles.
 
@@ -124,7 +142,7 @@ documents.onDidClose(({ document }) => {
 
 documents.onDidChangeContent(({ document }) => {
   const manager = getBundleForUri(document.uri)
-  manager.updateFileContents(document.uri, document.getText())
+  manager.scheduleFileContents(document.uri, document.getText(), document.version)
 })
 connection.onDidChangeWatchedFiles(({ changes }) => {
   const inner = async (): Promise<void> => {
@@ -142,26 +160,23 @@ connection.onDidChangeWatchedFiles(({ changes }) => {
 })
 
 connection.onRequest(ExtensionServerRequest.TocModification, async (params: TocModificationParams) => {
-  const { event } = params
   const manager = getBundleForUri(params.workspaceUri)
-  if (event.type === TocNodeKind.Page) {
-    await manager.createPage(event.bookIndex, event.parentNodeToken, event.title)
-  } else if (event.type === TocNodeKind.Subbook) {
-    await manager.createSubbook(event.bookIndex, event.parentNodeToken, event.title)
-  } else if (event.type === TocNodeKind.Ancillary) {
-    await manager.createAncillary(event.bookIndex, event.parentNodeToken, event.title)
-  } else {
-    await manager.modifyToc(event)
-  }
+  await manager.modifyTocs([params.event], params.version)
+})
+
+connection.onRequest(ExtensionServerRequest.TocModificationBatch, async (params: TocModificationBatchParams) => {
+  const manager = getBundleForUri(params.workspaceUri)
+  await manager.modifyTocs(params.events, params.version)
 })
 
 connection.onRequest(ExtensionServerRequest.BundleEnsureIds, bundleEnsureIdsHandler())
 connection.onRequest(ExtensionServerRequest.GenerateReadme, bundleGenerateReadme())
 connection.onRequest(ExtensionServerRequest.GetSubmoduleConfig, bundleGetSubmoduleConfig())
+connection.onRequest(ExtensionServerRequest.BookTocs, bundleBookTocs())
 
 connection.onCompletionResolve((a: CompletionItem, token: CancellationToken): CompletionItem => a)
 
-connection.onCompletion(async (params: CompletionParams): Promise<CompletionItem[]> => {
+connection.onCompletion(async (params: CompletionParams): Promise<CompletionList> => {
   const manager = getBundleForUri(params.textDocument.uri)
   return await autocompleteHandler(params, manager)
 })
@@ -181,4 +196,8 @@ connection.onDocumentLinks(async ({ textDocument }) => {
 documents.listen(connection)
 
 // Listen on the connection
+connection.onShutdown(async () => {
+  await Promise.all(bundleFactory.all.toArray().map(async m => { await m.factCache?.save() }))
+})
+
 connection.listen()
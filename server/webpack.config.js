@@ -9,10 +9,14 @@ const config = {
   target: 'node',
 
   context: path.join(__dirname),
-  entry: './src/server.ts',
+  entry: {
+    server: './src/server.ts',
+    // Loaded by ParserPool with worker_threads
+    'parse-worker': './src/parse-worker.ts'
+  },
   output: {
     path: path.resolve(__dirname, 'dist'),
-    filename: 'server.js',
+    filename: '[name].js',
     libraryTarget: 'commonjs2',
     devtoolModuleFilenameTemplate: '../[resource-path]'
   },